@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+"""Asyncio serving path for /similarusers, run alongside the uWSGI/Flask app.
+
+A /similarusers request spends nearly all its time waiting on the MediaWiki
+API, which pins one of the few synchronous uWSGI workers for that long. Here
+the same flow runs as a coroutine on one event loop, so one process can have
+hundreds of slow queries in flight:
+
+    python3 aioserver.py --config flask_config.yaml --resourcedir resources --port 5001
+
+and nginx can send /similarusers to it while the rest of the API stays on
+uWSGI. It loads the same config and data as wsgi.py and shares its code: only
+the MediaWiki API calls are made differently (mediawiki_async.py), and the
+JSON it returns is rendered by the Flask app, so it is the same byte for byte.
+The work on the data (the overlay, which may be the shared SQLite database,
+and building the response) runs on a small thread pool so it doesn't hold up
+the event loop.
+
+Limits (all optional, in the config):
+* ASYNC_MAX_REQUESTS: /similarusers requests worked on at once; the rest wait their turn
+* ASYNC_MW_CONNECTIONS: connections open to each wiki's API host
+* ASYNC_REQUEST_TIMEOUT: seconds before a request is given up with a 504 (like
+  uWSGI's harakiri); MW_TIME_BUDGET still bounds the page fetches within it
+* ASYNC_DATA_THREADS: threads for the work on the data
+
+A request whose client disconnects is cancelled, and so are the API calls made
+for it -- unless another request for the same user is waiting on them (see
+AsyncSingleFlight). Pages whose histories were not fetched stay pending for
+the user and are fetched on their next request, as with MW_TIME_BUDGET.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import functools
+import logging
+
+import aiohttp
+from aiohttp import web
+from flask import jsonify
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import GatewayTimeout, HTTPException, ServiceUnavailable
+from werkzeug.http import remove_entity_headers
+
+import instrumentation
+import mediawiki
+import mediawiki_async
+import refresh
+import wsgi
+
+app = wsgi.app
+
+DEFAULT_ASYNC_MAX_REQUESTS = 500
+DEFAULT_ASYNC_MW_CONNECTIONS = 100
+DEFAULT_ASYNC_REQUEST_TIMEOUT = 50  # seconds, as uwsgi.ini's harakiri
+DEFAULT_ASYNC_DATA_THREADS = 8
+DEFAULT_PORT = 5001
+
+# aiohttp 3.9 stopped cancelling handlers when the client goes away unless asked to
+HANDLER_CANCELLATION = (
+    {"handler_cancellation": True}
+    if tuple(int(n) for n in aiohttp.__version__.split(".")[:2]) >= (3, 9)
+    else {}
+)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSingleFlight(object):
+    """refresh.SingleFlight for coroutines: concurrent calls with the same key share one task.
+
+    The task is cancelled once every caller waiting for it has been.
+    """
+
+    def __init__(self):
+        self._flights = {}  # key -> [task, # of callers waiting]
+
+    async def do(self, key, fn):
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = [asyncio.ensure_future(fn()), 0]
+            self._flights[key] = flight
+            flight[0].add_done_callback(functools.partial(self._landed, key, flight))
+        flight[1] += 1
+        try:
+            return await asyncio.shield(flight[0])
+        finally:
+            flight[1] -= 1
+            if not flight[1] and not flight[0].done():
+                # nobody is waiting for it any more
+                flight[0].cancel()
+
+    def _landed(self, key, flight, task):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+
+async def finished(job):
+    """Wait for a refresh.RefreshJob run on another thread to finish."""
+    loop = asyncio.get_event_loop()
+    done = loop.create_future()
+
+    def resolve():
+        # (the waiter may have been cancelled meanwhile)
+        if not done.done():
+            done.set_result(None)
+
+    job.add_done_callback(lambda: loop.call_soon_threadsafe(resolve))
+    await done
+
+
+class AsyncServer(object):
+    """The /similarusers flow of wsgi.get_similar_users, with the API calls awaited."""
+
+    def __init__(self):
+        config = app.config
+        self.request_slots = asyncio.Semaphore(
+            config.get("ASYNC_MAX_REQUESTS", DEFAULT_ASYNC_MAX_REQUESTS)
+        )
+        self.timeout = config.get("ASYNC_REQUEST_TIMEOUT", DEFAULT_ASYNC_REQUEST_TIMEOUT)
+        self.executor = ThreadPoolExecutor(
+            config.get("ASYNC_DATA_THREADS", DEFAULT_ASYNC_DATA_THREADS),
+            thread_name_prefix="data",
+        )
+        self.user_checks = AsyncSingleFlight()
+        self.refreshes = AsyncSingleFlight()
+
+    async def run(self, fn, *args):
+        """fn(*args) on the data threads."""
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, functools.partial(fn, *args)
+        )
+
+    def session(self, wiki):
+        return mediawiki_async.get_session(
+            wiki.host,
+            app.config["CUSTOM_UA"],
+            app.config.get("ASYNC_MW_CONNECTIONS", DEFAULT_ASYNC_MW_CONNECTIONS),
+            timeout=app.config.get("MW_TIMEOUT", wsgi.DEFAULT_MW_TIMEOUT),
+        )
+
+    async def similar_users(self, request):
+        """GET /similarusers, with the same parameters and responses as wsgi.get_similar_users."""
+        try:
+            if not in_flask(request, wsgi.basic_auth.authenticate):
+                return to_aiohttp(in_flask(request, wsgi.basic_auth.challenge))
+            async with self.request_slots:
+                return await asyncio.wait_for(self._similar_users(request), self.timeout)
+        except HTTPException as exc:
+            return to_aiohttp(exc.get_response())
+        except asyncio.TimeoutError:
+            return to_aiohttp(GatewayTimeout("Ran out of time").get_response())
+
+    async def _similar_users(self, request):
+        # what wsgi.bind_data does before each request
+        if wsgi.load_status()["status"] != "ready":
+            raise ServiceUnavailable("Data is not loaded yet")
+        name, user_text, num_similar, followup = in_flask(request, parse_args)
+        wiki = wsgi.WIKIS.get(name)
+        await self.run(wsgi.check_snapshot, wiki)
+        try:
+            dataset = await self.run(wsgi.WIKIS.dataset, name)
+        except Exception as exc:
+            app.logger.exception("Failed to load %s", name)
+            raise ServiceUnavailable("Could not load the data for {0}: {1}".format(name, exc))
+
+        user_text, error = await self.validate_user_text(dataset, user_text)
+        if error is not None:
+            app.logger.error("Got error when trying to validate API arguments: %s", error)
+            return to_aiohttp(await self.run(in_app, jsonify, {"Error": error}))
+        ranking, stale = in_flask(request, lambda: (wsgi.validate_ranking(), wsgi.stale_requested()))
+
+        if stale:
+            # the refresh runs on the wiki's RefreshQueue, as under uWSGI
+            return to_aiohttp(
+                await self.run(
+                    in_app,
+                    wsgi.get_similar_users_stale,
+                    dataset,
+                    user_text,
+                    num_similar,
+                    followup,
+                    ranking,
+                )
+            )
+
+        responses = wiki.responses
+        cached = responses.get(user_text, num_similar, followup, ranking)
+        # responses are served as they are for RESPONSE_CACHE_TTL seconds, unless pages are still pending
+        if (
+            cached is None
+            or not responses.is_fresh(cached)
+            or await self.run(dataset.data.pending_pages, user_text)
+        ):
+            job = await self.refreshes.do(
+                (name, user_text), lambda: self.refresh(dataset, user_text)
+            )
+            if job.status == refresh.FAILED:
+                result = await self.run(
+                    wsgi.build_unrefreshed, dataset, user_text, num_similar, followup, ranking, job
+                )
+                return to_aiohttp(await self.run(in_app, jsonify, result))
+            skipped_pages = job.result or []
+            version = await self.run(dataset.data.version, user_text)
+            if cached is not None and cached.version == version and not skipped_pages:
+                responses.validate(cached)
+            else:
+                result = await self.run(
+                    wsgi.build_similar_users,
+                    dataset,
+                    user_text,
+                    num_similar,
+                    followup,
+                    skipped_pages,
+                    ranking,
+                )
+                if skipped_pages:
+                    # partial results aren't cached
+                    return to_aiohttp(await self.run(in_app, jsonify, result))
+                cached = responses.put(user_text, num_similar, followup, version, result, ranking)
+
+        etag, body = await self.run(render, dataset, cached, num_similar)
+        return to_aiohttp(in_flask(request, conditional_response, etag, body))
+
+    async def validate_user_text(self, dataset, user_text):
+        """wsgi.validate_user_text, with the check of users who are not in the data awaited."""
+        user_text = wsgi.standardize_user_text(user_text)
+        if not user_text:
+            return user_text, wsgi.MISSING_USER_TEXT
+        # concurrent requests for a user who is not in the data share one check
+        error = await self.user_checks.do(
+            (dataset.name, user_text), lambda: self.check_user_text(dataset, user_text)
+        )
+        return user_text, error
+
+    async def check_user_text(self, dataset, user_text):
+        """wsgi.check_user_text with the API calls awaited."""
+        with instrumentation.stage("check_user_text", dataset.name):
+            if await self.run(dataset.data.__contains__, user_text):
+                return None
+            wiki = dataset.wiki
+            session = self.session(wiki)
+            result = await session.get(**wsgi.usercontribs_query(dataset, user_text))
+            instrumentation.api_call("usercontribs", session.host)
+            has_contribs = bool(result["query"]["usercontribs"])
+            status = None
+            if has_contribs:
+                statuses = await mediawiki_async.lookup_account_statuses(
+                    wsgi.get_account_cache(wiki), session, [user_text]
+                )
+                status = statuses.get(user_text)
+            return await self.run(wsgi.admit_user, dataset, user_text, has_contribs, status)
+
+    async def refresh(self, dataset, user_text):
+        """Refresh a user's data as a job of the wiki's RefreshQueue (see wsgi.get_similar_users_stale) and return the finished job."""
+        queue = dataset.wiki.refreshes
+        job, claimed = queue.claim(user_text)
+        if not claimed:
+            # being refreshed in the background: wait without holding up a data thread
+            await finished(job)
+            return job
+        try:
+            result = await self.refresh_user_data(dataset, user_text)
+        except asyncio.CancelledError:
+            queue.finish(job, error="Cancelled")
+            raise
+        except Exception as exc:
+            logger.exception("Refresh of %s failed", user_text)
+            queue.finish(job, error=str(exc))
+        else:
+            queue.finish(job, result=result)
+        return job
+
+    async def refresh_user_data(self, dataset, user_text):
+        """wsgi.refresh_user_data with the API calls awaited. Returns the pages that could not be fetched in time."""
+        metadata = await self.run(dataset.data.metadata, user_text)
+        if metadata is None:
+            # evicted from the overlay since they were checked
+            return []
+        if await self.run(wsgi.ingested, dataset, user_text):
+            return []
+        edits = await self.get_additional_edits(dataset, user_text, metadata["most_recent_edit"])
+        if edits is None:
+            return []
+        return await self.update_coedit_data(
+            dataset, user_text, edits, app.config["EDIT_WINDOW"]
+        )
+
+    async def get_additional_edits(self, dataset, user_text, last_edit_timestamp):
+        """wsgi.get_additional_edits with the API calls awaited."""
+        with instrumentation.stage("get_additional_edits", dataset.name):
+            listing = await self.run(wsgi.EditListing, dataset, user_text, last_edit_timestamp)
+            session = self.session(dataset.wiki)
+            try:
+                async for r in session.listing(**listing.query()):
+                    instrumentation.api_call("allrevisions", session.host)
+                    if listing.add(r):
+                        break
+                return await self.run(listing.record)
+            except Exception as exc:
+                listing.failed(exc)
+                return None
+
+    async def update_coedit_data(self, dataset, user_text, new_edits, k):
+        """wsgi.update_coedit_data with the API calls awaited."""
+        with instrumentation.stage("update_coedit_data", dataset.name):
+            wiki = dataset.wiki
+            session = self.session(wiki)
+            update = await self.run(wsgi.CoeditUpdate, dataset, {user_text: new_edits}, k)
+            with instrumentation.stage("fetch_page_revisions", dataset.name):
+                revisions, skipped = await mediawiki_async.fetch_page_revisions(
+                    session,
+                    update.pageids(),
+                    max_concurrency=app.config.get("MW_MAX_WORKERS", wsgi.DEFAULT_MW_MAX_WORKERS),
+                    deadline=mediawiki.Deadline(
+                        app.config.get("MW_TIME_BUDGET", wsgi.DEFAULT_MW_TIME_BUDGET)
+                    ),
+                    cache=wsgi.get_revision_cache(wiki),
+                    **update.revisions_query()
+                )
+            await self.run(update.add_revisions, revisions, skipped)
+            with instrumentation.stage("account_status", dataset.name):
+                unknown_users = await self.run(update.unknown_users)
+                statuses = await mediawiki_async.lookup_account_statuses(
+                    wsgi.get_account_cache(wiki), session, unknown_users
+                )
+            skipped_pages = await self.run(update.record, statuses)
+            return skipped_pages[user_text]
+
+    async def close(self, web_app):
+        await mediawiki_async.close_sessions()
+        self.executor.shutdown(wait=False)
+
+
+def parse_args():
+    """(wiki, usertext, k, followup) of a /similarusers request, as wsgi.py reads them."""
+    name = wsgi.request.args.get("wiki") or wsgi.WIKIS.default
+    if name not in wsgi.WIKIS:
+        wsgi.abort(422, "Unknown wiki: {0}".format(name))
+    return (name,) + wsgi.parse_api_args()
+
+
+def in_flask(request, fn, *args):
+    """fn(*args) in a Flask request context for an aiohttp request.
+
+    Nothing is awaited inside it, so other requests on the event loop never
+    see this one's context.
+    """
+    with app.test_request_context(
+        request.path,
+        query_string=request.rel_url.raw_query_string,
+        headers=list(request.headers.items()),
+    ):
+        return fn(*args)
+
+
+def in_app(fn, *args):
+    """fn(*args) in a Flask app context (e.g. to jsonify), on whichever thread runs it."""
+    with app.app_context():
+        return fn(*args)
+
+
+def render(dataset, cached, num_similar):
+    """(etag, body) of a cached response trimmed to num_similar results."""
+    with app.app_context():
+        with instrumentation.stage("render", dataset.name):
+            return cached.body(
+                num_similar,
+                lambda result, k: jsonify(wsgi.trim_result(dataset, result, k)).get_data(),
+            )
+
+
+def conditional_response(etag, body):
+    """The Flask response wsgi.get_similar_users makes of a rendered body (304 if the client has it)."""
+    response = app.response_class(body, mimetype="application/json")
+    response.set_etag(etag)
+    # let browsers keep the response but check back (If-None-Match) before reusing it
+    response.cache_control.no_cache = True
+    return response.make_conditional(wsgi.request)
+
+
+def to_aiohttp(response):
+    """aiohttp response with the status, headers and body of a Flask/Werkzeug one."""
+    headers = Headers(response.headers)
+    headers.remove("Content-Length")
+    if response.status_code == 304:
+        # as Werkzeug does when it sends it
+        remove_entity_headers(headers)
+    return web.Response(
+        status=response.status_code, headers=list(headers.items()), body=response.get_data()
+    )
+
+
+async def metrics(request):
+    """Prometheus metrics of this process (as /metrics on each uWSGI worker)."""
+    return web.Response(
+        body=generate_latest(REGISTRY), headers={"Content-Type": CONTENT_TYPE_LATEST}
+    )
+
+
+def make_app():
+    """aiohttp application serving /similarusers (call once the config and data are loaded, from the event loop)."""
+    server = AsyncServer()
+    web_app = web.Application()
+    web_app.router.add_get("/similarusers", server.similar_users)
+    web_app.router.add_get("/metrics", metrics)
+    web_app.on_cleanup.append(server.close)
+    return web_app
+
+
+def parse_cli_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--config", required=True, help="flask_config.yaml to use")
+    parser.add_argument("--resourcedir", required=True, help="Directory with the data")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_cli_args()
+    wsgi.configure(args.config)
+    wsgi.load_data(args.resourcedir)
+
+    async def serve():
+        return make_app()
+
+    web.run_app(serve(), host=args.host, port=args.port, **HANDLER_CANCELLATION)
+
+
+if __name__ == "__main__":
+    main()
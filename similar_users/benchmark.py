@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+"""Benchmark loading and /similarusers latency against a local MediaWiki API stand-in.
+
+Usage:
+    python3 generate_data.py -r /tmp/bench --scale medium
+    python3 benchmark.py -r /tmp/bench --latency-ms 50 --output results.json
+    python3 benchmark.py -r /tmp/bench --compare results.json  # after a change
+
+Starts mediawiki_stub.py, points the service at it and runs it in this process
+through Flask's test client (so HTTP serving is not measured). Reports how long
+the snapshot takes to compile and to load, peak RSS, and p50/p95/p99 latency of
+/similarusers for each k, over cold queries (each user's first) and warm ones
+(the same query repeated). Results are written as JSON so runs can be compared.
+
+With --concurrency, a stress phase then fires that many identical /similarusers
+queries at once for each of --stress-users fresh users, along with batch queries
+that overlap them, and reports the MediaWiki API calls this took per user and
+how many users ended up with edits counted more than once. The benchmark exits
+with status 1 if any stress query failed, any user's edits were miscounted, or
+the API calls per user exceeded those of a cold query (see STRESS_CALLS_MARGIN).
+
+With --async-users, a last phase sends cold queries for that many fresh users
+all at once to the asyncio server (aioserver.py) over HTTP, to see how many
+slow queries one process keeps in flight.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import pathlib
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import requests
+import yaml
+
+import compile_snapshot
+import snapshot
+import wsgi
+
+# enough of flask_config.yaml to run the service; overridden by --config
+DEFAULT_CONFIG = {
+    "LOG_LEVEL": "WARNING",
+    "CUSTOM_UA": "similarusers benchmark",
+    "EARLIEST_TS": "2020-01-01T00:00:00Z",
+    "MOST_RECENT_REV_TS": "2020-10-01T00:00:00Z",
+    "TEMPORAL_OFFSET": "(-1, 0, 1)",
+    "NAMESPACES": [0],
+    "EDIT_WINDOW": 5,
+    "BASIC_AUTH_USERNAME": "benchmark",
+    "BASIC_AUTH_PASSWORD": "benchmark",
+    "OVERLAY_PATH": "",
+}
+PERCENTILES = (50, 95, 99)
+# the stress users are another sample than the cold queries' (and their pages may be cached by
+# then), so their API calls per user may run a bit over; refreshes that are not shared cost
+# about --concurrency times as much
+STRESS_CALLS_MARGIN = 1.5
+
+logger = logging.getLogger(__name__)
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB."""
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        maxrss /= 1024
+    return maxrss / 1024
+
+
+def summarize(latencies_ms):
+    latencies_ms = np.asarray(latencies_ms)
+    summary = {"n": len(latencies_ms)}
+    if len(latencies_ms):
+        summary["mean"] = float(latencies_ms.mean())
+        for p in PERCENTILES:
+            summary["p{0}".format(p)] = float(np.percentile(latencies_ms, p))
+    return summary
+
+
+def start_stub(port, latency_ms, jitter_ms, num_users, num_revisions, start):
+    """Run mediawiki_stub.py in a subprocess and wait until it answers."""
+    proc = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), "mediawiki_stub.py"),
+            "--port", str(port),
+            "--latency-ms", str(latency_ms),
+            "--jitter-ms", str(jitter_ms),
+            "--users", str(num_users),
+            "--revisions", str(num_revisions),
+            "--start", start,
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    url = "http://127.0.0.1:{0}".format(port)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            requests.get(url + "/stats", timeout=1)
+            return proc, url
+        except requests.ConnectionError:
+            if proc.poll() is not None:
+                break
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError("mediawiki_stub.py did not start on port {0}".format(port))
+
+
+def stub_calls(url):
+    return requests.get(url + "/stats").json()["calls"]
+
+
+def stub_num_edits(url, user_text, start):
+    """# of edits the stub has for a user from start on (all of them are after the dumps)."""
+    params = {
+        "action": "query",
+        "list": "allrevisions",
+        "arvuser": user_text,
+        "arvstart": start,
+        "arvlimit": 500,
+        "format": "json",
+    }
+    num_edits = 0
+    while True:
+        doc = requests.get(url + "/w/api.php", params=params).json()
+        num_edits += sum(len(page["revisions"]) for page in doc["query"]["allrevisions"])
+        if "continue" not in doc:
+            return num_edits
+        params.update(doc["continue"])
+
+
+def stress(app, headers, users, concurrency, url, start, cold_calls_per_user=None):
+    """Query each user `concurrency` times at once (plus overlapping batches) and check the result.
+
+    Identical concurrent queries should share one refresh, so the API calls per
+    user stay close to those of a single cold query (``cold_calls_per_user``, if
+    known), and every user's new edits should be counted exactly once. What went
+    wrong is listed in ``failures``.
+    """
+    paths = []
+    for i, user_text in enumerate(users):
+        other = users[(i + 1) % len(users)]
+        paths.extend(["/similarusers?usertext={0}&k=50".format(user_text)] * concurrency)
+        paths.extend(
+            ["/api/similarusers/batch?usertext={0}|{1}&k=50".format(user_text, other)]
+            * max(1, concurrency // 4)
+        )
+    random.Random(0).shuffle(paths)
+
+    def query(path):
+        begin = time.perf_counter()
+        response = app.test_client().get(path, headers=headers)
+        return path, response, (time.perf_counter() - begin) * 1000
+
+    calls_before = stub_calls(url)
+    with ThreadPoolExecutor(max_workers=concurrency * 2) as executor:
+        responses = list(executor.map(query, paths))
+    calls = stub_calls(url) - calls_before
+
+    errors = sum(
+        1
+        for _, response, _ in responses
+        if response.status_code != 200 or "Error" in (response.get_json() or {})
+    )
+    dataset = wsgi.WIKIS.dataset(wsgi.WIKIS.default)
+    data = dataset.data
+    miscounted = 0
+    for user_text in users:
+        # heavy users' edits take more than one request to gather
+        while (data.edit_cursor(user_text) or {}).get("continue"):
+            wsgi.get_additional_edits(dataset, user_text)
+        base = data.snapshot.metadata(data.user_id(user_text)) or {"num_edits": 0}
+        expected = base["num_edits"] + stub_num_edits(url, user_text, start)
+        if data.metadata(user_text)["num_edits"] != expected:
+            miscounted += 1
+    calls_per_user = calls / max(1, len(users))
+    failures = []
+    if errors:
+        failures.append("{0} of {1} queries failed".format(errors, len(paths)))
+    if miscounted:
+        failures.append("{0} users had their new edits miscounted".format(miscounted))
+    max_calls_per_user = None
+    if cold_calls_per_user:
+        max_calls_per_user = cold_calls_per_user * STRESS_CALLS_MARGIN
+        if calls_per_user > max_calls_per_user:
+            failures.append(
+                "{0:.1f} API calls per user, against {1:.1f} for a cold query".format(
+                    calls_per_user, cold_calls_per_user
+                )
+            )
+    return {
+        "users": len(users),
+        "requests": len(paths),
+        "mw_api_calls": calls,
+        "mw_api_calls_per_user": calls_per_user,
+        "max_mw_api_calls_per_user": max_calls_per_user,
+        "errors": errors,
+        "miscounted_users": miscounted,
+        "failures": failures,
+        "latency_ms": summarize([ms for _, _, ms in responses]),
+    }
+
+
+def serve_async(headers, users):
+    """Query every user at once through aioserver.py and report how long they took."""
+    import aiohttp
+    from aiohttp.test_utils import TestServer
+
+    import aioserver
+
+    async def query(http, server, user_text):
+        begin = time.perf_counter()
+        async with http.get(
+            server.make_url("/similarusers?usertext={0}&k=50".format(user_text)), headers=headers
+        ) as response:
+            doc = await response.json() if response.status == 200 else {}
+        return response.status != 200 or "Error" in doc, (time.perf_counter() - begin) * 1000
+
+    async def serve():
+        async with TestServer(aioserver.make_app()) as server:
+            connector = aiohttp.TCPConnector(limit=0)
+            async with aiohttp.ClientSession(connector=connector) as http:
+                begin = time.perf_counter()
+                responses = await asyncio.gather(
+                    *[query(http, server, user_text) for user_text in users]
+                )
+                return responses, time.perf_counter() - begin
+
+    responses, seconds = asyncio.run(serve())
+    return {
+        "users": len(users),
+        "seconds": seconds,
+        "errors": sum(1 for error, _ in responses if error),
+        "latency_ms": summarize([ms for _, ms in responses]),
+    }
+
+
+def sample_users(data_snapshot, num_stub_users, n, seed):
+    """Users that are both in the snapshot and active on the stub wiki."""
+    rnd = random.Random(seed)
+    candidates = [
+        "User{0}".format(i)
+        for i in rnd.sample(range(num_stub_users), min(num_stub_users, 20 * n))
+    ]
+    users = [u for u in candidates if data_snapshot.user_id(u) is not None]
+    return users[:n]
+
+
+def run(args):
+    config = dict(DEFAULT_CONFIG)
+    if args.config:
+        with open(args.config) as fin:
+            config.update(yaml.safe_load(fin))
+    results = {
+        "meta": {
+            "started": time.strftime(snapshot.TIME_FORMAT, time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": {k: str(v) for k, v in vars(args).items()},
+        }
+    }
+    try:
+        results["meta"]["commit"] = (
+            subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL)
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        pass
+
+    resource_dir = str(args.resourcedir)
+    snapshot_dir = os.path.join(resource_dir, "snapshot")
+    if args.recompile or not os.path.exists(
+        os.path.join(snapshot_dir, snapshot.META_FILE)
+    ):
+        start = time.time()
+        build_stats = compile_snapshot.compile_snapshot(
+            resource_dir,
+            snapshot_dir + ".bench",
+            compile_snapshot.make_tuple(config["TEMPORAL_OFFSET"]),
+            most_recent_rev_ts=config["MOST_RECENT_REV_TS"],
+            earliest_ts=config["EARLIEST_TS"],
+        )
+        if os.path.exists(snapshot_dir):
+            os.rename(snapshot_dir, snapshot_dir + ".old")
+        os.rename(snapshot_dir + ".bench", snapshot_dir)
+        results["compile"] = {"seconds": time.time() - start, "stats": build_stats}
+
+    proc, url = start_stub(
+        args.stub_port,
+        args.latency_ms,
+        args.jitter_ms,
+        args.stub_users,
+        args.stub_revisions,
+        config["MOST_RECENT_REV_TS"],
+    )
+    try:
+        config["MEDIAWIKI_URL"] = url
+        rss_before = peak_rss_mb()
+        start = time.time()
+        wsgi.app.config.update(config)
+        logging.getLogger("wsgi").setLevel(config["LOG_LEVEL"])
+        wsgi.load_data(resource_dir)
+        data_snapshot = wsgi.WIKIS.dataset(wsgi.WIKIS.default).data.snapshot
+        results["load"] = {
+            "seconds": time.time() - start,
+            "num_users": data_snapshot.num_users,
+        }
+        results["rss_mb"] = {"before_load": rss_before, "after_load": peak_rss_mb()}
+
+        client = wsgi.app.test_client()
+        auth = base64.b64encode(
+            "{0}:{1}".format(
+                config["BASIC_AUTH_USERNAME"], config["BASIC_AUTH_PASSWORD"]
+            ).encode()
+        ).decode()
+        headers = {"Authorization": "Basic " + auth}
+        num_queried = args.queries * len(args.k)
+        num_stressed = args.stress_users if args.concurrency else 0
+        users = sample_users(
+            data_snapshot, args.stub_users, num_queried + num_stressed + args.async_users, args.seed
+        )
+        if len(users) < num_queried + num_stressed + args.async_users:
+            logger.warning("Only found %d users to query", len(users))
+        async_users = users[num_queried + num_stressed :]
+        stress_users = users[num_queried : num_queried + num_stressed]
+        users = users[:num_queried]
+
+        results["latency_ms"] = {"cold": {}, "warm": {}}
+        calls_before = stub_calls(url)
+        cold_calls = 0
+        errors = 0
+        for i, k in enumerate(args.k):
+            k_users = users[i * args.queries : (i + 1) * args.queries]
+            for phase, repeats in (("cold", 1), ("warm", args.warm_repeats)):
+                phase_calls_before = stub_calls(url)
+                latencies = []
+                for _ in range(repeats):
+                    for user_text in k_users:
+                        start = time.perf_counter()
+                        response = client.get(
+                            "/similarusers?usertext={0}&k={1}".format(user_text, k),
+                            headers=headers,
+                        )
+                        latencies.append((time.perf_counter() - start) * 1000)
+                        if response.status_code != 200 or "Error" in (
+                            response.get_json() or {}
+                        ):
+                            errors += 1
+                results["latency_ms"][phase]["k={0}".format(k)] = summarize(latencies)
+                if phase == "cold":
+                    cold_calls += stub_calls(url) - phase_calls_before
+        results["mw_api_calls"] = stub_calls(url) - calls_before
+        results["mw_api_calls_per_cold_query"] = cold_calls / len(users) if users else None
+        results["errors"] = errors
+        if args.concurrency and stress_users:
+            results["stress"] = stress(
+                wsgi.app,
+                headers,
+                stress_users,
+                args.concurrency,
+                url,
+                config["MOST_RECENT_REV_TS"],
+                results["mw_api_calls_per_cold_query"],
+            )
+        if async_users:
+            results["async"] = serve_async(headers, async_users)
+        results["rss_mb"]["peak"] = peak_rss_mb()
+    finally:
+        proc.terminate()
+        proc.wait()
+    return results
+
+
+def compare(old, new):
+    """Print new / old for every number the two runs have in common."""
+
+    def flatten(doc, prefix=""):
+        for key, value in doc.items():
+            if isinstance(value, dict):
+                for item in flatten(value, prefix + key + "."):
+                    yield item
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield prefix + key, value
+
+    old_values = dict(flatten({k: v for k, v in old.items() if k != "meta"}))
+    for key, value in flatten({k: v for k, v in new.items() if k != "meta"}):
+        if key in old_values:
+            ratio = value / old_values[key] if old_values[key] else float("nan")
+            print("{0:<40} {1:>12.2f} {2:>12.2f} {3:>8.2f}x".format(
+                key, old_values[key], value, ratio))
+
+
+def parse_args():
+    """Parse command line arguments."""
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark loading and /similarusers latency against a local MediaWiki API stand-in"
+    )
+    parser.add_argument(
+        "--resourcedir",
+        "-r",
+        action="store",
+        help="Directory with the TSVs (e.g. from generate_data.py) and/or snapshot.",
+        type=pathlib.Path,
+        required=True,
+    )
+    parser.add_argument(
+        "--config",
+        "-c",
+        action="store",
+        help="Service configuration to use instead of the built-in defaults.",
+        type=pathlib.Path,
+        default=None,
+    )
+    parser.add_argument(
+        "--recompile", action="store_true", help="Recompile the snapshot even if it exists."
+    )
+    parser.add_argument(
+        "--k", type=lambda s: [int(k) for k in s.split(",")], default=[5, 50, 250],
+        help="Comma-separated values of k to query with.",
+    )
+    parser.add_argument("--queries", type=int, default=50, help="Users queried per k.")
+    parser.add_argument("--warm-repeats", type=int, default=3)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--stub-port", type=int, default=8765)
+    parser.add_argument("--stub-users", type=int, default=2000)
+    parser.add_argument("--stub-revisions", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--concurrency", type=int, default=0,
+        help="Identical queries fired at once per user in the stress phase (0 to skip it).",
+    )
+    parser.add_argument("--stress-users", type=int, default=10, help="Users in the stress phase.")
+    parser.add_argument(
+        "--async-users", type=int, default=0,
+        help="Fresh users queried all at once through aioserver.py (0 to skip it).",
+    )
+    parser.add_argument(
+        "--output", "-o", type=pathlib.Path, default=None, help="Write results as JSON here."
+    )
+    parser.add_argument(
+        "--compare", type=pathlib.Path, default=None, help="Earlier results to compare to."
+    )
+    parser.add_argument(
+        "--verbose",
+        "-v",
+        dest="verbose",
+        action="store_true",
+        help="Verbose output.",
+        default=False,
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    results = run(args)
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, "w") as fout:
+            json.dump(results, fout, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fin:
+            compare(json.load(fin), results)
+    failures = results.get("stress", {}).get("failures")
+    if failures:
+        for failure in failures:
+            logger.error("Stress phase: %s", failure)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,484 @@
+#!/usr/bin/env python3
+"""Compile the monthly TSV exports into a snapshot the service can memory-map.
+
+Usage: python3 compile_snapshot.py -c flask_config.yaml -r resources
+
+The three TSVs are parsed in parallel (one process each), a chunk of lines at a
+time, with the numeric columns converted as arrays. The snapshot is written next
+to the TSVs (``resources/snapshot`` by default) along with per-file rows/sec so the
+duration of the monthly refresh can be tracked as the data grows.
+"""
+
+from ast import literal_eval as make_tuple
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import functools
+import json
+import logging
+import os
+import pathlib
+import time
+
+import numpy as np
+import yaml
+
+import snapshot
+import temporal_index
+from snapshot import (
+    FLAG_HAS_METADATA,
+    FLAG_IS_ANON,
+    NO_TIMESTAMP,
+    NUM_DAYS,
+    NUM_HOURS,
+    TEMPORAL_DIMS,
+    SnapshotError,
+)
+
+COEDIT_FILE = "coedit_counts.tsv"
+TEMPORAL_FILE = "temporal.tsv"
+METADATA_FILE = "metadata.tsv"
+
+COEDIT_HEADER = ["user_text", "user_neighbor", "num_pages_overlapped"]
+TEMPORAL_HEADER = ["user_text", "day_of_week", "hour_of_day", "num_edits"]
+METADATA_HEADER = [
+    "user_text",
+    "is_anon",
+    "num_edits",
+    "num_pages",
+    "most_recent_edit",
+    "oldest_edit",
+]
+
+# same values distutils.util.strtobool accepts
+TRUE_VALUES = ("y", "yes", "t", "true", "on", "1")
+FALSE_VALUES = ("n", "no", "f", "false", "off", "0")
+
+DEFAULT_CHUNK_BYTES = 64 << 20
+NORMS_CHUNK_ROWS = 1 << 20
+
+logger = logging.getLogger(__name__)
+
+
+class _Interner(object):
+    """Assign provisional ids to user names in order of first appearance."""
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def __call__(self, column):
+        ids = self.ids
+        names = self.names
+        out = np.empty(len(column), dtype=np.int64)
+        for i, user_text in enumerate(column):
+            uid = ids.get(user_text)
+            if uid is None:
+                uid = ids[user_text] = len(names)
+                names.append(user_text)
+            out[i] = uid
+        return out
+
+
+def read_chunks(path, expected_header, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """Yield the columns of a TSV as tuples of strings, roughly chunk_bytes at a time."""
+    with open(path, "r", encoding="utf-8") as fin:
+        header = next(fin).rstrip("\r\n").split("\t")
+        if header != expected_header:
+            raise SnapshotError(
+                "Unexpected header in {0}: {1} (expected {2})".format(
+                    path, header, expected_header
+                )
+            )
+        while True:
+            lines = fin.readlines(chunk_bytes)
+            if not lines:
+                break
+            rows = [line.rstrip("\r\n").split("\t") for line in lines if line.strip()]
+            for row in rows:
+                if len(row) != len(expected_header):
+                    raise SnapshotError(
+                        "Expected {0} columns in {1} but got {2}".format(
+                            len(expected_header), path, row
+                        )
+                    )
+            if rows:
+                yield list(zip(*rows))
+
+
+def _timed(parse):
+    """Run a parser and attach its row count and rows/sec to the result."""
+
+    @functools.wraps(parse)
+    def wrapper(path, *args):
+        start = time.time()
+        result = parse(path, *args)
+        elapsed = time.time() - start
+        result["stats"] = {
+            "file": os.path.basename(path),
+            "rows": result["rows"],
+            "seconds": round(elapsed, 3),
+            "rows_per_sec": round(result["rows"] / elapsed) if elapsed else None,
+        }
+        return result
+
+    return wrapper
+
+
+@_timed
+def parse_coedits(path, chunk_bytes):
+    intern = _Interner()
+    users, neighbors, overlaps = [], [], []
+    for columns in read_chunks(path, COEDIT_HEADER, chunk_bytes):
+        users.append(intern(columns[0]))
+        neighbors.append(intern(columns[1]))
+        overlaps.append(np.array(columns[2], dtype=np.int32))
+    overlap = _concat(overlaps, np.int32)
+    return {
+        "names": intern.names,
+        "users": _concat(users, np.int64),
+        "neighbors": _concat(neighbors, np.int64),
+        "overlap": overlap,
+        "rows": len(overlap),
+    }
+
+
+@_timed
+def parse_temporal(path, chunk_bytes, temporal_offset):
+    intern = _Interner()
+    users, days, hours, counts = [], [], [], []
+    for columns in read_chunks(path, TEMPORAL_HEADER, chunk_bytes):
+        users.append(intern(columns[0]))
+        days.append(np.array(columns[1], dtype=np.int64) - 1)  # 0 Sunday - 6 Saturday
+        hours.append(np.array(columns[2], dtype=np.int64))  # 0 - 23
+        counts.append(np.array(columns[3], dtype=np.int64))
+    users = _concat(users, np.int64)
+    days = _concat(days, np.int64)
+    hours = _concat(hours, np.int64)
+    counts = _concat(counts, np.int64)
+
+    # vectorized snapshot.smear_temporal over every row at once
+    num_users = len(intern.names)
+    temporal = np.zeros(num_users * TEMPORAL_DIMS, dtype=np.int64)
+    for offset in temporal_offset:
+        h = hours + offset
+        d = (days + (h // 24)) % NUM_DAYS
+        h = h % NUM_HOURS
+        temporal += np.bincount(
+            users * TEMPORAL_DIMS + d, weights=counts, minlength=len(temporal)
+        ).astype(np.int64)
+        temporal += np.bincount(
+            users * TEMPORAL_DIMS + NUM_DAYS + h, weights=counts, minlength=len(temporal)
+        ).astype(np.int64)
+    return {
+        "names": intern.names,
+        "temporal": temporal.reshape(num_users, TEMPORAL_DIMS).astype(np.int32),
+        "rows": len(users),
+    }
+
+
+@_timed
+def parse_metadata(path, chunk_bytes):
+    intern = _Interner()
+    users, flags, num_edits, num_pages, most_recent, oldest = [], [], [], [], [], []
+    for columns in read_chunks(path, METADATA_HEADER, chunk_bytes):
+        users.append(intern(columns[0]))
+        flags.append(FLAG_HAS_METADATA | (_parse_bools(columns[1]) * FLAG_IS_ANON))
+        num_edits.append(np.array(columns[2], dtype=np.int64))
+        num_pages.append(np.array(columns[3], dtype=np.int64))
+        most_recent.append(_parse_timestamps(columns[4]))
+        oldest.append(_parse_timestamps(columns[5]))
+    users = _concat(users, np.int64)
+    return {
+        "names": intern.names,
+        "users": users,
+        "flags": _concat(flags, np.uint8),
+        "num_edits": _concat(num_edits, np.int64),
+        "num_pages": _concat(num_pages, np.int64),
+        "most_recent_edit": _concat(most_recent, np.int64),
+        "oldest_edit": _concat(oldest, np.int64),
+        "rows": len(users),
+    }
+
+
+def _concat(chunks, dtype):
+    if not chunks:
+        return np.zeros(0, dtype=dtype)
+    return np.concatenate(chunks).astype(dtype, copy=False)
+
+
+def _parse_bools(column):
+    lowered = np.array([v.lower() for v in column])
+    is_true = np.isin(lowered, TRUE_VALUES)
+    unknown = ~(is_true | np.isin(lowered, FALSE_VALUES))
+    if unknown.any():
+        raise SnapshotError(
+            "Invalid truth value {0!r} in is_anon column".format(lowered[unknown][0])
+        )
+    return is_true.astype(np.uint8)
+
+
+def _parse_timestamps(column):
+    """Parse TIME_FORMAT strings to epoch seconds; empty or malformed become NO_TIMESTAMP."""
+    try:
+        parsed = np.array([ts.rstrip("Z") for ts in column], dtype="datetime64[s]")
+    except ValueError:
+        # something other than TIME_FORMAT in this chunk -- fall back to one at a time
+        return np.array(
+            [snapshot.timestamp_to_epoch(ts) for ts in column], dtype=np.int64
+        )
+    epochs = parsed.astype(np.int64)
+    epochs[np.isnat(parsed)] = NO_TIMESTAMP
+    return epochs
+
+
+def compile_snapshot(
+    resource_dir,
+    snapshot_dir,
+    temporal_offset,
+    most_recent_rev_ts=None,
+    earliest_ts=None,
+    workers=3,
+    chunk_bytes=DEFAULT_CHUNK_BYTES,
+):
+    """Compile the three TSVs in resource_dir into a snapshot at snapshot_dir."""
+    start = time.time()
+    temporal_offset = tuple(temporal_offset)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        coedit_future = pool.submit(
+            parse_coedits, os.path.join(resource_dir, COEDIT_FILE), chunk_bytes
+        )
+        temporal_future = pool.submit(
+            parse_temporal,
+            os.path.join(resource_dir, TEMPORAL_FILE),
+            chunk_bytes,
+            temporal_offset,
+        )
+        metadata_future = pool.submit(
+            parse_metadata, os.path.join(resource_dir, METADATA_FILE), chunk_bytes
+        )
+        coedits = coedit_future.result()
+        temporal = temporal_future.result()
+        metadata = metadata_future.result()
+    for parsed in (coedits, temporal, metadata):
+        logger.info(
+            "Parsed %(rows)d rows from %(file)s in %(seconds).1fs (%(rows_per_sec)s rows/sec)",
+            parsed["stats"],
+        )
+
+    # final ids are positions in the byte-sorted name table so lookups can bisect
+    names = set(coedits["names"])
+    names.update(temporal["names"])
+    names.update(metadata["names"])
+    sorted_names = sorted(n.encode("utf-8") for n in names)
+    num_users = len(sorted_names)
+    global_ids = {n.decode("utf-8"): i for i, n in enumerate(sorted_names)}
+
+    def remap(local_names):
+        return np.array([global_ids[n] for n in local_names], dtype=np.int64)
+
+    arrays = _name_arrays(sorted_names)
+    del names
+
+    temporal_arrays = np.zeros((num_users, TEMPORAL_DIMS), dtype=np.int32)
+    temporal_arrays[remap(temporal["names"])] = temporal["temporal"]
+    arrays["temporal"] = temporal_arrays
+    arrays["temporal_norms"] = np.zeros((num_users, 2), dtype=np.float64)
+    for i in range(0, num_users, NORMS_CHUNK_ROWS):
+        arrays["temporal_norms"][i : i + NORMS_CHUNK_ROWS] = snapshot.temporal_norms(
+            temporal_arrays[i : i + NORMS_CHUNK_ROWS]
+        )
+
+    arrays.update(_metadata_arrays(remap(metadata["names"]), metadata, num_users))
+
+    coedit_remap = remap(coedits["names"])
+    arrays.update(
+        _coedit_arrays(
+            coedit_remap[coedits["users"]],
+            coedit_remap[coedits["neighbors"]],
+            coedits["overlap"],
+            arrays["meta_num_pages"],
+        )
+    )
+    arrays.update(
+        snapshot.reverse_index(
+            arrays["coedit_indptr"], arrays["coedit_neighbors"], arrays["coedit_overlap"]
+        )
+    )
+    arrays.update(temporal_index.build(arrays["temporal"], arrays["temporal_norms"]))
+
+    elapsed = time.time() - start
+    total_rows = coedits["rows"] + temporal["rows"] + metadata["rows"]
+    build_stats = {
+        "files": [coedits["stats"], temporal["stats"], metadata["stats"]],
+        "rows": total_rows,
+        "seconds": round(elapsed, 3),
+        "rows_per_sec": round(total_rows / elapsed) if elapsed else None,
+    }
+    snapshot.write_snapshot(
+        snapshot_dir,
+        arrays,
+        {
+            "temporal_offset": list(temporal_offset),
+            "num_coedits": int(coedits["rows"]),
+            "most_recent_rev_ts": most_recent_rev_ts,
+            "earliest_ts": earliest_ts,
+            "sources": {
+                name: os.path.getsize(os.path.join(resource_dir, name))
+                for name in (COEDIT_FILE, TEMPORAL_FILE, METADATA_FILE)
+            },
+            "build_stats": build_stats,
+        },
+    )
+    logger.info(
+        "Built snapshot of %d users at %s: %d rows in %.1fs (%s rows/sec)",
+        num_users,
+        snapshot_dir,
+        total_rows,
+        elapsed,
+        build_stats["rows_per_sec"],
+    )
+    return build_stats
+
+
+def _name_arrays(sorted_names):
+    offsets = np.zeros(len(sorted_names) + 1, dtype=np.int64)
+    np.cumsum([len(n) for n in sorted_names], out=offsets[1:])
+    blob = np.frombuffer(b"".join(sorted_names), dtype=np.uint8)
+    return {"names_offsets": offsets, "names_blob": blob}
+
+
+def _metadata_arrays(rows, metadata, num_users):
+    arrays = {
+        "meta_flags": np.zeros(num_users, dtype=np.uint8),
+        "meta_num_edits": np.zeros(num_users, dtype=np.int64),
+        "meta_num_pages": np.zeros(num_users, dtype=np.int64),
+        "meta_most_recent_edit": np.full(num_users, NO_TIMESTAMP, dtype=np.int64),
+        "meta_oldest_edit": np.full(num_users, NO_TIMESTAMP, dtype=np.int64),
+    }
+    # local ids follow first appearance, so metadata["users"][i] is the local id of row i
+    rows = rows[metadata["users"]]
+    arrays["meta_flags"][rows] = metadata["flags"]
+    arrays["meta_num_edits"][rows] = metadata["num_edits"]
+    arrays["meta_num_pages"][rows] = metadata["num_pages"]
+    arrays["meta_most_recent_edit"][rows] = metadata["most_recent_edit"]
+    arrays["meta_oldest_edit"][rows] = metadata["oldest_edit"]
+    return arrays
+
+
+def _coedit_arrays(users, neighbors, overlap, num_pages):
+    """CSR arrays with each user's neighbors ranked the way update_coedit_data ranks them.
+
+    That is by overlap and then by fewest pages edited, keeping dump order for ties.
+    """
+    num_users = len(num_pages)
+    order = np.lexsort(
+        (np.arange(len(users)), num_pages[neighbors], -overlap.astype(np.int64), users)
+    )
+    indptr = np.zeros(num_users + 1, dtype=np.int64)
+    np.cumsum(np.bincount(users, minlength=num_users), out=indptr[1:])
+    return {
+        "coedit_indptr": indptr,
+        "coedit_neighbors": neighbors[order].astype(np.int32),
+        "coedit_overlap": overlap[order].astype(np.int32),
+    }
+
+
+def parse_args():
+    """Parse command line arguments."""
+
+    parser = argparse.ArgumentParser(
+        description="Compile the co-edit, temporal and metadata TSVs into a snapshot"
+    )
+    parser.add_argument(
+        "--config",
+        "-c",
+        action="store",
+        help="Path to the service configuration file (for TEMPORAL_OFFSET etc.).",
+        type=pathlib.Path,
+        default=os.path.join(os.path.dirname(__file__), "flask_config.yaml"),
+    )
+    parser.add_argument(
+        "--resourcedir",
+        "-r",
+        action="store",
+        help="Directory containing the TSV files.",
+        type=pathlib.Path,
+        default=os.path.join(os.path.dirname(__file__), "resources"),
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        action="store",
+        help="Snapshot directory to write (default: <resourcedir>/snapshot).",
+        type=pathlib.Path,
+        default=None,
+    )
+    parser.add_argument(
+        "--most-recent-rev-ts",
+        action="store",
+        help="Last revision covered by the TSVs (default: MOST_RECENT_REV_TS from the config).",
+        default=None,
+    )
+    parser.add_argument(
+        "--earliest-ts",
+        action="store",
+        help="First revision covered by the TSVs (default: EARLIEST_TS from the config).",
+        default=None,
+    )
+    parser.add_argument(
+        "--workers",
+        action="store",
+        help="Number of files to parse in parallel.",
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        "--chunk-mb",
+        action="store",
+        help="Approximate size of each chunk of lines read at once, in MB.",
+        type=int,
+        default=DEFAULT_CHUNK_BYTES >> 20,
+    )
+    parser.add_argument(
+        "--stats",
+        action="store",
+        help="Also write the rows/sec report as JSON to this path.",
+        type=pathlib.Path,
+        default=None,
+    )
+    parser.add_argument(
+        "--verbose",
+        "-v",
+        dest="verbose",
+        action="store_true",
+        help="Verbose output.",
+        default=False,
+    )
+    return parser.parse_args()
+
+
+def main():
+
+    args = parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    config_yaml = yaml.safe_load(open(args.config))
+
+    output = args.output or os.path.join(args.resourcedir, "snapshot")
+    if os.path.exists(output):
+        raise SystemExit("{0} already exists -- remove it or choose --output".format(output))
+    build_stats = compile_snapshot(
+        args.resourcedir,
+        output,
+        make_tuple(config_yaml["TEMPORAL_OFFSET"]),
+        most_recent_rev_ts=args.most_recent_rev_ts or config_yaml.get("MOST_RECENT_REV_TS"),
+        earliest_ts=args.earliest_ts or config_yaml.get("EARLIEST_TS"),
+        workers=args.workers,
+        chunk_bytes=args.chunk_mb << 20,
+    )
+    if args.stats:
+        with open(args.stats, "w") as fout:
+            json.dump(build_stats, fout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -60,7 +60,7 @@ chown -R www-data:www-data ${LIB_PATH}
 
 echo "Copying configuration files..."
 cp ${TMP_PATH}/${REPO_LBL}/model/config/* ${ETC_PATH}
-cp ${TMP_PATH}/${REPO_LBL}/model/wsgi.py ${ETC_PATH}
+cp ${TMP_PATH}/${REPO_LBL}/model/*.py ${ETC_PATH}
 cp ${TMP_PATH}/${REPO_LBL}/model/flask_config.yaml ${ETC_PATH}
 chmod 400 ${ETC_PATH}/flask_config.yaml
 cp ${ETC_PATH}/model.nginx /etc/nginx/sites-available/model
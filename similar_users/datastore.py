@@ -0,0 +1,1452 @@
+"""Read/write access to user data: the read-only snapshot plus what has been learned since.
+
+The snapshot holds the monthly dumps. Everything the service learns afterwards
+(new edits, new users, new co-edit overlaps) is kept in an overlay of *deltas*
+on top of it, so reads merge the two and the snapshot is never copied.
+
+The overlay lives either in the process (MemoryOverlay) or in a SQLite database
+on local disk (SqliteOverlay) that every uWSGI worker shares and that survives
+restarts.
+
+A MemoryOverlay can be given a byte budget: past it, the users who are not in
+the snapshot (whom the service added itself, see check_user_text in wsgi.py)
+are forgotten, least recently used first. Both overlays report the bytes held
+by each of their structures and sample the total over time (GrowthHistory).
+"""
+
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+import heapq
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import numpy as np
+
+from snapshot import (
+    FLAG_HAS_METADATA,
+    FLAG_IS_ANON,
+    NO_TIMESTAMP,
+    TEMPORAL_DIMS,
+    temporal_norms,
+    timestamp_to_epoch,
+)
+import temporal_index
+
+NEIGHBOR_LIMIT = 250
+# MemoryOverlay updates of a user are serialized by one of this many locks (picked by the user's hash)
+NUM_USER_LOCKS = 64
+# what the overlays hold, as reported by byte_sizes (listed_by is the reverse of coedits)
+OVERLAY_STRUCTURES = (
+    "users",
+    "temporal",
+    "coedits",
+    "listed_by",
+    "pending_pages",
+    "edit_cursors",
+    "counted_pages",
+)
+# a user's entry in a neighbor's listed_by dict: hash, key and value pointers in a table ~2/3 full
+LISTED_BY_ENTRY_BYTES = 48
+HISTORY_INTERVAL = 300  # seconds between samples of an overlay's size
+HISTORY_SAMPLES = 2016  # samples kept (a week's worth)
+
+# uid is the neighbor's position in the snapshot (None if they are not in it) and
+# num_pages the # of pages they edited (None if there is no metadata for them)
+Neighbor = namedtuple("Neighbor", ["user_text", "overlap", "uid", "num_pages"])
+# a user who lists another among their neighbors, and the other's rank (0 = first) in their list
+ListedBy = namedtuple("ListedBy", ["user_text", "overlap", "uid", "num_pages", "rank"])
+# similarity is the mean of the day and hour cosine similarities (see temporal_index.py)
+TemporalMatch = namedtuple("TemporalMatch", ["user_text", "uid", "similarity"])
+# a user's whole neighbor list as parallel arrays (see UserStore.neighbor_arrays)
+NeighborArrays = namedtuple(
+    "NeighborArrays", ["uids", "overlaps", "num_pages", "counts", "norms", "names"]
+)
+
+
+class GrowthHistory(object):
+    """Samples of an overlay's total bytes, at most one every `interval` seconds, the last `max_samples` kept."""
+
+    def __init__(self, interval=HISTORY_INTERVAL, max_samples=HISTORY_SAMPLES):
+        self.interval = interval
+        self._samples = deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+
+    def sample(self, nbytes, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            if not self._samples or now - self._samples[-1][0] >= self.interval:
+                self._samples.append((now, nbytes))
+
+    def samples(self):
+        """[(epoch seconds, bytes)], oldest first."""
+        with self._lock:
+            return list(self._samples)
+
+    def growth_per_hour(self):
+        """Bytes gained per hour between the first and last samples (None before there are two)."""
+        samples = self.samples()
+        if len(samples) < 2 or samples[-1][0] <= samples[0][0]:
+            return None
+        (start, first), (end, last) = samples[0], samples[-1]
+        return (last - first) * 3600.0 / (end - start)
+
+
+class MemoryOverlay(object):
+    """Deltas learned since the snapshot, held in this process.
+
+    Updates take a per-user lock (one of NUM_USER_LOCKS, so updates of different
+    users rarely wait for each other), and reads return copies, so threads can
+    update and read the same user at once.
+
+    The bytes held for each user are tallied as they are updated (see _nbytes).
+    With max_bytes set, once the total goes over it the users who are not in
+    the snapshot are evicted, least recently read or updated first: all that
+    was learned about them goes (their own entries, not other users' coedits
+    with them), and they are checked and fetched afresh if queried again.
+    Users of the snapshot are never evicted, since the dumps hold nothing of
+    what they have done since.
+    """
+
+    def __init__(self, snapshot_id=None, max_bytes=0, history=None):
+        self.snapshot_id = snapshot_id
+        self.max_bytes = max_bytes  # 0 for no limit
+        self.evicted_users = 0
+        self.history = GrowthHistory() if history is None else history
+        # user_text -> {"is_anon", "num_edits", "num_pages", "most_recent_edit", "oldest_edit"}
+        # is_anon is only set for users that are not in the snapshot; counts are increments
+        self._users = {}
+        self._temporal = {}  # user_text -> [TEMPORAL_DIMS] increments
+        self._coedits = {}  # user_text -> {neighbor: additional pages overlapped}
+        self._listed_by = {}  # neighbor -> {user_text: additional pages overlapped}
+        self._pending_pages = {}  # user_text -> page ids still to be fetched
+        self._edit_cursors = {}  # user_text -> where the listing of their new edits resumes
+        self._counted_pages = {}  # user_text -> page ids already added to their num_pages
+        self._ingest_state = None  # where ingest.py has got to (see UserStore.ingest_state)
+        self._locks = [threading.Lock() for _ in range(NUM_USER_LOCKS)]
+        # guards the _listed_by dicts being created and dropped (their entries are per user)
+        self._listed_by_lock = threading.Lock()
+        self._footprints = {}  # user_text -> {structure: bytes held for them}
+        self._bytes = dict.fromkeys(OVERLAY_STRUCTURES, 0)  # sums of the footprints
+        self._recency = OrderedDict()  # users who can be evicted, least recently used first
+        self._accounting_lock = threading.Lock()
+
+    def _lock(self, user_text):
+        return self._locks[hash(user_text) % NUM_USER_LOCKS]
+
+    # (copying a dict or list is atomic in CPython, so reads need no lock -- as long as each
+    # user is looked up once, since they can be evicted by another thread in between)
+
+    def get_user(self, user_text):
+        self._touch(user_text)
+        return _copy(self._users.get(user_text))
+
+    def get_user_many(self, user_texts):
+        found = {}
+        for u in user_texts:
+            delta = self._users.get(u)
+            if delta is not None:
+                found[u] = dict(delta)
+        return found
+
+    def get_temporal(self, user_text):
+        return _copy(self._temporal.get(user_text))
+
+    def get_temporal_many(self, user_texts):
+        found = {}
+        for u in user_texts:
+            counts = self._temporal.get(u)
+            if counts is not None:
+                found[u] = list(counts)
+        return found
+
+    def get_coedits(self, user_text):
+        self._touch(user_text)
+        return _copy(self._coedits.get(user_text))
+
+    def get_listed_by(self, user_text):
+        return dict(self._listed_by.get(user_text, {}))
+
+    def coedit_users(self, user_texts):
+        """Those of user_texts who have coedit deltas."""
+        return set(u for u in user_texts if u in self._coedits)
+
+    def changed_users(self):
+        """Users whose metadata or temporal data has deltas."""
+        return set(self._users) | set(self._temporal)
+
+    def get_pending_pages(self, user_text):
+        return self._pending_pages.get(user_text, [])
+
+    def set_pending_pages(self, user_text, pageids):
+        with self._lock(user_text):
+            if pageids:
+                self._pending_pages[user_text] = list(pageids)
+            else:
+                self._pending_pages.pop(user_text, None)
+            self._account(user_text, ("pending_pages",))
+        self._enforce_budget(user_text)
+
+    def get_edit_cursor(self, user_text):
+        return self._edit_cursors.get(user_text)
+
+    def record_edit_batch(
+        self,
+        user_text,
+        cursor,
+        next_cursor,
+        num_edits,
+        pageids,
+        oldest_edit,
+        most_recent_edit,
+        temporal,
+    ):
+        with self._lock(user_text):
+            if self._edit_cursors.get(user_text) != cursor:
+                return False
+            counted = self._counted_pages.setdefault(user_text, set())
+            new_pages = set(pageids) - counted
+            counted.update(new_pages)
+            self._record_edits(
+                user_text, num_edits, len(new_pages), oldest_edit, most_recent_edit, temporal
+            )
+            self._edit_cursors[user_text] = next_cursor
+            self._account(user_text, ("users", "temporal", "edit_cursors", "counted_pages"))
+        self._enforce_budget(user_text)
+        return True
+
+    def get_ingest_state(self):
+        return _copy(self._ingest_state)
+
+    def record_ingested(self, batches, coedits, state):
+        conflicts = [u for u, batch in batches.items() if not self.record_edit_batch(u, **batch)]
+        for user_text, overlaps in coedits.items():
+            if user_text not in conflicts:
+                self.add_coedits(user_text, overlaps)
+        self._ingest_state = dict(state)
+        return conflicts
+
+    def add_user(self, user_text, is_anon):
+        with self._lock(user_text):
+            delta = self._users.setdefault(user_text, _empty_user_delta(is_anon))
+            if delta["is_anon"] is None:
+                delta["is_anon"] = is_anon
+            self._account(user_text, ("users",))
+        self._enforce_budget(user_text)
+
+    def record_edits(
+        self, user_text, num_edits, num_pages, oldest_edit, most_recent_edit, temporal
+    ):
+        with self._lock(user_text):
+            self._record_edits(
+                user_text, num_edits, num_pages, oldest_edit, most_recent_edit, temporal
+            )
+            self._account(user_text, ("users", "temporal"))
+        self._enforce_budget(user_text)
+
+    def _record_edits(
+        self, user_text, num_edits, num_pages, oldest_edit, most_recent_edit, temporal
+    ):
+        delta = self._users.setdefault(user_text, _empty_user_delta(None))
+        _merge_user_delta(delta, num_edits, num_pages, oldest_edit, most_recent_edit)
+        counts = self._temporal.setdefault(user_text, [0] * TEMPORAL_DIMS)
+        for i, n in enumerate(temporal):
+            counts[i] += n
+
+    def add_coedits(self, user_text, overlaps):
+        with self._lock(user_text):
+            coedits = self._coedits.setdefault(user_text, {})
+            for neighbor, num_pages in overlaps.items():
+                coedits[neighbor] = coedits.get(neighbor, 0) + num_pages
+            with self._listed_by_lock:
+                for neighbor in overlaps:
+                    # only user_text's entry of the neighbor's dict is written, under user_text's lock
+                    listed_by = self._listed_by.setdefault(neighbor, {})
+                    listed_by[user_text] = coedits[neighbor]
+            self._account(user_text, ("coedits", "listed_by"))
+        self._enforce_budget(user_text)
+
+    def _account(self, user_text, structures):
+        """Tally the bytes now held for user_text in `structures` (under user_text's lock)."""
+        sizes = {}
+        for structure in structures:
+            if structure == "listed_by":
+                sizes[structure] = LISTED_BY_ENTRY_BYTES * len(self._coedits.get(user_text, ()))
+            else:
+                held = getattr(self, "_" + structure).get(user_text)
+                sizes[structure] = 0 if held is None else _nbytes(held)
+        delta = self._users.get(user_text)
+        with self._accounting_lock:
+            footprint = self._footprints.setdefault(user_text, {})
+            for structure, nbytes in sizes.items():
+                self._bytes[structure] += nbytes - footprint.get(structure, 0)
+                footprint[structure] = nbytes
+            # users of the snapshot have deltas with is_anon unset (see _empty_user_delta)
+            if delta is None or delta["is_anon"] is not None:
+                self._recency[user_text] = True
+                self._recency.move_to_end(user_text)
+            else:
+                self._recency.pop(user_text, None)
+
+    def _touch(self, user_text):
+        with self._accounting_lock:
+            if user_text in self._recency:
+                self._recency.move_to_end(user_text)
+
+    def _enforce_budget(self, keep):
+        """Sample the total bytes, and evict users until it is within max_bytes (keeping `keep`)."""
+        total = self.total_bytes()
+        self.history.sample(total)
+        while self.max_bytes and total > self.max_bytes:
+            with self._accounting_lock:
+                victim = next(iter(self._recency), None)
+            if victim is None or victim == keep:
+                # what's left can't be evicted (or is the user being updated)
+                return
+            with self._lock(victim):
+                self._evict(victim)
+            total = self.total_bytes()
+
+    def _evict(self, user_text):
+        """Forget everything held for user_text (under their lock)."""
+        for held in (
+            self._users,
+            self._temporal,
+            self._pending_pages,
+            self._edit_cursors,
+            self._counted_pages,
+        ):
+            held.pop(user_text, None)
+        coedits = self._coedits.pop(user_text, {})
+        with self._listed_by_lock:
+            for neighbor in coedits:
+                listed_by = self._listed_by.get(neighbor)
+                if listed_by is not None:
+                    listed_by.pop(user_text, None)
+                    if not listed_by:
+                        del self._listed_by[neighbor]
+        with self._accounting_lock:
+            for structure, nbytes in self._footprints.pop(user_text, {}).items():
+                self._bytes[structure] -= nbytes
+            if self._recency.pop(user_text, None) is not None:
+                self.evicted_users += 1
+
+    def rebase(self, snapshot_id, most_recent_rev_ts):
+        """Overlay for the snapshot snapshot_id, keeping only what it does not already cover.
+
+        Returns a new overlay (requests still on the old snapshot keep this one)
+        holding the users whose new edits all came after ``most_recent_rev_ts``.
+        """
+        if self.snapshot_id in (None, snapshot_id):
+            self.snapshot_id = snapshot_id
+            return self
+        rebased = MemoryOverlay(snapshot_id, self.max_bytes, self.history)
+        rebased.evicted_users = self.evicted_users
+        rebased._ingest_state = self._ingest_state
+        for user_text in list(self._users):
+            with self._lock(user_text):
+                # (evicted since the list was taken, or not)
+                delta = self._users.get(user_text)
+                if delta is None or not _after_snapshot(delta, most_recent_rev_ts):
+                    continue
+                rebased._users[user_text] = dict(delta)
+                counts = self._temporal.get(user_text)
+                if counts is not None:
+                    rebased._temporal[user_text] = list(counts)
+                coedits = self._coedits.get(user_text)
+                if coedits is not None:
+                    rebased.add_coedits(user_text, dict(coedits))
+                pending = self._pending_pages.get(user_text)
+                if pending is not None:
+                    rebased._pending_pages[user_text] = list(pending)
+                cursor = self._edit_cursors.get(user_text)
+                if cursor is not None:
+                    rebased._edit_cursors[user_text] = cursor
+                    rebased._counted_pages[user_text] = set(
+                        self._counted_pages.get(user_text, ())
+                    )
+                with rebased._lock(user_text):
+                    rebased._account(user_text, OVERLAY_STRUCTURES)
+        # keep the least recently used order
+        with self._accounting_lock:
+            recency = list(self._recency)
+        for user_text in recency:
+            if user_text in rebased._recency:
+                rebased._recency.move_to_end(user_text)
+        return rebased
+
+    def sizes(self, max_age=None):
+        """# of entries held for each kind of data (one per user, or per user and neighbor/page).
+
+        (Counted afresh each time; max_age is for SqliteOverlay's sake.)
+        """
+        return {
+            "users": len(self._users),
+            "temporal": len(self._temporal),
+            "coedits": sum(len(c) for c in list(self._coedits.values())),
+            "pending_pages": sum(len(p) for p in list(self._pending_pages.values())),
+            "edit_cursors": len(self._edit_cursors),
+            "counted_pages": sum(len(p) for p in list(self._counted_pages.values())),
+        }
+
+    def byte_sizes(self, max_age=None):
+        """Approximate bytes held in each of the OVERLAY_STRUCTURES (see _nbytes)."""
+        sizes = self._byte_sizes()
+        self.history.sample(sum(sizes.values()))
+        return sizes
+
+    def total_bytes(self):
+        return sum(self._byte_sizes().values())
+
+    def _byte_sizes(self):
+        with self._accounting_lock:
+            sizes = dict(self._bytes)
+        # the dicts of all users, and the listed_by dict of each neighbor
+        for structure in OVERLAY_STRUCTURES:
+            sizes[structure] += sys.getsizeof(getattr(self, "_" + structure))
+        sizes["listed_by"] += len(self._listed_by) * sys.getsizeof({})
+        return sizes
+
+
+SQLITE_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS users (
+        user_text TEXT PRIMARY KEY,
+        is_anon INTEGER,
+        num_edits INTEGER NOT NULL DEFAULT 0,
+        num_pages INTEGER NOT NULL DEFAULT 0,
+        most_recent_edit TEXT,
+        oldest_edit TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS temporal (
+        user_text TEXT NOT NULL,
+        slot INTEGER NOT NULL,
+        num_edits INTEGER NOT NULL,
+        PRIMARY KEY (user_text, slot)
+    ) WITHOUT ROWID""",
+    # rowid keeps each user's neighbors in the order they were first seen
+    """CREATE TABLE IF NOT EXISTS coedits (
+        user_text TEXT NOT NULL,
+        neighbor TEXT NOT NULL,
+        num_pages INTEGER NOT NULL,
+        UNIQUE (user_text, neighbor)
+    )""",
+    """CREATE TABLE IF NOT EXISTS pending_pages (
+        user_text TEXT NOT NULL,
+        pageid INTEGER NOT NULL,
+        PRIMARY KEY (user_text, pageid)
+    ) WITHOUT ROWID""",
+    # cursor: JSON of where the listing of the user's new edits resumes (see UserStore.edit_cursor)
+    """CREATE TABLE IF NOT EXISTS edit_cursors (
+        user_text TEXT PRIMARY KEY,
+        cursor TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS counted_pages (
+        user_text TEXT NOT NULL,
+        pageid INTEGER NOT NULL,
+        PRIMARY KEY (user_text, pageid)
+    ) WITHOUT ROWID""",
+    # for looking up who lists a user (see UserStore.listed_by)
+    "CREATE INDEX IF NOT EXISTS coedits_neighbor ON coedits (neighbor)",
+    # "snapshot": id of the snapshot the deltas are relative to; "ingest": JSON of ingest.py's progress
+    """CREATE TABLE IF NOT EXISTS overlay_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )""",
+)
+
+# stay under SQLite's default limit of 999 bound parameters per statement
+SQLITE_MAX_PARAMS = 900
+# counting the SQLite overlay's rows and pages reads the whole database, so the counts are reused
+SQLITE_SIZES_MAX_AGE = 300  # seconds
+
+
+class SqliteOverlay(object):
+    """Deltas learned since the snapshot, shared by all worker processes through SQLite.
+
+    Every write is a single transaction of increments (upserts), so workers
+    updating the same user add to each other's changes instead of overwriting
+    them. Connections are opened per thread and per process, so the overlay can
+    be created before uWSGI forks. Once the database has been moved onto a newer
+    snapshot (see rebase), writes through an overlay bound to an older one are
+    dropped, since they would be relative to the wrong snapshot.
+
+    It is on disk, so it has no memory budget (max_bytes is always 0) and
+    nothing is evicted.
+    """
+
+    max_bytes = 0
+    evicted_users = 0
+
+    def __init__(self, path, timeout=30, snapshot_id=None, history=None):
+        self.path = path
+        self.timeout = timeout
+        self.snapshot_id = snapshot_id
+        self.history = GrowthHistory() if history is None else history
+        self._local = threading.local()
+        self._counted = {}  # "sizes"/"byte_sizes" -> (epoch seconds, result)
+        self._counted_lock = threading.Lock()
+        with self._transaction() as conn:
+            for statement in SQLITE_SCHEMA:
+                conn.execute(statement)
+
+    def _conn(self):
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            # readers don't block the writer (and vice versa) in WAL mode
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            local.conn = conn
+            local.pid = os.getpid()
+        return local.conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        # take the write lock up front so concurrent writers wait instead of deadlocking
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @contextmanager
+    def _write(self):
+        """Transaction for an update, or None if the database has moved on to another snapshot."""
+        with self._transaction() as conn:
+            if self.snapshot_id is not None and self.snapshot_id != _recorded_snapshot(conn):
+                yield None
+            else:
+                yield conn
+
+    def _select_in(self, query, user_texts):
+        """Rows of `query` with its `{0}` replaced by placeholders for user_texts, in batches."""
+        user_texts = list(dict.fromkeys(user_texts))
+        conn = self._conn()
+        for i in range(0, len(user_texts), SQLITE_MAX_PARAMS):
+            batch = user_texts[i : i + SQLITE_MAX_PARAMS]
+            for row in conn.execute(query.format(",".join("?" * len(batch))), batch):
+                yield row
+
+    def get_user(self, user_text):
+        return self.get_user_many([user_text]).get(user_text)
+
+    def get_user_many(self, user_texts):
+        users = {}
+        for row in self._select_in(
+            "SELECT user_text, is_anon, num_edits, num_pages, most_recent_edit, oldest_edit "
+            "FROM users WHERE user_text IN ({0})",
+            user_texts,
+        ):
+            users[row[0]] = {
+                "is_anon": None if row[1] is None else bool(row[1]),
+                "num_edits": row[2],
+                "num_pages": row[3],
+                "most_recent_edit": row[4],
+                "oldest_edit": row[5],
+            }
+        return users
+
+    def get_temporal(self, user_text):
+        return self.get_temporal_many([user_text]).get(user_text)
+
+    def get_temporal_many(self, user_texts):
+        temporal = {}
+        for user_text, slot, num_edits in self._select_in(
+            "SELECT user_text, slot, num_edits FROM temporal WHERE user_text IN ({0})",
+            user_texts,
+        ):
+            temporal.setdefault(user_text, [0] * TEMPORAL_DIMS)[slot] = num_edits
+        return temporal
+
+    def get_coedits(self, user_text):
+        rows = self._conn().execute(
+            "SELECT neighbor, num_pages FROM coedits WHERE user_text = ? ORDER BY rowid",
+            (user_text,),
+        )
+        return dict(rows.fetchall())
+
+    def get_listed_by(self, user_text):
+        rows = self._conn().execute(
+            "SELECT user_text, num_pages FROM coedits WHERE neighbor = ?", (user_text,)
+        )
+        return dict(rows.fetchall())
+
+    def coedit_users(self, user_texts):
+        return set(
+            row[0]
+            for row in self._select_in(
+                "SELECT DISTINCT user_text FROM coedits WHERE user_text IN ({0})", user_texts
+            )
+        )
+
+    def changed_users(self):
+        rows = self._conn().execute(
+            "SELECT user_text FROM users UNION SELECT DISTINCT user_text FROM temporal"
+        )
+        return set(row[0] for row in rows)
+
+    def get_pending_pages(self, user_text):
+        rows = self._conn().execute(
+            "SELECT pageid FROM pending_pages WHERE user_text = ?", (user_text,)
+        )
+        return [row[0] for row in rows]
+
+    def set_pending_pages(self, user_text, pageids):
+        with self._write() as conn:
+            if conn is None:
+                return
+            conn.execute("DELETE FROM pending_pages WHERE user_text = ?", (user_text,))
+            conn.executemany(
+                "INSERT OR IGNORE INTO pending_pages (user_text, pageid) VALUES (?, ?)",
+                [(user_text, pid) for pid in pageids],
+            )
+
+    def get_edit_cursor(self, user_text):
+        row = self._conn().execute(
+            "SELECT cursor FROM edit_cursors WHERE user_text = ?", (user_text,)
+        ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def record_edit_batch(
+        self,
+        user_text,
+        cursor,
+        next_cursor,
+        num_edits,
+        pageids,
+        oldest_edit,
+        most_recent_edit,
+        temporal,
+    ):
+        with self._write() as conn:
+            if conn is None:
+                return False
+            return _record_edit_batch(
+                conn,
+                user_text,
+                cursor,
+                next_cursor,
+                num_edits,
+                pageids,
+                oldest_edit,
+                most_recent_edit,
+                temporal,
+            )
+
+    def get_ingest_state(self):
+        row = self._conn().execute(
+            "SELECT value FROM overlay_meta WHERE key = 'ingest'"
+        ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def record_ingested(self, batches, coedits, state):
+        # all in one transaction, so readers see a batch whole and a crash loses it whole
+        with self._write() as conn:
+            if conn is None:
+                return list(batches)
+            conflicts = [
+                u for u, batch in batches.items() if not _record_edit_batch(conn, u, **batch)
+            ]
+            for user_text, overlaps in coedits.items():
+                if user_text not in conflicts:
+                    _add_coedits(conn, user_text, overlaps)
+            conn.execute(
+                "INSERT OR REPLACE INTO overlay_meta (key, value) VALUES ('ingest', ?)",
+                (json.dumps(state, sort_keys=True),),
+            )
+            return conflicts
+
+    def add_user(self, user_text, is_anon):
+        with self._write() as conn:
+            if conn is None:
+                return
+            conn.execute(
+                "INSERT INTO users (user_text, is_anon) VALUES (?, ?) "
+                "ON CONFLICT (user_text) DO UPDATE SET "
+                "is_anon = COALESCE(is_anon, excluded.is_anon)",
+                (user_text, int(is_anon)),
+            )
+
+    def record_edits(
+        self, user_text, num_edits, num_pages, oldest_edit, most_recent_edit, temporal
+    ):
+        with self._write() as conn:
+            if conn is None:
+                return
+            _record_edits(
+                conn, user_text, num_edits, num_pages, oldest_edit, most_recent_edit, temporal
+            )
+
+    def add_coedits(self, user_text, overlaps):
+        with self._write() as conn:
+            if conn is None:
+                return
+            _add_coedits(conn, user_text, overlaps)
+
+    def rebase(self, snapshot_id, most_recent_rev_ts):
+        """Move the database onto the snapshot snapshot_id, keeping only what it does not already cover.
+
+        The users whose new edits all came after ``most_recent_rev_ts`` are kept and
+        the rest are dropped (they are fetched again from the new snapshot's last
+        edit). Only the first worker to get here prunes; a database that has no
+        snapshot recorded yet is assumed to be relative to this one.
+        """
+        with self._transaction() as conn:
+            recorded = _recorded_snapshot(conn)
+            if recorded is not None and recorded != snapshot_id:
+                if most_recent_rev_ts is None:
+                    kept = "SELECT user_text FROM users WHERE 0"
+                    params = ()
+                else:
+                    kept = "SELECT user_text FROM users WHERE oldest_edit > ?"
+                    params = (most_recent_rev_ts,)
+                for table in (
+                    "temporal",
+                    "coedits",
+                    "pending_pages",
+                    "edit_cursors",
+                    "counted_pages",
+                ):
+                    conn.execute(
+                        "DELETE FROM {0} WHERE user_text NOT IN ({1})".format(table, kept),
+                        params,
+                    )
+                conn.execute(
+                    "DELETE FROM users WHERE user_text NOT IN ({0})".format(kept), params
+                )
+            conn.execute(
+                "INSERT OR REPLACE INTO overlay_meta (key, value) VALUES ('snapshot', ?)",
+                (snapshot_id,),
+            )
+        return SqliteOverlay(self.path, self.timeout, snapshot_id, self.history)
+
+    def _recount(self, name, max_age, count):
+        """count(), or its result from within the last max_age seconds (SQLITE_SIZES_MAX_AGE if None)."""
+        if max_age is None:
+            max_age = SQLITE_SIZES_MAX_AGE
+        with self._counted_lock:
+            counted = self._counted.get(name)
+        if counted is not None and time.time() - counted[0] < max_age:
+            return dict(counted[1])
+        result = count()
+        with self._counted_lock:
+            self._counted[name] = (time.time(), result)
+        return dict(result)
+
+    def sizes(self, max_age=None):
+        """# of rows of each table (users for temporal), at most max_age seconds old (see _recount)."""
+        return self._recount("sizes", max_age, self._sizes)
+
+    def _sizes(self):
+        conn = self._conn()
+        return {
+            "users": conn.execute("SELECT COUNT(*) FROM users").fetchone()[0],
+            "temporal": conn.execute(
+                "SELECT COUNT(DISTINCT user_text) FROM temporal"
+            ).fetchone()[0],
+            "coedits": conn.execute("SELECT COUNT(*) FROM coedits").fetchone()[0],
+            "pending_pages": conn.execute("SELECT COUNT(*) FROM pending_pages").fetchone()[0],
+            "edit_cursors": conn.execute("SELECT COUNT(*) FROM edit_cursors").fetchone()[0],
+            "counted_pages": conn.execute("SELECT COUNT(*) FROM counted_pages").fetchone()[0],
+        }
+
+    def byte_sizes(self, max_age=None):
+        """Bytes on disk of each of the OVERLAY_STRUCTURES (tables with their indexes).
+
+        Needs SQLite's dbstat table; without it, the whole database is
+        reported as "database". At most max_age seconds old (see _recount).
+        """
+        return self._recount("byte_sizes", max_age, self._byte_sizes)
+
+    def _byte_sizes(self):
+        conn = self._conn()
+        try:
+            rows = conn.execute(
+                "SELECT m.tbl_name, m.name, SUM(s.pgsize) FROM dbstat s "
+                "JOIN sqlite_master m ON m.name = s.name GROUP BY m.name"
+            ).fetchall()
+        except sqlite3.OperationalError:
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            sizes = {"database": page_size * conn.execute("PRAGMA page_count").fetchone()[0]}
+        else:
+            sizes = dict.fromkeys(OVERLAY_STRUCTURES, 0)
+            for table, name, nbytes in rows:
+                structure = "listed_by" if name == "coedits_neighbor" else table
+                if structure in sizes:
+                    sizes[structure] += nbytes
+        self.history.sample(sum(sizes.values()))
+        return sizes
+
+    def total_bytes(self, max_age=None):
+        return sum(self.byte_sizes(max_age).values())
+
+
+def _record_edits(
+    conn, user_text, num_edits, num_pages, oldest_edit, most_recent_edit, temporal
+):
+    # TIME_FORMAT timestamps sort lexicographically; COALESCE because max/min of NULL is NULL
+    conn.execute(
+        "INSERT INTO users "
+        "(user_text, num_edits, num_pages, most_recent_edit, oldest_edit) "
+        "VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT (user_text) DO UPDATE SET "
+        "num_edits = num_edits + excluded.num_edits, "
+        "num_pages = num_pages + excluded.num_pages, "
+        "most_recent_edit = max(COALESCE(most_recent_edit, excluded.most_recent_edit), "
+        "COALESCE(excluded.most_recent_edit, most_recent_edit)), "
+        "oldest_edit = min(COALESCE(oldest_edit, excluded.oldest_edit), "
+        "COALESCE(excluded.oldest_edit, oldest_edit))",
+        (user_text, num_edits, num_pages, most_recent_edit, oldest_edit),
+    )
+    conn.executemany(
+        "INSERT INTO temporal (user_text, slot, num_edits) VALUES (?, ?, ?) "
+        "ON CONFLICT (user_text, slot) DO UPDATE SET "
+        "num_edits = num_edits + excluded.num_edits",
+        [(user_text, slot, int(n)) for slot, n in enumerate(temporal) if n],
+    )
+
+
+def _record_edit_batch(
+    conn,
+    user_text,
+    cursor,
+    next_cursor,
+    num_edits,
+    pageids,
+    oldest_edit,
+    most_recent_edit,
+    temporal,
+):
+    row = conn.execute(
+        "SELECT cursor FROM edit_cursors WHERE user_text = ?", (user_text,)
+    ).fetchone()
+    if (None if row is None else json.loads(row[0])) != cursor:
+        return False
+    before = conn.total_changes
+    conn.executemany(
+        "INSERT OR IGNORE INTO counted_pages (user_text, pageid) VALUES (?, ?)",
+        [(user_text, pid) for pid in pageids],
+    )
+    new_pages = conn.total_changes - before
+    _record_edits(conn, user_text, num_edits, new_pages, oldest_edit, most_recent_edit, temporal)
+    conn.execute(
+        "INSERT OR REPLACE INTO edit_cursors (user_text, cursor) VALUES (?, ?)",
+        (user_text, json.dumps(next_cursor, sort_keys=True)),
+    )
+    return True
+
+
+def _add_coedits(conn, user_text, overlaps):
+    conn.executemany(
+        "INSERT INTO coedits (user_text, neighbor, num_pages) VALUES (?, ?, ?) "
+        "ON CONFLICT (user_text, neighbor) DO UPDATE SET "
+        "num_pages = num_pages + excluded.num_pages",
+        [(user_text, neighbor, n) for neighbor, n in overlaps.items()],
+    )
+
+
+def _copy(value):
+    return None if value is None else type(value)(value)
+
+
+def _nbytes(value):
+    """Approximate bytes held by value: sys.getsizeof of it and of everything in it.
+
+    Objects shared between structures (e.g. user names) are counted every time,
+    so this errs on the high side. Lists and sets are sized by their first item:
+    the overlay's hold ints (page ids, counts) of much the same size, and some
+    get long enough that adding up every item on each update would be slow.
+    """
+    nbytes = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            nbytes += _nbytes(key) + _nbytes(item)
+    elif isinstance(value, (list, tuple, set)) and value:
+        nbytes += len(value) * _nbytes(next(iter(value)))
+    return nbytes
+
+
+def _recorded_snapshot(conn):
+    row = conn.execute("SELECT value FROM overlay_meta WHERE key = 'snapshot'").fetchone()
+    return None if row is None else row[0]
+
+
+def _after_snapshot(delta, most_recent_rev_ts):
+    """Whether all of a user's new edits were made after the snapshot's last revision."""
+    return (
+        most_recent_rev_ts is not None
+        and delta["oldest_edit"] is not None
+        and delta["oldest_edit"] > most_recent_rev_ts
+    )
+
+
+def _empty_user_delta(is_anon):
+    return {
+        "is_anon": is_anon,
+        "num_edits": 0,
+        "num_pages": 0,
+        "most_recent_edit": None,
+        "oldest_edit": None,
+    }
+
+
+def _merge_user_delta(delta, num_edits, num_pages, oldest_edit, most_recent_edit):
+    delta["num_edits"] += num_edits
+    delta["num_pages"] += num_pages
+    # TIME_FORMAT timestamps sort lexicographically
+    if most_recent_edit and (
+        not delta["most_recent_edit"] or most_recent_edit > delta["most_recent_edit"]
+    ):
+        delta["most_recent_edit"] = most_recent_edit
+    if oldest_edit and (not delta["oldest_edit"] or oldest_edit < delta["oldest_edit"]):
+        delta["oldest_edit"] = oldest_edit
+
+
+def _merge_metadata(base, delta):
+    """Snapshot metadata (or None) with an overlay delta (or None) applied."""
+    if delta is None:
+        return base
+    if base is None:
+        if delta["is_anon"] is None:
+            # edits recorded for someone check_user_text never admitted
+            return None
+        return dict(delta)
+    merged = dict(base)
+    _merge_user_delta(
+        merged,
+        delta["num_edits"],
+        delta["num_pages"],
+        delta["oldest_edit"],
+        delta["most_recent_edit"],
+    )
+    return merged
+
+
+class UserStore(object):
+    """USER_METADATA, TEMPORAL_DATA and COEDIT_DATA: snapshot merged with the overlay."""
+
+    def __init__(self, snapshot=None, overlay=None):
+        self.snapshot = snapshot
+        self.overlay = overlay if overlay is not None else MemoryOverlay()
+        self.temporal_index = (
+            None if snapshot is None else temporal_index.TemporalIndex.for_snapshot(snapshot)
+        )
+
+    def user_id(self, user_text):
+        if self.snapshot is None:
+            return None
+        return self.snapshot.user_id(user_text)
+
+    def __contains__(self, user_text):
+        return self.metadata(user_text) is not None
+
+    def known_users(self, user_texts):
+        """The subset of user_texts that have metadata, with one overlay lookup."""
+        deltas = self.overlay.get_user_many(user_texts)
+        known = set()
+        for user_text in user_texts:
+            uid = self.user_id(user_text)
+            base = uid is not None and self.snapshot.has_metadata(uid)
+            delta = deltas.get(user_text)
+            if base or (delta is not None and delta["is_anon"] is not None):
+                known.add(user_text)
+        return known
+
+    def metadata(self, user_text, uid=None):
+        """Merged metadata for a user, or None if they are neither in the dumps nor learned since."""
+        if uid is None:
+            uid = self.user_id(user_text)
+        base = self.snapshot.metadata(uid) if uid is not None else None
+        return _merge_metadata(base, self.overlay.get_user(user_text))
+
+    def version(self, user_text):
+        """Changes whenever the snapshot or the user's metadata or co-edit list does."""
+        meta = self.metadata(user_text)
+        coedits = self.overlay.get_coedits(user_text) or {}
+        return (
+            None if self.snapshot is None else self.snapshot.meta.get("created"),
+            None if meta is None else (meta["num_edits"], meta["most_recent_edit"]),
+            # co-edit deltas only ever grow
+            len(coedits),
+            sum(coedits.values()),
+        )
+
+    def num_pages(self, user_text, default=None, uid=None):
+        meta = self.metadata(user_text, uid=uid)
+        if meta is None:
+            return default
+        return meta["num_pages"]
+
+    def num_pages_many(self, users):
+        """Merged num_pages (None if no metadata) for a list of (user_text, uid) pairs."""
+        deltas = self.overlay.get_user_many([u for u, _ in users])
+        result = []
+        for user_text, uid in users:
+            base = None if uid is None else self.snapshot.num_pages(uid)
+            delta = deltas.get(user_text)
+            if delta is None:
+                result.append(base)
+            elif base is not None:
+                result.append(base + delta["num_pages"])
+            elif delta["is_anon"] is not None:
+                result.append(delta["num_pages"])
+            else:
+                result.append(None)
+        return result
+
+    def temporal_vectors(self, users):
+        """Dense day/hour vectors (7 days then 24 hours) and their norms for many users at once.
+
+        ``users`` is a list of (user_text, uid) pairs. Returns a ``len(users) x 31``
+        matrix of counts (zeros for unknown users) and a ``len(users) x 2`` matrix of
+        the (day, hour) norms, taken from the snapshot unless the overlay changed a row.
+        """
+        uids = np.array(
+            [-1 if uid is None else uid for _, uid in users], dtype=np.int64
+        )
+        counts = np.zeros((len(users), TEMPORAL_DIMS), dtype=np.float64)
+        norms = np.zeros((len(users), 2), dtype=np.float64)
+        in_snapshot = uids >= 0
+        if in_snapshot.any():
+            counts[in_snapshot] = self.snapshot.temporal[uids[in_snapshot]]
+            norms[in_snapshot] = self.snapshot.temporal_norms[uids[in_snapshot]]
+        deltas = self.overlay.get_temporal_many([u for u, _ in users])
+        if deltas:
+            for i, (user_text, _) in enumerate(users):
+                if user_text in deltas:
+                    counts[i] += deltas[user_text]
+                    norms[i] = temporal_norms(counts[i])
+        return counts, norms
+
+    def neighbors(self, user_text, k=None, limit=NEIGHBOR_LIMIT):
+        """Most-similar users as Neighbor tuples, most similar first.
+
+        Sorted by overlap and then by fewest pages edited; beyond ``limit`` entries
+        the list is cut at the first neighbor that overlapped on a single page.
+        Neighbors whose overlap has not changed since the dumps keep their rank
+        in the dump, which broke ties by the pages they had edited then, while
+        num_pages is reported as it is now (see _merge_coedits).
+        """
+        uid = self.user_id(user_text)
+        delta = self.overlay.get_coedits(user_text)
+        if uid is None:
+            ids, overlaps = (), ()
+        else:
+            ids, overlaps = self.snapshot.neighbors(uid)
+        if not delta:
+            # the dump is already in ranked order, so only resolve the names returned
+            end = len(ids)
+            if end > limit:
+                singles = np.flatnonzero(np.asarray(overlaps[limit:]) == 1)
+                if len(singles):
+                    end = limit + int(singles[0])
+            if k is not None:
+                end = min(k, end)
+            candidates = [
+                (self.snapshot.user_text(ids[i]), int(overlaps[i]), int(ids[i]))
+                for i in range(end)
+            ]
+            return self._with_num_pages(candidates)
+
+        candidates = []
+        for _, overlap, ut, neighbor_uid in self._merge_coedits(ids, overlaps, delta):
+            if k is not None and len(candidates) == k:
+                break
+            if len(candidates) >= limit and overlap == 1:
+                break
+            if ut is None:
+                ut = self.snapshot.user_text(neighbor_uid)
+            candidates.append((ut, overlap, neighbor_uid))
+        return self._with_num_pages(candidates)
+
+    def overlaps_with(self, user_text, others):
+        """{other: pages overlapped} for the few users ``others``, deltas merged.
+
+        They are looked up in user_text's whole neighbor list, nothing cut off;
+        those who are not in it are left out.
+        """
+        found = {}
+        uid = self.user_id(user_text)
+        if uid is not None:
+            ids, overlaps = self.snapshot.neighbors(uid)
+            other_uids = {other: self.user_id(other) for other in others}
+            wanted = np.array([u for u in other_uids.values() if u is not None], dtype=np.int64)
+            if len(wanted):
+                positions = np.flatnonzero(np.isin(ids, wanted))
+                by_uid = {int(ids[i]): int(overlaps[i]) for i in positions}
+                for other, other_uid in other_uids.items():
+                    if other_uid in by_uid:
+                        found[other] = by_uid[other_uid]
+        delta = self.overlay.get_coedits(user_text)
+        if delta:
+            for other in others:
+                if delta.get(other):
+                    found[other] = found.get(other, 0) + delta[other]
+        return found
+
+    def neighbor_arrays(self, user_text):
+        """A user's whole neighbor list, deltas merged and nothing cut off, as a NeighborArrays.
+
+        Meant for scoring every neighbor at once: rows are in dump order followed
+        by new neighbors, with uids (-1 for users not in the snapshot), merged
+        overlaps, num_pages (0 where there is no metadata) and temporal counts and
+        norms (as from temporal_vectors). Only the rows of users the overlay has
+        changed are looked up one by one; ``names`` has the user_text of those
+        rows, the others are resolved with neighbors_at.
+        """
+        uid = self.user_id(user_text)
+        if uid is None:
+            ids, overlaps = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        else:
+            ids, overlaps = self.snapshot.neighbors(uid)
+        uids = np.asarray(ids, dtype=np.int64)
+        overlaps = np.array(overlaps, dtype=np.int64)
+        names = {}
+
+        delta = self.overlay.get_coedits(user_text)
+        if delta:
+            delta_uids = [self.user_id(ut) for ut in delta]
+            wanted = np.array([u for u in delta_uids if u is not None], dtype=np.int64)
+            positions = np.flatnonzero(np.isin(uids, wanted)) if len(wanted) else ()
+            row_of = {int(uids[i]): int(i) for i in positions}
+            new_uids = []
+            new_overlaps = []
+            for (ut, extra), neighbor_uid in zip(delta.items(), delta_uids):
+                row = row_of.get(neighbor_uid)
+                if row is None:
+                    names[len(uids) + len(new_uids)] = ut
+                    new_uids.append(-1 if neighbor_uid is None else neighbor_uid)
+                    new_overlaps.append(extra)
+                else:
+                    names[row] = ut
+                    overlaps[row] += extra
+            uids = np.concatenate([uids, np.array(new_uids, dtype=np.int64)])
+            overlaps = np.concatenate([overlaps, np.array(new_overlaps, dtype=np.int64)])
+
+        num_pages = np.zeros(len(uids), dtype=np.int64)
+        counts = np.zeros((len(uids), TEMPORAL_DIMS), dtype=np.float64)
+        norms = np.zeros((len(uids), 2), dtype=np.float64)
+        in_snapshot = np.flatnonzero(uids >= 0)
+        if len(in_snapshot):
+            rows = uids[in_snapshot]
+            has_metadata = (self.snapshot.meta_flags[rows] & FLAG_HAS_METADATA) != 0
+            num_pages[in_snapshot] = np.where(has_metadata, self.snapshot.meta_num_pages[rows], 0)
+            counts[in_snapshot] = self.snapshot.temporal[rows]
+            norms[in_snapshot] = self.snapshot.temporal_norms[rows]
+
+        # rows whose metadata or temporal data has changed since the dumps
+        changed = self.overlay.changed_users()
+        stale = {row: ut for row, ut in names.items() if ut in changed}
+        unnamed = [row for row in in_snapshot if int(row) not in names]
+        # a name lookup (user_id) reads about log2(num_users) names, so either look
+        # up the changed users or read the names of the neighbors, whichever is less
+        if len(changed) * max(1, int(self.snapshot.num_users).bit_length()) < len(unnamed):
+            changed_uids = [self.user_id(ut) for ut in changed if ut not in names.values()]
+            changed_uids = np.array([u for u in changed_uids if u is not None], dtype=np.int64)
+            if len(changed_uids):
+                for row in np.flatnonzero(np.isin(uids, changed_uids)):
+                    stale.setdefault(int(row), self.snapshot.user_text(int(uids[row])))
+        elif changed:
+            for row in unnamed:
+                neighbor = self.snapshot.user_text(int(uids[row]))
+                if neighbor in changed:
+                    stale[int(row)] = neighbor
+        if stale:
+            rows = sorted(stale)
+            users = [(stale[row], None if uids[row] < 0 else int(uids[row])) for row in rows]
+            num_pages[rows] = [n or 0 for n in self.num_pages_many(users)]
+            counts[rows], norms[rows] = self.temporal_vectors(users)
+        return NeighborArrays(uids, overlaps, num_pages, counts, norms, names)
+
+    def neighbors_at(self, arrays, rows):
+        """Neighbor tuples for the given rows of a NeighborArrays, in that order."""
+        candidates = []
+        for row in rows:
+            row = int(row)
+            neighbor_uid = int(arrays.uids[row])
+            user_text = arrays.names.get(row)
+            if user_text is None:
+                user_text = self.snapshot.user_text(neighbor_uid)
+            candidates.append(
+                (user_text, int(arrays.overlaps[row]), None if neighbor_uid < 0 else neighbor_uid)
+            )
+        return self._with_num_pages(candidates)
+
+    def _merge_coedits(self, ids, overlaps, delta):
+        """Ranked (key, overlap, user_text, uid) for a user's dump neighbors merged with their deltas.
+
+        Only the neighbors in ``delta`` are looked up and re-ranked; they are then
+        merged into the dump's ranked list, whose other entries keep their place
+        (as when there are no deltas), so the cost grows with the size of the delta
+        rather than with the whole list. Changed neighbors break ties on overlap
+        by their num_pages now, deltas included, and unchanged ones by their
+        num_pages in the dump: pages a neighbor has edited since do not move them
+        among the unchanged entries, whose order is the dump's. Remaining ties keep
+        dump order, with new neighbors last in the order they were first seen.
+        Entries are produced lazily, so taking the top k stops early; user_text is
+        None for unchanged entries until they are resolved.
+        """
+        uids = [self.user_id(ut) for ut in delta]
+        # where the changed neighbors that are in the dump sit in its ranked list
+        wanted = np.array([u for u in uids if u is not None], dtype=np.int64)
+        positions = np.flatnonzero(np.isin(ids, wanted)) if len(wanted) else ()
+        position_of = {int(ids[i]): int(i) for i in positions}
+
+        changed = []
+        num_new = 0
+        for (ut, extra), neighbor_uid in zip(delta.items(), uids):
+            position = position_of.get(neighbor_uid)
+            if position is None:
+                changed.append((ut, extra, neighbor_uid, len(ids) + num_new))
+                num_new += 1
+            else:
+                changed.append(
+                    (ut, int(overlaps[position]) + extra, neighbor_uid, position)
+                )
+        num_pages = self.num_pages_many([(ut, u) for ut, _, u, _ in changed])
+        changed = sorted(
+            ((-overlap, n or 0, position), overlap, ut, u)
+            for (ut, overlap, u, position), n in zip(changed, num_pages)
+        )
+
+        def unchanged():
+            skip = set(position_of.values())
+            for i in range(len(ids)):
+                if i in skip:
+                    continue
+                neighbor_uid = int(ids[i])
+                overlap = int(overlaps[i])
+                n = self.snapshot.num_pages(neighbor_uid)
+                yield (-overlap, n or 0, i), overlap, None, neighbor_uid
+
+        return heapq.merge(unchanged(), changed, key=lambda entry: entry[0])
+
+    def listed_by(self, user_text, k=None, max_rank=NEIGHBOR_LIMIT):
+        """Users who have user_text among their max_rank most similar, as ListedBy tuples, closest first.
+
+        Closest means user_text ranks highest in their list, then most overlap.
+        The snapshot's reverse index already has this for the dumps; only the
+        users whose lists have changed since (those with co-edit deltas) are
+        re-ranked, from their merged lists, and merged in.
+        """
+        uid = self.user_id(user_text)
+        if uid is None:
+            users = overlaps = ranks = np.zeros(0, dtype=np.int32)
+        else:
+            users, overlaps, ranks = self.snapshot.listed_by(uid)
+            # ranked by rank first, so the users within max_rank come first
+            end = int(np.searchsorted(ranks, max_rank))
+            users, overlaps, ranks = users[:end], overlaps[:end], ranks[:end]
+
+        recheck = set(self.overlay.get_listed_by(user_text))
+        skip = set()
+        if len(users):
+            # only their lists can have changed since the dumps
+            names = [self.snapshot.user_text(int(u)) for u in users]
+            edited = self.overlay.coedit_users(names)
+            for i, name in enumerate(names):
+                if name in edited:
+                    skip.add(i)
+                    recheck.add(name)
+        changed = []
+        for other in recheck:
+            for rank, neighbor in enumerate(self.neighbors(other, max_rank)):
+                if neighbor.user_text == user_text:
+                    changed.append(
+                        ((rank, -neighbor.overlap), other, neighbor.overlap, rank, self.user_id(other))
+                    )
+                    break
+        changed.sort()
+
+        def unchanged():
+            for i in range(len(users)):
+                if i not in skip:
+                    overlap = int(overlaps[i])
+                    rank = int(ranks[i])
+                    yield (rank, -overlap), None, overlap, rank, int(users[i])
+
+        candidates = []
+        for _, ut, overlap, rank, other_uid in heapq.merge(
+            unchanged(), changed, key=lambda entry: entry[0]
+        ):
+            if k is not None and len(candidates) == k:
+                break
+            if ut is None:
+                ut = self.snapshot.user_text(other_uid)
+            candidates.append((ut, overlap, other_uid, rank))
+        num_pages = self.num_pages_many([(ut, u) for ut, _, u, _ in candidates])
+        return [
+            ListedBy(ut, overlap, u, n, rank)
+            for (ut, overlap, u, rank), n in zip(candidates, num_pages)
+        ]
+
+    def temporal_neighbors(
+        self,
+        user_text,
+        k,
+        is_anon=None,
+        active_since=None,
+        active_until=None,
+        probes=temporal_index.DEFAULT_PROBES,
+    ):
+        """Users anywhere in the data whose temporal fingerprints are closest to user_text's.
+
+        Returns up to k TemporalMatch tuples, most similar first. Candidates can be
+        filtered on USER_METADATA: is_anon, and a period (TIME_FORMAT strings,
+        either end optional) that their edits in the data must overlap. Users in
+        the snapshot come from its temporal index; those whose data has changed
+        since are left out of that search and scored from their merged data.
+        """
+        uid = self.user_id(user_text)
+        counts, norms = self.temporal_vectors([(user_text, uid)])
+        query = temporal_index.fingerprints(counts, norms)[0]
+        if not query.any():
+            return []
+        filtered = is_anon is not None or active_since or active_until
+        since = timestamp_to_epoch(active_since) if active_since else None
+        until = timestamp_to_epoch(active_until) if active_until else None
+
+        changed = [(ut, self.user_id(ut)) for ut in self.overlay.changed_users()]
+        excluded = np.array(
+            [u for _, u in changed if u is not None] + ([uid] if uid is not None else []),
+            dtype=np.int64,
+        )
+
+        def accept(uids):
+            mask = ~np.isin(uids, excluded)
+            if filtered:
+                flags = self.snapshot.meta_flags[uids]
+                mask &= (flags & FLAG_HAS_METADATA) != 0
+                if is_anon is not None:
+                    mask &= ((flags & FLAG_IS_ANON) != 0) == bool(is_anon)
+                if since is not None:
+                    mask &= self.snapshot.meta_most_recent_edit[uids] >= since
+                if until is not None:
+                    oldest = self.snapshot.meta_oldest_edit[uids]
+                    mask &= (oldest != NO_TIMESTAMP) & (oldest <= until)
+            return mask
+
+        matches = []
+        if self.temporal_index is not None:
+            uids, scores = self.temporal_index.search(query, k, accept, probes)
+            matches.extend((float(s), None, int(u)) for u, s in zip(uids, scores))
+
+        others = []
+        for other, other_uid in changed:
+            if other == user_text:
+                continue
+            if filtered:
+                meta = self.metadata(other, uid=other_uid)
+                # TIME_FORMAT timestamps sort lexicographically
+                if (
+                    meta is None
+                    or (is_anon is not None and bool(meta["is_anon"]) != bool(is_anon))
+                    or (active_since and (meta["most_recent_edit"] or "") < active_since)
+                    or (active_until and not (meta["oldest_edit"] or "~") <= active_until)
+                ):
+                    continue
+            others.append((other, other_uid))
+        if others:
+            counts, norms = self.temporal_vectors(others)
+            scores = temporal_index.fingerprints(counts, norms) @ query
+            matches.extend(
+                (float(score), other, other_uid)
+                for (other, other_uid), score, n in zip(others, scores, norms)
+                if n.any()
+            )
+
+        matches.sort(key=lambda match: -match[0])
+        return [
+            TemporalMatch(
+                other if other is not None else self.snapshot.user_text(other_uid),
+                other_uid,
+                score,
+            )
+            for score, other, other_uid in matches[:k]
+        ]
+
+    def _with_num_pages(self, candidates):
+        num_pages = self.num_pages_many([(ut, uid) for ut, _, uid in candidates])
+        return [
+            Neighbor(ut, overlap, uid, n)
+            for (ut, overlap, uid), n in zip(candidates, num_pages)
+        ]
+
+    def add_user(self, user_text, is_anon):
+        """Admit a valid user that was not in the dumps."""
+        self.overlay.add_user(user_text, is_anon)
+
+    def record_edits(
+        self, user_text, num_edits, num_pages, oldest_edit, most_recent_edit, temporal
+    ):
+        """Add a user's edits made since the dumps to their metadata and temporal data."""
+        self.overlay.record_edits(
+            user_text, num_edits, num_pages, oldest_edit, most_recent_edit, temporal
+        )
+
+    def edit_cursor(self, user_text):
+        """Where the listing of the user's new edits resumes (see record_edit_batch), or None."""
+        return self.overlay.get_edit_cursor(user_text)
+
+    def record_edit_batch(
+        self,
+        user_text,
+        cursor,
+        next_cursor,
+        num_edits,
+        pageids,
+        oldest_edit,
+        most_recent_edit,
+        temporal,
+    ):
+        """Record one batch of a user's new edits and move their edit cursor from cursor to next_cursor.
+
+        Cursors are JSON-serializable values chosen by the caller. The batch is
+        only recorded if the user's cursor is still ``cursor`` (i.e. nobody else
+        has recorded it in the meantime); returns whether it was. Of ``pageids``,
+        only the pages not counted before are added to the user's num_pages.
+        """
+        return self.overlay.record_edit_batch(
+            user_text,
+            cursor,
+            next_cursor,
+            num_edits,
+            pageids,
+            oldest_edit,
+            most_recent_edit,
+            temporal,
+        )
+
+    def add_coedits(self, user_text, overlaps):
+        """Add pages newly overlapped with each neighbor ({neighbor: num_pages})."""
+        if overlaps:
+            self.overlay.add_coedits(user_text, overlaps)
+
+    def ingest_state(self):
+        """Where ingest.py has got to in its stream of edits (see record_ingested), or None."""
+        return self.overlay.get_ingest_state()
+
+    def record_ingested(self, batches, coedits, state):
+        """Record a batch of edits taken in by ingest.py, and how far it has got.
+
+        ``batches`` holds the arguments of record_edit_batch for each user
+        ({user_text: {"cursor": ..., "next_cursor": ..., ...}}) and ``coedits``
+        the pages newly overlapped ({user_text: {neighbor: num_pages}}); a
+        user's coedits are only added if their batch is recorded. ``state`` is
+        kept as the ingest state. Returns the users whose edit cursor had moved
+        on, whose batches were left out.
+        """
+        return self.overlay.record_ingested(batches, coedits, state)
+
+    def pending_pages(self, user_text):
+        """Pages with new edits by the user whose histories have not been fetched yet."""
+        return self.overlay.get_pending_pages(user_text)
+
+    def set_pending_pages(self, user_text, pageids):
+        self.overlay.set_pending_pages(user_text, pageids)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""Write synthetic coedit_counts.tsv, temporal.tsv and metadata.tsv for benchmarking.
+
+Usage: python3 generate_data.py -r /tmp/bench --scale production
+
+The files have the same headers and value formats as the PySpark exports. The
+``production`` scale comes out at roughly the sizes listed in the README (about
+1.1GB, 150MB and 200MB). Users are named like the accounts of mediawiki_stub.py
+("User<i>", and "10.x.y.z" for IPs), so the two can be used together.
+"""
+
+import argparse
+import json
+import logging
+import os
+import pathlib
+import time
+
+import numpy as np
+
+from compile_snapshot import (
+    COEDIT_FILE,
+    COEDIT_HEADER,
+    METADATA_FILE,
+    METADATA_HEADER,
+    TEMPORAL_FILE,
+    TEMPORAL_HEADER,
+)
+from snapshot import NUM_DAYS, NUM_HOURS, TIME_FORMAT, timestamp_to_epoch
+
+SCALES = {"small": 10000, "medium": 300000, "production": 3000000}
+MAX_NEIGHBORS = 250
+CHUNK_USERS = 50000
+
+logger = logging.getLogger(__name__)
+
+
+def user_names(num_users, anon_fraction, rng):
+    """Names for num_users users, a random anon_fraction of them IP addresses."""
+    is_anon = rng.random(num_users) < anon_fraction
+    names = []
+    num_anons = 0
+    for i, anon in enumerate(is_anon):
+        if anon:
+            names.append(
+                "10.{0}.{1}.{2}".format(
+                    num_anons // 65536, (num_anons // 256) % 256, num_anons % 256
+                )
+            )
+            num_anons += 1
+        else:
+            names.append("User{0}".format(i))
+    return names, is_anon
+
+
+def generate(
+    resource_dir,
+    num_users,
+    neighbors=15,
+    temporal_rows=2,
+    anon_fraction=0.3,
+    earliest_ts="2020-01-01T00:00:00Z",
+    most_recent_rev_ts="2020-09-30T23:59:59Z",
+    seed=0,
+):
+    """Write the three TSVs for num_users users to resource_dir. Returns rows written per file."""
+    os.makedirs(resource_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    names, is_anon = user_names(num_users, anon_fraction, rng)
+    start = timestamp_to_epoch(earliest_ts)
+    end = timestamp_to_epoch(most_recent_rev_ts)
+    rows = {COEDIT_FILE: 0, TEMPORAL_FILE: 0, METADATA_FILE: 0}
+
+    with open(os.path.join(resource_dir, COEDIT_FILE), "w") as coedits, open(
+        os.path.join(resource_dir, TEMPORAL_FILE), "w"
+    ) as temporal, open(os.path.join(resource_dir, METADATA_FILE), "w") as metadata:
+        coedits.write("\t".join(COEDIT_HEADER) + "\n")
+        temporal.write("\t".join(TEMPORAL_HEADER) + "\n")
+        metadata.write("\t".join(METADATA_HEADER) + "\n")
+        for first in range(0, num_users, CHUNK_USERS):
+            last = min(num_users, first + CHUNK_USERS)
+            n = last - first
+            # most users have a few neighbors, some have the full 250
+            num_neighbors = np.minimum(
+                rng.geometric(1.0 / neighbors, n), MAX_NEIGHBORS
+            )
+            max_overlap = np.ones(n, dtype=np.int64)
+            lines = []
+            for i in range(n):
+                uid = first + i
+                ids = np.unique(rng.integers(0, num_users, num_neighbors[i]))
+                ids = ids[ids != uid]
+                rng.shuffle(ids)
+                overlaps = np.sort(rng.geometric(0.3, len(ids)))[::-1]
+                if len(overlaps):
+                    max_overlap[i] = overlaps[0]
+                user_text = names[uid]
+                lines.extend(
+                    "{0}\t{1}\t{2}\n".format(user_text, names[j], o)
+                    for j, o in zip(ids, overlaps)
+                )
+            coedits.writelines(lines)
+            rows[COEDIT_FILE] += len(lines)
+
+            num_rows = rng.integers(1, 2 * temporal_rows, n, endpoint=True)
+            users = np.repeat(np.arange(first, last), num_rows)
+            days = rng.integers(1, NUM_DAYS, len(users), endpoint=True)
+            hours = rng.integers(0, NUM_HOURS, len(users))
+            counts = rng.geometric(0.2, len(users))
+            temporal.writelines(
+                "{0}\t{1}\t{2}\t{3}\n".format(names[u], d, h, c)
+                for u, d, h, c in zip(users, days, hours, counts)
+            )
+            rows[TEMPORAL_FILE] += len(users)
+
+            num_pages = max_overlap + rng.geometric(0.05, n)
+            num_edits = num_pages + rng.geometric(0.05, n)
+            oldest = rng.integers(start, end, n)
+            most_recent = oldest + (rng.random(n) * (end - oldest)).astype(np.int64)
+            metadata.writelines(
+                "{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n".format(
+                    names[uid],
+                    is_anon[uid],
+                    num_edits[i],
+                    num_pages[i],
+                    time.strftime(TIME_FORMAT, time.gmtime(most_recent[i])),
+                    time.strftime(TIME_FORMAT, time.gmtime(oldest[i])),
+                )
+                for i, uid in enumerate(range(first, last))
+            )
+            rows[METADATA_FILE] += n
+            logger.info("Generated %d of %d users", last, num_users)
+    return rows
+
+
+def parse_args():
+    """Parse command line arguments."""
+
+    parser = argparse.ArgumentParser(
+        description="Write synthetic co-edit, temporal and metadata TSVs for benchmarking"
+    )
+    parser.add_argument(
+        "--resourcedir",
+        "-r",
+        action="store",
+        help="Directory to write the TSV files to.",
+        type=pathlib.Path,
+        required=True,
+    )
+    parser.add_argument(
+        "--scale",
+        choices=sorted(SCALES),
+        default="small",
+        help="Number of users: {0}.".format(
+            ", ".join("{0} {1}".format(k, v) for k, v in sorted(SCALES.items()))
+        ),
+    )
+    parser.add_argument(
+        "--users", type=int, default=None, help="Number of users (overrides --scale)."
+    )
+    parser.add_argument(
+        "--neighbors", type=float, default=15, help="Mean # of neighbors per user."
+    )
+    parser.add_argument(
+        "--temporal-rows", type=float, default=2, help="Mean # of day/hour rows per user."
+    )
+    parser.add_argument("--anon-fraction", type=float, default=0.3)
+    parser.add_argument("--earliest-ts", default="2020-01-01T00:00:00Z")
+    parser.add_argument("--most-recent-rev-ts", default="2020-09-30T23:59:59Z")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--verbose",
+        "-v",
+        dest="verbose",
+        action="store_true",
+        help="Verbose output.",
+        default=False,
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    num_users = args.users or SCALES[args.scale]
+    start = time.time()
+    rows = generate(
+        str(args.resourcedir),
+        num_users,
+        neighbors=args.neighbors,
+        temporal_rows=args.temporal_rows,
+        anon_fraction=args.anon_fraction,
+        earliest_ts=args.earliest_ts,
+        most_recent_rev_ts=args.most_recent_rev_ts,
+        seed=args.seed,
+    )
+    print(
+        json.dumps(
+            {"users": num_users, "rows": rows, "seconds": round(time.time() - start, 1)},
+            indent=2,
+            sort_keys=True,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
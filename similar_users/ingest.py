@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+"""Keep the shared overlay up to date from a stream of edits, so that queries need no API calls.
+
+    python3 ingest.py --config flask_config.yaml --resourcedir resources
+    python3 ingest.py --config flask_config.yaml --resourcedir resources --source edits.ndjson
+
+Reads ``mediawiki.revision-create`` events, from Wikimedia's EventStreams
+(INGEST_SOURCE) or from a file with one event per line (e.g. for testing), and
+takes in the edits to the wikis served as a refresh of their editors
+(wsgi.refresh_user_data) would have: each edit is added to its editor's
+metadata and temporal data, and the users who edited within EDIT_WINDOW
+revisions of it on the page are added to each other's co-edits -- once per
+page and pair of users, and leaving out bots. Edits are written in batches
+(INGEST_BATCH_SIZE events, or every INGEST_BATCH_SECONDS), each in one
+transaction on the SQLite overlay the workers share, together with how far the
+ingester has got.
+
+Only the users whose new edits have been listed from the API since the
+ingester started are kept up to date this way (their edits before then are
+only in the API). While the ingester keeps up, requests for them skip the
+refresh altogether (see wsgi.ingested); other users are refreshed as before,
+which brings them in. Page histories are followed in memory, for the last
+INGEST_MAX_PAGES pages edited, and start empty, so the first edits to a page
+after the ingester starts only have the edits after them as neighbors.
+
+A restarted ingester resumes after the last event of its last batch. Its
+throughput is exported as ``similarusers_ingest_events_total`` (by wiki and
+outcome) on --metrics-port, and a file is followed by a summary of the
+events per second.
+"""
+
+from collections import Counter, OrderedDict, deque, namedtuple
+from datetime import datetime
+import argparse
+import calendar
+import json
+import logging
+import time
+
+import requests
+from prometheus_client import start_http_server
+
+import instrumentation
+import wsgi
+
+DEFAULT_INGEST_SOURCE = "https://stream.wikimedia.org/v2/stream/revision-create"
+DEFAULT_INGEST_BATCH_SIZE = 1000  # events per transaction
+DEFAULT_INGEST_BATCH_SECONDS = 5  # at most between transactions while events come in
+DEFAULT_INGEST_MAX_PAGES = 100000  # pages whose recent edits are followed
+RECONNECT_SECONDS = 5
+
+# wiki: database name (e.g. enwiki); user_text: None if the username was suppressed
+Revision = namedtuple(
+    "Revision", ["wiki", "pageid", "namespace", "user_text", "timestamp", "is_bot"]
+)
+
+logger = logging.getLogger(__name__)
+
+
+def parse_event(event):
+    """Revision of a revision-create event, or None if it isn't one."""
+    try:
+        performer = event.get("performer") or {}
+        return Revision(
+            event["database"],
+            event["page_id"],
+            event["page_namespace"],
+            performer.get("user_text"),
+            event["rev_timestamp"],
+            bool(performer.get("user_is_bot")) or "bot" in performer.get("user_groups", ()),
+        )
+    except (AttributeError, KeyError):
+        return None
+
+
+def read_file(path, position=None):
+    """(line number, event) for each line of a newline-delimited JSON file, after line `position`."""
+    with open(path) as fin:
+        for lineno, line in enumerate(fin, 1):
+            if position is not None and lineno <= position:
+                continue
+            line = line.strip()
+            if line:
+                yield lineno, json.loads(line)
+
+
+def read_stream(url, user_agent, last_event_id=None):
+    """(event id, event) for each event of a server-sent event stream, reconnecting where it left off."""
+    while True:
+        headers = {"Accept": "text/event-stream", "User-Agent": user_agent}
+        if last_event_id is not None:
+            headers["Last-Event-ID"] = last_event_id
+        try:
+            with requests.get(url, headers=headers, stream=True, timeout=(10, 60)) as response:
+                response.raise_for_status()
+                response.encoding = "utf-8"
+                event_id, data = None, []
+                for line in response.iter_lines(decode_unicode=True):
+                    if line:
+                        field, _, value = line.partition(":")
+                        if value.startswith(" "):
+                            value = value[1:]
+                        if field == "id":
+                            event_id = value
+                        elif field == "data":
+                            data.append(value)
+                        continue
+                    # a blank line ends an event
+                    if data:
+                        if event_id is not None:
+                            last_event_id = event_id
+                        try:
+                            event = json.loads("\n".join(data))
+                        except ValueError:
+                            logger.warning("Skipped an event that is not JSON: %s", data[0][:200])
+                        else:
+                            yield last_event_id, event
+                    event_id, data = None, []
+        except requests.RequestException as exc:
+            logger.warning("Lost the stream %s (%s); reconnecting", url, exc)
+        time.sleep(RECONNECT_SECONDS)
+
+
+class IngestedEdits(wsgi.EditListing):
+    """A user's edits taken in from the stream, recorded as if listed from the API.
+
+    The cursor moves on past them, so a refresh doesn't list them again, but
+    keeps when the user was last listed from the API.
+    """
+
+    def next_cursor(self):
+        cursor = wsgi.EditListing.next_cursor(self)
+        # (edits can come in out of order)
+        cursor["arvstart"] = max(cursor["arvstart"], self.start["arvstart"])
+        cursor["listed"] = self.start.get("listed")
+        return cursor
+
+
+class WikiIngester(object):
+    """One wiki's edits being taken in, a batch at a time."""
+
+    def __init__(self, name, k, max_pages):
+        self.name = name
+        self.k = k
+        self.max_pages = max_pages
+        self.since = None  # when the ingester started taking edits in (TIME_FORMAT)
+        # page id -> (its last k edits as (user_text, user key, is_bot, tracked), pairs counted on it)
+        self.pages = OrderedDict()
+        self.written = {}  # user key -> the edit cursor the ingester last recorded for them
+        self.totals = Counter()
+        self.reset()
+
+    def reset(self):
+        self.dataset = wsgi.WIKIS.dataset(self.name)
+        self.namespaces = set(wsgi.app.config["NAMESPACES"])
+        self.edits = {}  # user key -> IngestedEdits, or None if the user isn't kept up to date here
+        self.coedits = {}  # user key -> {neighbor: pages newly overlapped}
+        self.outcomes = Counter()
+        self.newest = None
+
+    def add(self, rev):
+        """Take one revision in."""
+        if rev.namespace not in self.namespaces or rev.timestamp < self.dataset.most_recent_rev_ts:
+            # out of scope, or in the dumps already
+            self.outcomes["skipped"] += 1
+            return
+        key = None if rev.user_text is None else wsgi.standardize_user_text(rev.user_text)
+        edits = None
+        if key and not rev.is_bot:
+            edits = self.user_edits(key)
+            if (
+                edits is not None
+                and rev.timestamp < edits.cursor["arvstart"]
+                and self.written.get(key) != edits.cursor
+            ):
+                # listed from the API already (unless the cursor is where the ingester left it)
+                edits = None
+        tracked = edits is not None
+
+        window, counted = self.page(rev.pageid)
+        # the oldest edit of a full window is too far back to count the new one as its neighbor
+        first_later = 1 if len(window) == self.k else 0
+        for i, (user_text, other, is_bot, other_tracked) in enumerate(window):
+            if user_text is None or other == key:
+                continue
+            if tracked and not is_bot:
+                self.count(counted, key, user_text)
+            if other_tracked and i >= first_later and rev.user_text and not rev.is_bot:
+                self.count(counted, other, rev.user_text)
+        window.append((rev.user_text, key, rev.is_bot, tracked))
+
+        if tracked:
+            edits.add_edit(rev.pageid, rev.timestamp)
+        else:
+            self.outcomes["untracked"] += 1
+        if self.newest is None or rev.timestamp > self.newest:
+            self.newest = rev.timestamp
+
+    def user_edits(self, key):
+        """IngestedEdits for the user's edits in this batch, or None if the ingester doesn't keep them up to date."""
+        if key not in self.edits:
+            edits = None
+            if key in self.dataset.data:
+                edits = IngestedEdits(self.dataset, key)
+                cursor = edits.cursor
+                if (
+                    cursor is None
+                    or cursor["continue"] is not None
+                    or (cursor.get("listed") or "") < self.since
+                ):
+                    # the API has edits of theirs the ingester hasn't seen
+                    edits = None
+            self.edits[key] = edits
+        return self.edits[key]
+
+    def page(self, pid):
+        page = self.pages.get(pid)
+        if page is None:
+            page = self.pages[pid] = (deque(maxlen=self.k), set())
+            if len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+        else:
+            self.pages.move_to_end(pid)
+        return page
+
+    def count(self, counted, user_key, neighbor):
+        """Count the page for user_key and neighbor, unless it has been already."""
+        if (user_key, neighbor) in counted:
+            return
+        counted.add((user_key, neighbor))
+        overlaps = self.coedits.setdefault(user_key, {})
+        overlaps[neighbor] = overlaps.get(neighbor, 0) + 1
+
+    def flush(self, state):
+        """Write the batch to the overlay, with the ingest state, in one transaction."""
+        batches = {
+            key: edits.batch()
+            for key, edits in self.edits.items()
+            if edits is not None and edits.new_edits
+        }
+        with instrumentation.stage("ingest_batch", self.name):
+            conflicts = self.dataset.data.record_ingested(batches, self.coedits, state)
+        for key, batch in batches.items():
+            if key not in conflicts:
+                self.written[key] = batch["next_cursor"]
+        # users refreshed from the API meanwhile have had these edits listed
+        self.outcomes["conflict"] = sum(batches[key]["num_edits"] for key in conflicts)
+        self.outcomes["recorded"] = (
+            sum(batch["num_edits"] for batch in batches.values()) - self.outcomes["conflict"]
+        )
+        for outcome, n in self.outcomes.items():
+            instrumentation.INGEST_EVENTS.labels(self.name, outcome).inc(n)
+        self.totals.update(self.outcomes)
+        if self.newest is not None:
+            newest = calendar.timegm(datetime.strptime(self.newest, wsgi.TIME_FORMAT).timetuple())
+            instrumentation.INGEST_LAG.labels(self.name).set(time.time() - newest)
+        # (the dataset is looked up again, in case a new snapshot has been installed)
+        wsgi.check_snapshot(wsgi.WIKIS.get(self.name))
+        self.reset()
+
+
+class Ingester(object):
+    """Takes in the edits to the wikis served from a stream of revision events."""
+
+    def __init__(self, source, names, k, batch_size, batch_seconds, max_pages):
+        self.source = source
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.wikis = OrderedDict((name, WikiIngester(name, k, max_pages)) for name in names)
+        state = self.wikis[names[0]].dataset.data.ingest_state()
+        # carry on from the last batch if it was from the same source
+        self.resumed = state if state is not None and state["source"] == source else None
+        self.since = None if self.resumed is None else self.resumed["since"]
+        self.events = 0 if self.resumed is None else self.resumed["events"]
+        self.other_events = 0
+        for wiki in self.wikis.values():
+            wiki.since = self.since
+
+    def position(self):
+        """Where in the source to resume from (None to start afresh)."""
+        return None if self.resumed is None else self.resumed["position"]
+
+    def run(self, events):
+        """Take in (position, event) pairs until they run out. Returns a summary of the throughput."""
+        begun = time.time()
+        last_flush = time.monotonic()
+        position = self.position()
+        num_events = 0
+        batched = 0
+        for position, event in events:
+            self.add(event)
+            num_events += 1
+            batched += 1
+            if batched >= self.batch_size or time.monotonic() - last_flush >= self.batch_seconds:
+                self.flush(position)
+                last_flush = time.monotonic()
+                batched = 0
+        if batched:
+            self.flush(position)
+        seconds = time.time() - begun
+        return {
+            "events": num_events,
+            "seconds": seconds,
+            "events_per_second": num_events / seconds if seconds else None,
+            "other_wikis": self.other_events,
+            "wikis": {name: dict(wiki.totals) for name, wiki in self.wikis.items()},
+        }
+
+    def add(self, event):
+        rev = parse_event(event)
+        wiki = None if rev is None else self.wikis.get(rev.wiki)
+        if wiki is None:
+            self.other_events += 1
+            return
+        if self.since is None:
+            # the ingester has seen every edit from here on
+            self.since = rev.timestamp
+            for w in self.wikis.values():
+                w.since = self.since
+        self.events += 1
+        wiki.add(rev)
+
+    def flush(self, position):
+        state = {
+            "source": self.source,
+            "position": position,
+            "since": self.since,
+            "updated": time.time(),
+            "events": self.events,
+        }
+        for wiki in self.wikis.values():
+            wiki.flush(state)
+        logger.info("Ingested %d events (up to %s)", self.events, position)
+
+
+def parse_args():
+    """Parse command line arguments."""
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--config", required=True, help="flask_config.yaml to use")
+    parser.add_argument("--resourcedir", required=True, help="Directory with the data")
+    parser.add_argument(
+        "--source",
+        default=None,
+        help="URL of an event stream, or a file of events (default: INGEST_SOURCE)",
+    )
+    parser.add_argument(
+        "--wiki",
+        action="append",
+        default=None,
+        help="Wiki to take edits in for (can be repeated; default: all served)",
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, default=0, help="Serve Prometheus metrics on this port"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    wsgi.configure(args.config)
+    config = wsgi.app.config
+    wsgi.load_data(args.resourcedir)
+    names = args.wiki or [wiki.name for wiki in wsgi.WIKIS]
+    for name in names:
+        if name not in wsgi.WIKIS:
+            raise SystemExit("Unknown wiki: {0}".format(name))
+        if not wsgi.WIKIS.get(name).overlay_path:
+            raise SystemExit(
+                "The overlay of {0} is in memory: the ingester needs the SQLite one the "
+                "workers share (OVERLAY_PATH)".format(name)
+            )
+    if args.metrics_port:
+        start_http_server(args.metrics_port)
+
+    source = args.source or config.get("INGEST_SOURCE", DEFAULT_INGEST_SOURCE)
+    ingester = Ingester(
+        source,
+        names,
+        config["EDIT_WINDOW"],
+        config.get("INGEST_BATCH_SIZE", DEFAULT_INGEST_BATCH_SIZE),
+        config.get("INGEST_BATCH_SECONDS", DEFAULT_INGEST_BATCH_SECONDS),
+        config.get("INGEST_MAX_PAGES", DEFAULT_INGEST_MAX_PAGES),
+    )
+    if source.startswith(("http://", "https://")):
+        events = read_stream(source, config["CUSTOM_UA"], ingester.position())
+    else:
+        events = read_file(source, ingester.position())
+    print(json.dumps(ingester.run(events), indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Prometheus metrics for where requests spend their time and how much work they do.
+
+Stage durations are histograms labelled by wiki and stage, so a slow request can
+be pinned on checking the user, gathering their new edits, fetching page
+histories or building the response. The work counters (API calls, pages
+fetched, revisions scanned, overlapping users found) divided by the request
+rate give the work done per request. All of these are cheap to update (a lock
+and an addition) and are meant to stay on in production.
+"""
+
+import functools
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# from 1ms to the MediaWiki time budget and beyond
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_SECONDS = Histogram(
+    "similarusers_stage_seconds",
+    "Time spent in each stage of answering a request",
+    ["wiki", "stage"],
+    buckets=STAGE_BUCKETS,
+)
+MW_API_CALLS = Counter(
+    "similarusers_mw_api_calls",
+    "MediaWiki API calls made (each continuation counts)",
+    ["host", "query"],
+)
+PAGES_FETCHED = Counter(
+    "similarusers_pages_fetched", "Page histories fetched from the MediaWiki API", ["wiki"]
+)
+REVISIONS_SCANNED = Counter(
+    "similarusers_revisions_scanned", "Revisions scanned for edits near the user's", ["wiki"]
+)
+OVERLAPPING_USERS = Counter(
+    "similarusers_overlapping_users", "Overlapping users found in page histories", ["wiki"]
+)
+LOAD_SECONDS = Gauge(
+    "similarusers_load_seconds", "Time taken by the last load of a wiki's data", ["wiki"]
+)
+INGEST_EVENTS = Counter(
+    "similarusers_ingest_events",
+    "Revision events read by ingest.py, by what became of them",
+    ["wiki", "outcome"],
+)
+INGEST_LAG = Gauge(
+    "similarusers_ingest_lag_seconds",
+    "Seconds between the newest edit in ingest.py's last batch and when the batch was written",
+    ["wiki"],
+)
+
+
+def stage(name, wiki):
+    """Context manager that times a stage for a wiki: ``with stage("render", "enwiki"): ...``"""
+    return STAGE_SECONDS.labels(wiki, name).time()
+
+
+def timed(name):
+    """Decorator that times a function as a stage, for the wiki of the dataset it is called with first."""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(dataset, *args, **kwargs):
+            with stage(name, dataset.name):
+                return fn(dataset, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def api_call(query, host, n=1):
+    """Count n calls to a MediaWiki API, by the kind of query (e.g. "revisions")."""
+    MW_API_CALLS.labels(host, query).inc(n)
@@ -0,0 +1,377 @@
+"""Pooled, concurrent access to the MediaWiki API.
+
+Every caller in a process shares one keep-alive ``requests`` session per wiki
+(wrapped in ``mwapi.Session``), and per-page revision histories are fetched by a
+bounded pool of threads that gives up once a time budget is spent. Histories can
+be kept in a RevisionCache so that pages shared by several queried users are
+only ever topped up with their newest revisions, and account statuses (bot, anon,
+...) in an AccountStatusCache so they are not looked up on every request.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+import logging
+import sys
+import threading
+import time
+
+import mwapi
+import requests
+from requests.adapters import HTTPAdapter
+
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+_REVISION_CACHES = {}
+_ACCOUNT_CACHES = {}
+
+# account statuses, from list=users
+BOT = "bot"
+ANON = "anon"  # not a valid account name, i.e. an IP address
+MISSING = "missing"
+REGISTERED = "registered"
+
+
+def get_session(host, user_agent, pool_size=10, timeout=None):
+    """Shared mwapi.Session for host, backed by a pooled keep-alive HTTP session."""
+    key = (host, user_agent)
+    with _SESSIONS_LOCK:
+        session = _SESSIONS.get(key)
+        if session is None:
+            http = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            http.mount("https://", adapter)
+            http.mount("http://", adapter)
+            session = mwapi.Session(
+                host, user_agent=user_agent, timeout=timeout, session=http
+            )
+            _SESSIONS[key] = session
+    return session
+
+
+def get_revision_cache(host, max_bytes):
+    """Shared RevisionCache for host (the size of the first call wins)."""
+    with _SESSIONS_LOCK:
+        cache = _REVISION_CACHES.get(host)
+        if cache is None:
+            cache = RevisionCache(max_bytes)
+            _REVISION_CACHES[host] = cache
+    return cache
+
+
+def get_account_cache(host, max_entries, ttl, batch_size):
+    """Shared AccountStatusCache for host (the settings of the first call win)."""
+    with _SESSIONS_LOCK:
+        cache = _ACCOUNT_CACHES.get(host)
+        if cache is None:
+            cache = AccountStatusCache(max_entries, ttl, batch_size)
+            _ACCOUNT_CACHES[host] = cache
+    return cache
+
+
+def drop_caches(host):
+    """Forget the revision and account caches for host, e.g. when its wiki is unloaded."""
+    with _SESSIONS_LOCK:
+        _REVISION_CACHES.pop(host, None)
+        _ACCOUNT_CACHES.pop(host, None)
+
+
+def caches():
+    """(kind, host, cache) for every cache in this process, e.g. to report their hit rates."""
+    with _SESSIONS_LOCK:
+        return [("revisions", host, c) for host, c in _REVISION_CACHES.items()] + [
+            ("account_status", host, c) for host, c in _ACCOUNT_CACHES.items()
+        ]
+
+
+def _revisions_nbytes(revs):
+    """Approximate memory held by a list of revision dicts."""
+    nbytes = sys.getsizeof(revs)
+    for rev in revs:
+        nbytes += sys.getsizeof(rev)
+        for value in rev.values():
+            nbytes += sys.getsizeof(value)
+    return nbytes
+
+
+class RevisionCache(object):
+    """Page histories (oldest first) keyed by (page id, start timestamp), evicted LRU by size.
+
+    Cached lists are never modified in place -- topping up a history replaces it --
+    so callers may keep reading a list after it has been evicted or replaced.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (revisions, nbytes)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, revs):
+        nbytes = _revisions_nbytes(revs)
+        with self._lock:
+            old = self._entries.get(key)
+            if old is not None:
+                if len(old[0]) > len(revs):
+                    # a concurrent fetch of the same page already stored a newer history
+                    return
+                self.nbytes -= old[1]
+                del self._entries[key]
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (revs, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+
+
+def _normalize_user_text(user_text):
+    """The form list=users echoes a name back in (spaces, first letter upper-cased)."""
+    user_text = user_text.replace("_", " ")
+    return user_text[:1].upper() + user_text[1:]
+
+
+def _account_status(user):
+    """Status of one entry of list=users (usprop=groups, formatversion=2)."""
+    if "invalid" in user:
+        return ANON
+    if "missing" in user:
+        return MISSING
+    if "bot" in user.get("groups", []):
+        return BOT
+    return REGISTERED
+
+
+class AccountStatusCache(object):
+    """Account status (BOT, ANON, MISSING or REGISTERED) by user, kept for ttl seconds.
+
+    Users that are not cached are looked up together, in batches of up to
+    ``batch_size`` names per list=users call (50 is the API's limit for clients
+    without the apihighlimits right).
+    """
+
+    def __init__(self, max_entries, ttl, batch_size=50):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.hits = 0
+        self.misses = 0
+        self.api_calls = 0
+        self._entries = OrderedDict()  # user_text -> (status, expires)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, user_text, now):
+        entry = self._entries.get(user_text)
+        if entry is None:
+            return None
+        if entry[1] <= now:
+            del self._entries[user_text]
+            return None
+        self._entries.move_to_end(user_text)
+        return entry[0]
+
+    def _put(self, user_text, status, now):
+        self._entries[user_text] = (status, now + self.ttl)
+        self._entries.move_to_end(user_text)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def lookup(self, session, user_texts):
+        """Dict of user_text -> status; users the API did not answer for are left out."""
+        statuses, misses = self.cached(user_texts)
+        for batch in self.batches(misses):
+            result = session.get(**users_query(batch))
+            instrumentation.api_call("users", session.host)
+            statuses.update(self.store(batch, result))
+        return statuses
+
+    def cached(self, user_texts):
+        """(statuses of the users that are cached, users that have to be looked up)."""
+        statuses = {}
+        misses = []
+        now = time.monotonic()
+        with self._lock:
+            for user_text in dict.fromkeys(user_texts):
+                status = self._get(user_text, now)
+                if status is None:
+                    misses.append(user_text)
+                else:
+                    statuses[user_text] = status
+            self.hits += len(statuses)
+            self.misses += len(misses)
+        return statuses, misses
+
+    def batches(self, user_texts):
+        return [
+            user_texts[i : i + self.batch_size] for i in range(0, len(user_texts), self.batch_size)
+        ]
+
+    def store(self, batch, result):
+        """Cache the statuses in the list=users response for a batch of users, and return them."""
+        answered = {user["name"]: _account_status(user) for user in result["query"]["users"]}
+        statuses = {}
+        now = time.monotonic()
+        with self._lock:
+            self.api_calls += 1
+            for user_text in batch:
+                status = answered.get(user_text)
+                if status is None:
+                    status = answered.get(_normalize_user_text(user_text))
+                if status is not None:
+                    statuses[user_text] = status
+                    self._put(user_text, status, now)
+        return statuses
+
+
+def users_query(user_texts):
+    """list=users query for the account status (groups) of up to 50 users."""
+    return dict(
+        action="query",
+        list="users",
+        ususers="|".join(user_texts),
+        usprop="groups",
+        format="json",
+        formatversion=2,
+    )
+
+
+class Deadline(object):
+    """Point in time after which no more API calls should be started."""
+
+    def __init__(self, seconds=None):
+        self.expires = None if seconds is None else time.monotonic() + seconds
+
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        return self.expires is not None and time.monotonic() >= self.expires
+
+
+def fetch_page_revisions(
+    session, pageids, max_workers, deadline=None, cache=None, **params
+):
+    """Fetch the revision history of each page concurrently (prop=revisions, all continuations).
+
+    Returns ``(revisions, skipped)``: a dict of page id -> list of revisions for the
+    pages fetched completely, and a list of the page ids left out because the
+    deadline passed or their fetch failed.
+
+    With a RevisionCache (and ``rvdir="newer"``), pages already in the cache are
+    only asked for revisions from their newest cached timestamp onwards.
+    """
+    if deadline is None:
+        deadline = Deadline()
+    if params.get("rvdir") != "newer":
+        cache = None
+    stop = threading.Event()
+
+    def fetch(pid):
+        key, cached, fetch_params = cached_history(cache, pid, params)
+        revs = []
+        for r in session.get(
+            action="query", prop="revisions", pageids=pid, continuation=True, **fetch_params
+        ):
+            instrumentation.api_call("revisions", session.host)
+            revs.extend(r["query"]["pages"][0].get("revisions", []))
+            # give up only if another batch is coming: a page fetched completely is kept
+            # (and cached, even once the request has stopped waiting for it)
+            if "continue" in r and (stop.is_set() or deadline.expired()):
+                return None
+        return topped_up_history(cache, key, cached, revs)
+
+    revisions = {}
+    skipped = []
+    if not pageids:
+        return revisions, skipped
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = {executor.submit(fetch, pid): pid for pid in pageids}
+        done, not_done = wait(futures, timeout=deadline.remaining())
+        stop.set()
+        for future in not_done:
+            future.cancel()
+            skipped.append(futures[future])
+        for future in done:
+            pid = futures[future]
+            try:
+                revs = future.result()
+            except Exception as exc:
+                logger.error("Failed to get revisions for page %s: %s", pid, exc)
+                revs = None
+            if revs is None:
+                skipped.append(pid)
+            else:
+                revisions[pid] = revs
+    finally:
+        # don't hold up the request for fetches still in flight -- they stop after
+        # their current API call because `stop` is set
+        executor.shutdown(wait=False)
+    if skipped:
+        logger.warning(
+            "Left out %d of %d pages (time budget or API errors)",
+            len(skipped),
+            len(pageids),
+        )
+    return revisions, skipped
+
+
+def cached_history(cache, pid, params):
+    """(cache key, cached history or None, query parameters for what is missing from it) for a page."""
+    key = (pid, params.get("rvstart"))
+    cached = None if cache is None else cache.get(key)
+    if cached and cached[-1].get("timestamp"):
+        # rvstart is inclusive, so this repeats the revision(s) at that timestamp
+        return key, cached, dict(params, rvstart=cached[-1]["timestamp"])
+    return key, None, params
+
+
+def topped_up_history(cache, key, cached, revs):
+    """The cached history (if any) followed by the revisions fetched since, which are cached together."""
+    if cached is not None:
+        seen = set(
+            rev.get("revid") for rev in cached if rev.get("timestamp") == cached[-1]["timestamp"]
+        )
+        revs = cached + [rev for rev in revs if rev.get("revid") not in seen]
+    if cache is not None:
+        cache.put(key, revs)
+    return revs
+
+
+def edit_window_neighbors(revs, user_text, k):
+    """Users who edited within k revisions of any of user_text's edits in a page history.
+
+    Returned in the order they are first encountered.
+    """
+    neighbors = {}
+    user_edit_indices = [i for i, e in enumerate(revs) if e.get("user") == user_text]
+    for idx in user_edit_indices:
+        for e in revs[max(0, idx - k) : idx + k]:
+            # "user" is missing if the username was suppressed
+            if e.get("user") and e["user"] != user_text:
+                neighbors[e["user"]] = True
+    return list(neighbors)
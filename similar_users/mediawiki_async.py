@@ -0,0 +1,173 @@
+"""Asynchronous access to the MediaWiki API, for the asyncio serving path (aioserver.py).
+
+The counterpart of mediawiki.py for coroutines: each wiki's API is reached
+through one aiohttp connection pool (at most ``max_connections`` connections to
+its host) shared by every request on the event loop, and page histories are
+fetched as concurrent tasks that are cancelled once the time budget is spent,
+or as soon as the request they are for is cancelled. The RevisionCache and
+AccountStatusCache of mediawiki.py are shared with the threaded path.
+"""
+
+import asyncio
+import json
+import logging
+
+import aiohttp
+import mwapi.errors
+
+import instrumentation
+import mediawiki
+
+logger = logging.getLogger(__name__)
+
+_SESSIONS = {}
+
+
+class AsyncSession(object):
+    """GETs against a wiki's api.php, like mwapi.Session.get but awaited.
+
+    Failures are raised as mwapi's errors (APIError for errors the API reports,
+    TimeoutError and ConnectionError for calls that failed), so callers can
+    handle both kinds of session alike.
+    """
+
+    def __init__(self, host, user_agent, http, timeout=None, api_path="/w/api.php"):
+        self.host = host
+        self.api_url = host + api_path
+        self.headers = {"User-Agent": user_agent}
+        self.http = http
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+
+    async def get(self, **params):
+        """The response to one API call (see listing for queries with continuations)."""
+        params = _query_params(params)
+        params["format"] = "json"
+        try:
+            async with self.http.get(
+                self.api_url, params=params, headers=self.headers, timeout=self.timeout
+            ) as response:
+                text = await response.text()
+        except asyncio.TimeoutError as exc:
+            raise mwapi.errors.TimeoutError(str(exc)) from exc
+        except aiohttp.ClientError as exc:
+            raise mwapi.errors.ConnectionError(str(exc)) from exc
+        try:
+            doc = json.loads(text)
+        except ValueError:
+            raise ValueError("Could not decode as JSON:\n{0}".format(text[:350]))
+        if "error" in doc:
+            raise mwapi.errors.APIError.from_doc(doc["error"])
+        return doc
+
+    async def listing(self, **params):
+        """The responses to a query and all its continuations, as an async iterator (mwapi's continuation=True)."""
+        params = dict(params)
+        params.pop("continuation", None)
+        params.setdefault("continue", "")
+        while True:
+            doc = await self.get(**params)
+            yield doc
+            if "continue" not in doc:
+                break
+            # re-send all continue values in the next call
+            params.update(doc["continue"])
+
+
+def _query_params(params):
+    """Query string parameters as mwapi sends them: lists joined with |, True as "" and False/None left out."""
+    query = {}
+    for key, value in params.items():
+        if isinstance(value, bool):
+            value = "" if value else None
+        elif not isinstance(value, str) and hasattr(value, "__iter__"):
+            value = "|".join(str(v) for v in value)
+        if value is not None:
+            query[key] = value if isinstance(value, str) else str(value)
+    return query
+
+
+def get_session(host, user_agent, max_connections, timeout=None):
+    """Shared AsyncSession for host (call from the event loop; the settings of the first call win)."""
+    key = (host, user_agent)
+    session = _SESSIONS.get(key)
+    if session is None:
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=max_connections)
+        session = AsyncSession(
+            host, user_agent, aiohttp.ClientSession(connector=connector), timeout=timeout
+        )
+        _SESSIONS[key] = session
+    return session
+
+
+async def close_sessions():
+    """Close the connection pools of all sessions (when the event loop shuts down)."""
+    sessions = list(_SESSIONS.values())
+    _SESSIONS.clear()
+    for session in sessions:
+        await session.http.close()
+
+
+async def fetch_page_revisions(
+    session, pageids, max_concurrency, deadline=None, cache=None, **params
+):
+    """mediawiki.fetch_page_revisions for an AsyncSession: each page's history is fetched by its own task.
+
+    At most ``max_concurrency`` pages are fetched at once. Returns ``(revisions,
+    skipped)`` like mediawiki.fetch_page_revisions: the fetches still running
+    when the deadline passes are cancelled and their pages skipped. If the
+    caller is cancelled, so are all of them.
+    """
+    if deadline is None:
+        deadline = mediawiki.Deadline()
+    if params.get("rvdir") != "newer":
+        cache = None
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def fetch(pid):
+        async with semaphore:
+            key, cached, fetch_params = mediawiki.cached_history(cache, pid, params)
+            revs = []
+            async for r in session.listing(
+                action="query", prop="revisions", pageids=pid, **fetch_params
+            ):
+                instrumentation.api_call("revisions", session.host)
+                revs.extend(r["query"]["pages"][0].get("revisions", []))
+            return mediawiki.topped_up_history(cache, key, cached, revs)
+
+    revisions = {}
+    skipped = []
+    if not pageids:
+        return revisions, skipped
+    tasks = {asyncio.ensure_future(fetch(pid)): pid for pid in pageids}
+    try:
+        done, not_done = await asyncio.wait(tasks, timeout=deadline.remaining())
+    finally:
+        # out of time, or the request was cancelled
+        for task in tasks:
+            task.cancel()
+    for task in not_done:
+        skipped.append(tasks[task])
+    for task in done:
+        pid = tasks[task]
+        if task.exception() is not None:
+            logger.error("Failed to get revisions for page %s: %s", pid, task.exception())
+            skipped.append(pid)
+        else:
+            revisions[pid] = task.result()
+    if skipped:
+        logger.warning(
+            "Left out %d of %d pages (time budget or API errors)",
+            len(skipped),
+            len(pageids),
+        )
+    return revisions, skipped
+
+
+async def lookup_account_statuses(cache, session, user_texts):
+    """AccountStatusCache.lookup for an AsyncSession: {user_text: status}, left out if the API had no answer."""
+    statuses, misses = cache.cached(user_texts)
+    for batch in cache.batches(misses):
+        result = await session.get(**mediawiki.users_query(batch))
+        instrumentation.api_call("users", session.host)
+        statuses.update(cache.store(batch, result))
+    return statuses
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""Local stand-in for the parts of the MediaWiki API this service calls.
+
+Answers ``list=allrevisions``, ``prop=revisions``, ``list=users`` and
+``list=usercontribs`` (with continuation) from a synthetic, seeded edit history,
+with a configurable delay per call. This makes it possible to exercise
+concurrency and time budgets without hitting Wikipedia:
+
+    python3 mediawiki_stub.py --port 8080 --latency-ms 200
+    # and in flask_config.yaml:
+    MEDIAWIKI_URL: "http://127.0.0.1:8080"
+"""
+
+from bisect import bisect_left
+from datetime import datetime, timedelta
+import argparse
+import random
+import threading
+import time
+
+from flask import Flask, request, jsonify
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+class FakeWiki(object):
+    """Seeded random edit history: who edited which page when."""
+
+    def __init__(
+        self,
+        num_users=1000,
+        num_pages=2000,
+        num_revisions=50000,
+        num_bots=20,
+        num_anons=100,
+        start="2020-10-01T00:00:00Z",
+        days=30,
+        seed=0,
+    ):
+        rnd = random.Random(seed)
+        self.users = ["User{0}".format(i) for i in range(num_users)]
+        self.bots = set("Bot{0}".format(i) for i in range(num_bots))
+        self.anons = [
+            "10.{0}.{1}.{2}".format(i // 65536, (i // 256) % 256, i % 256)
+            for i in range(num_anons)
+        ]
+        editors = self.users + sorted(self.bots) + self.anons
+        start = datetime.strptime(start, TIME_FORMAT)
+        span = days * 24 * 3600
+
+        self.pages = {pid: [] for pid in range(1, num_pages + 1)}
+        for revid in range(1, num_revisions + 1):
+            # a few pages and a few editors account for most of the activity
+            pid = min(num_pages, int(rnd.paretovariate(1.2)))
+            pid = rnd.randint(1, num_pages) if pid == 1 else pid
+            user = editors[min(len(editors) - 1, int(rnd.expovariate(5.0 / len(editors))))]
+            ts = start + timedelta(seconds=rnd.randint(0, span))
+            self.pages[pid].append(
+                {"revid": revid, "timestamp": ts.strftime(TIME_FORMAT), "user": user}
+            )
+        self.contribs = {}
+        for pid, revs in self.pages.items():
+            revs.sort(key=lambda r: (r["timestamp"], r["revid"]))
+            for rev in revs:
+                self.contribs.setdefault(rev["user"], []).append((rev["timestamp"], pid, rev))
+        for revs in self.contribs.values():
+            revs.sort(key=lambda r: (r[0], r[2]["revid"]))
+
+    def page_revisions(self, pid, start, offset, limit):
+        revs = self.pages.get(pid, [])
+        first = bisect_left([r["timestamp"] for r in revs], start) if start else 0
+        chunk = revs[first + offset : first + offset + limit]
+        more = first + offset + limit < len(revs)
+        return chunk, more
+
+    def user_revisions(self, user, start, offset, limit):
+        revs = self.contribs.get(user, [])
+        first = bisect_left([r[0] for r in revs], start) if start else 0
+        chunk = revs[first + offset : first + offset + limit]
+        more = first + offset + limit < len(revs)
+        return chunk, more
+
+    def user_info(self, user):
+        if user in self.anons or user.replace(".", "").isdigit():
+            return {"name": user, "invalid": True}
+        if user in self.bots:
+            return {"userid": 1, "name": user, "groups": ["bot", "*", "user"]}
+        if user in self.contribs:
+            return {"userid": 1, "name": user, "groups": ["*", "user"]}
+        return {"name": user, "missing": True}
+
+
+def create_app(wiki, latency_ms=0, jitter_ms=0, seed=0):
+    app = Flask(__name__)
+    rnd = random.Random(seed)
+    rnd_lock = threading.Lock()
+    app.config["CALLS"] = 0
+
+    @app.route("/w/api.php", methods=["GET", "POST"])
+    def api():
+        params = request.values
+        with rnd_lock:
+            app.config["CALLS"] += 1
+            delay = max(0.0, rnd.gauss(latency_ms, jitter_ms)) / 1000
+        time.sleep(delay)
+        if params.get("action") != "query":
+            return jsonify({"error": {"code": "badvalue", "info": "only action=query"}})
+        if params.get("list") == "allrevisions":
+            return jsonify(_allrevisions(wiki, params))
+        if params.get("prop") == "revisions":
+            return jsonify(_revisions(wiki, params))
+        if params.get("list") == "users":
+            users = params.get("ususers", "").split("|")
+            return jsonify({"query": {"users": [wiki.user_info(u) for u in users]}})
+        if params.get("list") == "usercontribs":
+            return jsonify(_usercontribs(wiki, params))
+        return jsonify({"error": {"code": "badvalue", "info": "unsupported query"}})
+
+    @app.route("/stats", methods=["GET"])
+    def stats():
+        return jsonify({"calls": app.config["CALLS"]})
+
+    return app
+
+
+def _allrevisions(wiki, params):
+    offset = int(params.get("arvcontinue", 0))
+    limit = int(params.get("arvlimit", 500))
+    chunk, more = wiki.user_revisions(
+        params["arvuser"], params.get("arvstart"), offset, limit
+    )
+    pages = []
+    for _, pid, rev in chunk:
+        if not pages or pages[-1]["pageid"] != pid:
+            pages.append({"pageid": pid, "ns": 0, "revisions": []})
+        pages[-1]["revisions"].append(dict(rev, comment=""))
+    doc = {"query": {"allrevisions": pages}}
+    if more:
+        doc["continue"] = {"arvcontinue": str(offset + limit), "continue": "-||"}
+    return doc
+
+
+def _revisions(wiki, params):
+    pid = int(params["pageids"])
+    offset = int(params.get("rvcontinue", 0))
+    limit = int(params.get("rvlimit", 500))
+    chunk, more = wiki.page_revisions(pid, params.get("rvstart"), offset, limit)
+    doc = {"query": {"pages": [{"pageid": pid, "ns": 0, "revisions": chunk}]}}
+    if more:
+        doc["continue"] = {"rvcontinue": str(offset + limit), "continue": "||"}
+    return doc
+
+
+def _usercontribs(wiki, params):
+    limit = int(params.get("uclimit", 500))
+    chunk, _ = wiki.user_revisions(params["ucuser"], params.get("ucstart"), 0, limit)
+    return {
+        "query": {
+            "usercontribs": [
+                {"user": params["ucuser"], "pageid": pid, "timestamp": ts}
+                for ts, pid, _ in chunk
+            ]
+        }
+    }
+
+
+def parse_args():
+    """Parse command line arguments."""
+
+    parser = argparse.ArgumentParser(
+        description="A local stand-in for the MediaWiki API queries made by similarusers"
+    )
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency-ms", type=float, default=0, help="Mean delay per call.")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="Std. dev. of delay.")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--pages", type=int, default=2000)
+    parser.add_argument("--revisions", type=int, default=50000)
+    parser.add_argument("--start", default="2020-10-01T00:00:00Z",
+                        help="Timestamp of the earliest revision (i.e. MOST_RECENT_REV_TS).")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    wiki = FakeWiki(
+        num_users=args.users,
+        num_pages=args.pages,
+        num_revisions=args.revisions,
+        start=args.start,
+        days=args.days,
+        seed=args.seed,
+    )
+    app = create_app(wiki, args.latency_ms, args.jitter_ms, args.seed)
+    app.run("127.0.0.1", args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
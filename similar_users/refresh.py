@@ -0,0 +1,245 @@
+"""Background refreshes of users' data from the MediaWiki API, at most one per user at a time.
+
+A user's refresh (gathering their new edits and updating their co-edit data) is
+queued as a RefreshJob and run by a small pool of worker threads. Asking for a
+user that is already queued or being refreshed returns the existing job, and a
+request that needs the refresh done before it can answer runs it in place of the
+queued job (or waits for the one in progress) rather than starting another.
+Several users can be refreshed together (run_many), e.g. for a batch request,
+still sharing the refreshes already under way for any of them, and a refresh
+can be claimed to run outside the queue's threads (claim, then finish).
+
+SingleFlight does the same for any other call: concurrent calls for the same key
+share the result of the first.
+"""
+
+from collections import OrderedDict
+import logging
+import queue
+import threading
+import time
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshJob(object):
+    def __init__(self, key):
+        self.key = key
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.finished = None  # time.monotonic() when done
+        self.finished_at = None  # TIME_FORMAT when done
+        self._done = threading.Event()
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+
+    def wait(self, timeout=None):
+        """Wait until the job has finished; True unless the timeout passed first."""
+        return self._done.wait(timeout)
+
+    def add_done_callback(self, fn):
+        """Call fn() once the job has finished (on the thread that finishes it), or now if it has."""
+        with self._callbacks_lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn()
+
+    def age(self):
+        """Seconds since the job finished (None if it hasn't)."""
+        if self.finished is None:
+            return None
+        return time.monotonic() - self.finished
+
+    def to_dict(self):
+        return {"status": self.status, "finished": self.finished_at, "error": self.error}
+
+
+class RefreshQueue(object):
+    """De-duplicating job queue that runs ``refresh(key)`` on background threads."""
+
+    def __init__(self, refresh, num_workers=2, max_jobs=10000):
+        self.refresh = refresh
+        self.num_workers = num_workers
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()  # key -> latest RefreshJob
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = []
+
+    def job(self, key):
+        """Latest job for key, or None."""
+        with self._lock:
+            return self._jobs.get(key)
+
+    def pending(self):
+        """Number of jobs waiting for a worker."""
+        return self._queue.qsize()
+
+    def submit(self, key):
+        """Queue a refresh of key unless one is already queued or running. Returns its job."""
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job.status in (QUEUED, RUNNING):
+                return job
+            job = self._add(key, QUEUED)
+            # threads are started on first use so that none exist before uWSGI forks
+            if not self._workers:
+                for i in range(self.num_workers):
+                    worker = threading.Thread(
+                        target=self._work, name="refresh-{0}".format(i), daemon=True
+                    )
+                    worker.start()
+                    self._workers.append(worker)
+        self._queue.put(key)
+        return job
+
+    def run(self, key):
+        """Refresh key in this thread (or wait for the refresh already running) and return its job."""
+        job, claimed = self.claim(key)
+        if not claimed:
+            job.wait()
+            return job
+        self._execute(job)
+        return job
+
+    def claim(self, key):
+        """Take on the refresh of key, to run it elsewhere (e.g. in a coroutine) and then finish its job.
+
+        Returns ``(job, claimed)``: claimed is False if key is already being
+        refreshed, in which case wait for that job instead.
+        """
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job.status == RUNNING:
+                return job, False
+            if job is not None and job.status == QUEUED:
+                # take it over -- the worker skips jobs that are no longer queued
+                job.status = RUNNING
+            else:
+                job = self._add(key, RUNNING)
+            return job, True
+
+    def run_many(self, keys, refresh_many):
+        """Refresh several keys together in this thread and return their jobs ({key: job}).
+
+        ``refresh_many(keys)`` gets the keys that are not already being refreshed
+        and returns {key: result}; keys being refreshed elsewhere are waited for
+        instead, and queued ones are taken over.
+        """
+        jobs = OrderedDict()
+        claimed = []
+        with self._lock:
+            for key in keys:
+                if key in jobs:
+                    continue
+                job = self._jobs.get(key)
+                if job is None or job.status != RUNNING:
+                    if job is not None and job.status == QUEUED:
+                        job.status = RUNNING
+                    else:
+                        job = self._add(key, RUNNING)
+                    claimed.append(job)
+                jobs[key] = job
+        if claimed:
+            try:
+                results = refresh_many([job.key for job in claimed])
+            except Exception as exc:
+                logger.exception("Refresh of %s failed", ", ".join(map(str, jobs)))
+                for job in claimed:
+                    self.finish(job, error=str(exc))
+            else:
+                for job in claimed:
+                    self.finish(job, result=results.get(job.key))
+        for job in jobs.values():
+            job.wait()
+        return jobs
+
+    def forget_finished(self):
+        """Drop finished jobs, e.g. once the data they refreshed has been replaced."""
+        with self._lock:
+            for key in [k for k, job in self._jobs.items() if job.status in (DONE, FAILED)]:
+                del self._jobs[key]
+
+    def _add(self, key, status):
+        job = RefreshJob(key)
+        job.status = status
+        self._jobs.pop(key, None)
+        self._jobs[key] = job
+        # forget the oldest finished jobs
+        while len(self._jobs) > self.max_jobs:
+            oldest_key, oldest = next(iter(self._jobs.items()))
+            if oldest.status in (QUEUED, RUNNING):
+                break
+            del self._jobs[oldest_key]
+        return job
+
+    def _work(self):
+        while True:
+            key = self._queue.get()
+            with self._lock:
+                job = self._jobs.get(key)
+                if job is None or job.status != QUEUED:
+                    continue
+                job.status = RUNNING
+            self._execute(job)
+
+    def _execute(self, job):
+        try:
+            result = self.refresh(job.key)
+        except Exception as exc:
+            logger.exception("Refresh of %s failed", job.key)
+            self.finish(job, error=str(exc))
+        else:
+            self.finish(job, result=result)
+
+    def finish(self, job, result=None, error=None):
+        """Record the outcome of a job and wake whoever waits for it."""
+        job.result = result
+        job.error = error
+        job.status = DONE if error is None else FAILED
+        job.finished = time.monotonic()
+        job.finished_at = time.strftime(TIME_FORMAT, time.gmtime())
+        with job._callbacks_lock:
+            job._done.set()
+            callbacks, job._callbacks = job._callbacks, []
+        for fn in callbacks:
+            fn()
+
+
+class SingleFlight(object):
+    """Runs ``fn()`` for a key at most once at a time: concurrent calls for the key share its result."""
+
+    def __init__(self):
+        self._calls = {}  # key -> [done event, result, exception]
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = [threading.Event(), None, None]
+        if not leader:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+        try:
+            call[1] = fn()
+        except Exception as exc:
+            call[2] = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call[0].set()
+        return call[1]
@@ -0,0 +1,100 @@
+"""Cache of finished /similarusers responses.
+
+A response is kept per (user, followup, ranking) along with the version of the user's
+data it was built from (their most recent edit and co-edit list, and the
+snapshot). A cached response for k neighbors also answers any smaller k. For
+``ttl`` seconds after it was last validated a response is served without
+checking the MediaWiki API for new edits at all; after that it is served only if
+the refreshed data still has the same version.
+"""
+
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+
+
+class CachedResponse(object):
+    """A response built for up to `k` neighbors and the data version it reflects."""
+
+    def __init__(self, user_text, k, followup, version, result, ranking=None):
+        self.user_text = user_text
+        self.k = k
+        self.followup = followup
+        self.ranking = ranking
+        self.version = version
+        self.result = result
+        self.validated = time.monotonic()
+        self._bodies = {}  # k -> (etag, JSON)
+
+    def covers(self, k):
+        # fewer results than asked for means there were no more neighbors
+        return k <= self.k or len(self.result["results"]) < self.k
+
+    def body(self, k, render):
+        """(etag, body) of the response for k neighbors.
+
+        ``render(result, k)`` serializes the cached result cut down to k neighbors;
+        it is only called the first time each k is asked for.
+        """
+        cached = self._bodies.get(k)
+        if cached is None:
+            etag = hashlib.sha1(
+                repr((self.user_text, k, self.followup, self.ranking, self.version)).encode("utf-8")
+            ).hexdigest()
+            cached = (etag, render(self.result, k))
+            self._bodies[k] = cached
+        return cached
+
+
+class ResponseCache(object):
+    """LRU cache of CachedResponse by (user_text, followup, ranking)."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_text, k, followup, ranking=None):
+        """Cached response that can answer k (possibly needing revalidation), or None."""
+        key = (user_text, followup, ranking)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or not entry.covers(k):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def is_fresh(self, entry):
+        return time.monotonic() - entry.validated < self.ttl
+
+    def validate(self, entry):
+        """Mark a response as checked against the latest data."""
+        entry.validated = time.monotonic()
+
+    def put(self, user_text, k, followup, version, result, ranking=None):
+        entry = CachedResponse(user_text, k, followup, version, result, ranking)
+        key = (user_text, followup, ranking)
+        with self._lock:
+            old = self._entries.get(key)
+            if old is not None and old.version == version and old.k > k:
+                # keep the larger response -- it answers this k too
+                self.validate(old)
+                return old
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
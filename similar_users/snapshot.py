@@ -0,0 +1,334 @@
+"""Compact on-disk snapshot of the co-edit, temporal and metadata dumps.
+
+The TSVs produced by the PySpark notebooks are compiled once (see
+compile_snapshot.py) into a directory of flat numpy arrays that are opened with mmap, so every uWSGI worker shares the
+same page-cache copy instead of holding its own dicts of tuples:
+
+* users are identified by their position in a sorted table of UTF-8 names
+  (``names_offsets`` / ``names_blob``)
+* ``COEDIT_DATA`` is stored CSR-style: the neighbors of user ``i`` are
+  ``coedit_neighbors[coedit_indptr[i]:coedit_indptr[i + 1]]`` with the matching
+  ``coedit_overlap`` counts, ranked by overlap and then by fewest pages edited
+* the reverse index (``reverse_*``) has the same lists the other way round:
+  ``reverse_users[reverse_indptr[i]:reverse_indptr[i + 1]]`` are the users who
+  list user ``i``, with its rank in their list (``reverse_rank``) and their
+  overlap, closest (lowest rank) first
+* ``TEMPORAL_DATA`` is a dense ``num_users x 31`` matrix -- 7 days-of-week
+  followed by 24 hours-of-day, already smeared by ``TEMPORAL_OFFSET`` -- plus
+  the norms of each row's day and hour parts for cosine similarity
+* ``USER_METADATA`` is columnar, with timestamps as seconds since the epoch
+* ``tindex_*`` is a nearest-neighbor index of the temporal data (see
+  temporal_index.py)
+
+``meta.json`` records the format version, the SHA-256 of every array file and
+what the snapshot was built from.
+"""
+
+from bisect import bisect_left
+from datetime import datetime, timezone
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+FORMAT_VERSION = 3
+META_FILE = "meta.json"
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+NUM_DAYS = 7
+NUM_HOURS = 24
+TEMPORAL_DIMS = NUM_DAYS + NUM_HOURS
+
+NO_TIMESTAMP = -1
+FLAG_HAS_METADATA = 1
+FLAG_IS_ANON = 2
+
+ARRAYS = (
+    "names_offsets",
+    "names_blob",
+    "coedit_indptr",
+    "coedit_neighbors",
+    "coedit_overlap",
+    "temporal",
+    "temporal_norms",
+    "meta_flags",
+    "meta_num_edits",
+    "meta_num_pages",
+    "meta_most_recent_edit",
+    "meta_oldest_edit",
+)
+# written by compile_snapshot.py since the reverse index was added; built at load time if missing
+REVERSE_ARRAYS = ("reverse_indptr", "reverse_users", "reverse_overlap", "reverse_rank")
+# likewise for the temporal nearest-neighbor index (see temporal_index.py)
+TEMPORAL_INDEX_ARRAYS = ("tindex_centroids", "tindex_indptr", "tindex_users", "tindex_vectors")
+OPTIONAL_ARRAYS = REVERSE_ARRAYS + TEMPORAL_INDEX_ARRAYS
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def timestamp_to_epoch(ts):
+    """Convert a TIME_FORMAT string to seconds since the epoch (NO_TIMESTAMP if missing)."""
+    if not ts:
+        return NO_TIMESTAMP
+    try:
+        dt = datetime.strptime(ts, TIME_FORMAT)
+    except ValueError:
+        return NO_TIMESTAMP
+    return int(dt.replace(tzinfo=timezone.utc).timestamp())
+
+
+def epoch_to_timestamp(epoch):
+    """Convert seconds since the epoch back to a TIME_FORMAT string (None if missing)."""
+    if epoch == NO_TIMESTAMP:
+        return None
+    return time.strftime(TIME_FORMAT, time.gmtime(int(epoch)))
+
+
+def smear_temporal(counts, day, hour, num_edits, offsets):
+    """Add edits at (day, hour) to a dense day/hour vector, smeared over nearby hours."""
+    for offset in offsets:
+        h = hour + offset  # -1 to 24
+        d = (day + (h // 24)) % NUM_DAYS
+        h = h % NUM_HOURS
+        counts[d] += num_edits
+        counts[NUM_DAYS + h] += num_edits
+    return counts
+
+
+def temporal_norms(counts):
+    """Euclidean norms of the day and hour parts of one or more day/hour vectors."""
+    counts = np.asarray(counts, dtype=np.float64)
+    return np.stack(
+        [
+            np.sqrt(np.einsum("...i,...i", counts[..., :NUM_DAYS], counts[..., :NUM_DAYS])),
+            np.sqrt(np.einsum("...i,...i", counts[..., NUM_DAYS:], counts[..., NUM_DAYS:])),
+        ],
+        axis=-1,
+    )
+
+
+class _SortedNames(object):
+    """Sequence view over the sorted name table so it can be binary-searched in place."""
+
+    def __init__(self, offsets, blob):
+        self._offsets = offsets
+        self._blob = blob
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        return self._blob[self._offsets[i] : self._offsets[i + 1]].tobytes()
+
+
+class Snapshot(object):
+    """Read-only, memory-mapped view of a compiled snapshot directory."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE), "r") as fin:
+            self.meta = json.load(fin)
+        if self.meta.get("format_version") != FORMAT_VERSION:
+            raise SnapshotError(
+                "Snapshot at {0} has format version {1} but {2} is required -- "
+                "recompile it with compile_snapshot.py.".format(
+                    path, self.meta.get("format_version"), FORMAT_VERSION
+                )
+            )
+        for name in ARRAYS + OPTIONAL_ARRAYS:
+            if name in ARRAYS or name in self.meta["checksums"]:
+                setattr(
+                    self,
+                    name,
+                    np.load(os.path.join(path, name + ".npy"), mmap_mode="r"),
+                )
+        if REVERSE_ARRAYS[0] not in self.meta["checksums"]:
+            logger.warning(
+                "Snapshot at %s has no reverse index -- building it in memory "
+                "(recompile the snapshot to have it precomputed)",
+                path,
+            )
+            for name, array in reverse_index(
+                self.coedit_indptr, self.coedit_neighbors, self.coedit_overlap
+            ).items():
+                setattr(self, name, array)
+        self._names = _SortedNames(self.names_offsets, self.names_blob)
+        # identifies the snapshot, e.g. for an overlay to know which one it is relative to
+        self.id = hashlib.sha1(
+            json.dumps(self.meta, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    @property
+    def num_users(self):
+        return len(self._names)
+
+    @property
+    def nbytes(self):
+        """Total size of the arrays, i.e. how much of the page cache the snapshot can take up."""
+        return sum(
+            getattr(self, name).nbytes
+            for name in ARRAYS + OPTIONAL_ARRAYS
+            if hasattr(self, name)
+        )
+
+    @property
+    def temporal_offset(self):
+        return tuple(self.meta["temporal_offset"])
+
+    def user_id(self, user_text):
+        """Position of user_text in the name table, or None if it is not in the snapshot."""
+        key = user_text.encode("utf-8")
+        i = bisect_left(self._names, key)
+        if i < len(self._names) and self._names[i] == key:
+            return i
+        return None
+
+    def user_text(self, uid):
+        return self._names[uid].decode("utf-8")
+
+    def has_metadata(self, uid):
+        return bool(self.meta_flags[uid] & FLAG_HAS_METADATA)
+
+    def metadata(self, uid):
+        """USER_METADATA-style dict for a user, or None if the dump has no metadata row."""
+        flags = int(self.meta_flags[uid])
+        if not flags & FLAG_HAS_METADATA:
+            return None
+        return {
+            "is_anon": bool(flags & FLAG_IS_ANON),
+            "num_edits": int(self.meta_num_edits[uid]),
+            "num_pages": int(self.meta_num_pages[uid]),
+            "most_recent_edit": epoch_to_timestamp(self.meta_most_recent_edit[uid]),
+            "oldest_edit": epoch_to_timestamp(self.meta_oldest_edit[uid]),
+        }
+
+    def num_pages(self, uid):
+        if not self.meta_flags[uid] & FLAG_HAS_METADATA:
+            return None
+        return int(self.meta_num_pages[uid])
+
+    def neighbors(self, uid):
+        """Neighbor ids and overlap counts for a user, most similar first (views into the mmap)."""
+        start = self.coedit_indptr[uid]
+        end = self.coedit_indptr[uid + 1]
+        return self.coedit_neighbors[start:end], self.coedit_overlap[start:end]
+
+    def listed_by(self, uid):
+        """Ids of the users who list uid among their neighbors, with their overlap and uid's rank in their list.
+
+        Closest (lowest rank, then most overlap) first; views into the mmap.
+        """
+        start = self.reverse_indptr[uid]
+        end = self.reverse_indptr[uid + 1]
+        return (
+            self.reverse_users[start:end],
+            self.reverse_overlap[start:end],
+            self.reverse_rank[start:end],
+        )
+
+    def verify_checksums(self):
+        """Raise SnapshotError if any array file does not match the checksum in meta.json."""
+        for name in sorted(self.meta["checksums"]):
+            expected = self.meta["checksums"][name]
+            actual = file_checksum(os.path.join(self.path, name + ".npy"))
+            if actual != expected:
+                raise SnapshotError(
+                    "Checksum mismatch for {0} in snapshot at {1}".format(
+                        name, self.path
+                    )
+                )
+
+
+def reverse_index(indptr, neighbors, overlap):
+    """The REVERSE_ARRAYS for the co-edit lists given as CSR arrays (see the module docstring)."""
+    num_users = len(indptr) - 1
+    lengths = np.diff(indptr)
+    users = np.repeat(np.arange(num_users, dtype=np.int32), lengths)
+    ranks = np.arange(len(neighbors), dtype=np.int64) - np.repeat(indptr[:-1], lengths)
+    order = np.lexsort((users, -np.asarray(overlap, dtype=np.int64), ranks, neighbors))
+    reverse_indptr = np.zeros(num_users + 1, dtype=np.int64)
+    np.cumsum(np.bincount(neighbors, minlength=num_users), out=reverse_indptr[1:])
+    return {
+        "reverse_indptr": reverse_indptr,
+        "reverse_users": users[order],
+        "reverse_overlap": np.asarray(overlap, dtype=np.int32)[order],
+        "reverse_rank": ranks[order].astype(np.int32),
+    }
+
+
+def file_checksum(path, block_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, "rb") as fin:
+        for block in iter(lambda: fin.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def write_snapshot(snapshot_dir, arrays, meta):
+    """Write arrays + meta.json to a temporary directory and move it into place.
+
+    Several workers may race to build the same snapshot; whichever rename lands
+    first wins and the others are discarded.
+    """
+    parent = os.path.dirname(os.path.abspath(snapshot_dir))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=".snapshot-", dir=parent)
+    try:
+        checksums = {}
+        for name in ARRAYS + OPTIONAL_ARRAYS:
+            if name not in arrays:
+                continue
+            path = os.path.join(tmp_dir, name + ".npy")
+            np.save(path, arrays[name])
+            checksums[name] = file_checksum(path)
+        meta = dict(meta)
+        meta.update(
+            {
+                "format_version": FORMAT_VERSION,
+                "num_users": len(arrays["names_offsets"]) - 1,
+                "created": time.strftime(TIME_FORMAT, time.gmtime()),
+                "checksums": checksums,
+            }
+        )
+        with open(os.path.join(tmp_dir, META_FILE), "w") as fout:
+            json.dump(meta, fout, indent=2, sort_keys=True)
+        os.chmod(tmp_dir, 0o755)
+        try:
+            os.rename(tmp_dir, snapshot_dir)
+        except OSError:
+            if not os.path.exists(os.path.join(snapshot_dir, META_FILE)):
+                raise
+            logger.info("Snapshot %s already written by another process", snapshot_dir)
+    finally:
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+
+
+def install_snapshot(snapshot_dir, link):
+    """Atomically point the symlink ``link`` (e.g. resources/snapshot) at snapshot_dir.
+
+    Running services notice the change and switch over (see reload_data in
+    wsgi.py). A snapshot directory already at ``link``, as written before
+    snapshots were installed this way, is first moved aside to
+    ``<link>-<created>`` so that it can still be switched back to.
+    """
+    Snapshot(snapshot_dir)  # refuse anything that can't be loaded
+    link = os.path.abspath(link)
+    if os.path.realpath(snapshot_dir) == os.path.realpath(link):
+        return
+    if os.path.isdir(link) and not os.path.islink(link):
+        with open(os.path.join(link, META_FILE), "r") as fin:
+            created = json.load(fin).get("created", "old")
+        os.rename(link, "{0}-{1}".format(link, created.replace(":", "")))
+    tmp_link = "{0}.{1}.tmp".format(link, os.getpid())
+    os.symlink(os.path.relpath(os.path.abspath(snapshot_dir), os.path.dirname(link)), tmp_link)
+    os.replace(tmp_link, link)
@@ -0,0 +1,178 @@
+"""Nearest-neighbor search over every user's temporal fingerprint (when in the week and day they edit).
+
+A user's fingerprint is their day-of-week and hour-of-day vectors, each scaled to
+unit length and joined (times 1/sqrt(2), so it has unit length itself): the dot
+product of two fingerprints is the mean of the day and the hour cosine
+similarities that /similarusers reports for co-editors.
+
+The index is an inverted file over a spherical k-means clustering of the
+fingerprints: users are grouped into lists by their closest centroid, and a
+search only scans the lists whose centroids are closest to the query. It is
+built by compile_snapshot.py and stored in the snapshot (the ``tindex_*``
+arrays, with the fingerprints as float16 in list order so each list is one
+contiguous block), so searching millions of users touches a few thousand rows.
+"""
+
+import logging
+import math
+import time
+
+import numpy as np
+
+from snapshot import NUM_DAYS, TEMPORAL_INDEX_ARRAYS
+
+DEFAULT_PROBES = 32  # lists scanned per search (more for better recall, fewer for speed)
+KMEANS_ITERATIONS = 8
+KMEANS_SAMPLE_PER_LIST = 32
+ASSIGN_CHUNK_ROWS = 65536
+
+logger = logging.getLogger(__name__)
+
+
+def fingerprints(counts, norms):
+    """Unit-length float32 fingerprints for rows of day/hour counts and their (day, hour) norms."""
+    counts = np.asarray(counts, dtype=np.float32)
+    norms = np.array(norms, dtype=np.float32)
+    norms[norms == 0] = 1
+    result = np.empty(counts.shape, dtype=np.float32)
+    result[..., :NUM_DAYS] = counts[..., :NUM_DAYS] / norms[..., 0:1]
+    result[..., NUM_DAYS:] = counts[..., NUM_DAYS:] / norms[..., 1:2]
+    result *= np.float32(1 / math.sqrt(2))
+    return result
+
+
+def _assign(vectors, centroids):
+    """Index of the closest centroid for each vector."""
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for i in range(0, len(vectors), ASSIGN_CHUNK_ROWS):
+        chunk = np.asarray(vectors[i : i + ASSIGN_CHUNK_ROWS], dtype=np.float32)
+        assignment[i : i + ASSIGN_CHUNK_ROWS] = (chunk @ centroids.T).argmax(axis=1)
+    return assignment
+
+
+def build(temporal, temporal_norms, num_lists=None, seed=0):
+    """The TEMPORAL_INDEX_ARRAYS for a snapshot's temporal matrix and norms.
+
+    Users who have no temporal data are left out (if none have any, the index
+    has no lists). num_lists defaults to about twice the square root of the
+    number of users.
+    """
+    start = time.time()
+    nonzero = np.flatnonzero(np.asarray(temporal_norms).any(axis=1))
+    vectors = np.empty((len(nonzero), temporal.shape[1]), dtype=np.float32)
+    for i in range(0, len(nonzero), ASSIGN_CHUNK_ROWS):
+        rows = nonzero[i : i + ASSIGN_CHUNK_ROWS]
+        vectors[i : i + len(rows)] = fingerprints(temporal[rows], temporal_norms[rows])
+    if len(vectors) == 0:
+        logger.info("No users with temporal data -- the temporal index is empty")
+        return {
+            "tindex_centroids": np.zeros((0, temporal.shape[1]), dtype=np.float32),
+            "tindex_indptr": np.zeros(1, dtype=np.int64),
+            "tindex_users": np.zeros(0, dtype=np.int32),
+            "tindex_vectors": np.zeros((0, temporal.shape[1]), dtype=np.float16),
+        }
+    if num_lists is None:
+        num_lists = int(2 * math.sqrt(len(vectors)))
+    num_lists = max(1, min(num_lists, len(vectors)))
+
+    # spherical k-means on a sample: centroids are unit-length means of their members
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), num_lists * KMEANS_SAMPLE_PER_LIST)
+    sample = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    centroids = sample[rng.choice(len(sample), num_lists, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assignment = _assign(sample, centroids)
+        sums = np.stack(
+            [
+                np.bincount(assignment, weights=sample[:, d], minlength=num_lists)
+                for d in range(sample.shape[1])
+            ],
+            axis=1,
+        )
+        lengths = np.linalg.norm(sums, axis=1)
+        # lists that got no members keep their old centroid
+        filled = lengths > 0
+        centroids[filled] = (sums[filled] / lengths[filled, None]).astype(np.float32)
+
+    assignment = _assign(vectors, centroids)
+    order = np.argsort(assignment, kind="stable")
+    indptr = np.zeros(num_lists + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assignment, minlength=num_lists), out=indptr[1:])
+    logger.info(
+        "Built temporal index of %d users in %d lists in %.1fs",
+        len(vectors),
+        num_lists,
+        time.time() - start,
+    )
+    return {
+        "tindex_centroids": centroids.astype(np.float32),
+        "tindex_indptr": indptr,
+        "tindex_users": nonzero[order].astype(np.int32),
+        "tindex_vectors": vectors[order].astype(np.float16),
+    }
+
+
+class TemporalIndex(object):
+    """Search over a snapshot's tindex_* arrays (see build)."""
+
+    def __init__(self, centroids, indptr, users, vectors):
+        self.centroids = centroids
+        self.indptr = indptr
+        self.users = users
+        self.vectors = vectors
+
+    @classmethod
+    def for_snapshot(cls, data_snapshot):
+        """The snapshot's index, built in memory if it was compiled without one."""
+        if not hasattr(data_snapshot, TEMPORAL_INDEX_ARRAYS[0]):
+            logger.warning(
+                "Snapshot at %s has no temporal index -- building it in memory "
+                "(recompile the snapshot to have it precomputed)",
+                data_snapshot.path,
+            )
+            for name, array in build(
+                data_snapshot.temporal, data_snapshot.temporal_norms
+            ).items():
+                setattr(data_snapshot, name, array)
+        return cls(*(getattr(data_snapshot, name) for name in TEMPORAL_INDEX_ARRAYS))
+
+    def search(self, query, k, accept=None, probes=DEFAULT_PROBES):
+        """(uids, scores) of the k users whose fingerprints are closest to query, best first.
+
+        accept(uids) -> boolean mask can rule users out (e.g. by metadata). The
+        ``probes`` lists closest to the query are scanned, and then more, a batch
+        of ``probes`` at a time, until k users have been accepted or every list
+        has been scanned -- so a narrow filter still gets its k users.
+        """
+        if len(self.centroids) == 0:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+        query = np.asarray(query, dtype=np.float32)
+        order = np.argsort(-(self.centroids @ query))
+        found_uids = []
+        found_scores = []
+        num_found = 0
+        for first in range(0, len(order), max(1, probes)):
+            lists = order[first : first + probes]
+            starts = self.indptr[lists]
+            ends = self.indptr[lists + 1]
+            rows = np.concatenate(
+                [np.arange(s, e) for s, e in zip(starts, ends)] or [np.zeros(0, dtype=np.int64)]
+            )
+            uids = np.asarray(self.users[rows])
+            if accept is not None and len(uids):
+                mask = accept(uids)
+                rows = rows[mask]
+                uids = uids[mask]
+            scores = np.asarray(self.vectors[rows], dtype=np.float32) @ query
+            found_uids.append(uids)
+            found_scores.append(scores)
+            num_found += len(uids)
+            if num_found >= k:
+                break
+        uids = np.concatenate(found_uids) if found_uids else np.zeros(0, dtype=np.int32)
+        scores = np.concatenate(found_scores) if found_scores else np.zeros(0, dtype=np.float32)
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            uids, scores = uids[top], scores[top]
+        best = np.argsort(-scores, kind="stable")
+        return uids[best], scores[best]
@@ -0,0 +1,170 @@
+"""The wikis one deployment serves, each with its own data loaded the first time it is asked for.
+
+A Wiki holds what lasts for the life of the process: where its data is, its
+API host, its overlay, its cached responses and refresh queue. Its Dataset --
+the memory-mapped snapshot merged with the overlay, and the period the
+snapshot covers -- is loaded on first use and replaced as a whole when a new
+snapshot is installed, so a request keeps the dataset it started with.
+
+The WikiRegistry keeps the datasets of all loaded wikis within a memory budget:
+when loading one takes them over it, the least recently used wikis are unloaded
+(except pinned ones, i.e. the default wiki) until they fit again. A wiki that
+nobody asks for costs no more than its entry in the registry.
+"""
+
+from collections import OrderedDict
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# titles used in messages for wikis that don't configure one
+DEFAULT_TITLES = {"enwiki": "English Wikipedia"}
+
+
+def lang_of(name):
+    """Language code of a Wikipedia's database name, e.g. "en" for "enwiki"."""
+    if name.endswith("wiki"):
+        return name[: -len("wiki")].replace("_", "-")
+    return name
+
+
+def load_status(status):
+    return {"status": status, "stage": None, "started": None, "finished": None, "error": None}
+
+
+class Dataset(object):
+    """One load of a wiki's data: a UserStore and the period its snapshot covers."""
+
+    def __init__(self, wiki, data, most_recent_rev_ts, earliest_ts):
+        self.wiki = wiki
+        self.name = wiki.name
+        self.data = data
+        self.most_recent_rev_ts = most_recent_rev_ts
+        self.earliest_ts = earliest_ts
+
+    @property
+    def nbytes(self):
+        """Size of the snapshot arrays (what the dataset adds to memory once it is in use)."""
+        if self.data.snapshot is None:
+            return 0
+        return self.data.snapshot.nbytes
+
+
+class Wiki(object):
+    """A wiki served: where its data is, its API host, and its caches (its Dataset is loaded on demand)."""
+
+    def __init__(
+        self,
+        name,
+        lang,
+        resource_dir,
+        host,
+        title=None,
+        overlay_path=None,
+        pinned=False,
+        most_recent_rev_ts=None,
+        earliest_ts=None,
+    ):
+        self.name = name
+        self.lang = lang
+        self.resource_dir = resource_dir
+        self.host = host
+        self.title = title or DEFAULT_TITLES.get(name, name)
+        self.overlay_path = overlay_path  # None keeps the overlay in memory
+        self.pinned = pinned
+        # the period of the dumps, for snapshots that don't record it
+        self.most_recent_rev_ts = most_recent_rev_ts
+        self.earliest_ts = earliest_ts
+        self.overlay = None  # created with the first dataset and kept when it is unloaded
+        self.dataset = None
+        self.responses = None
+        self.refreshes = None
+        self.load_status = load_status("not loaded")
+        self.next_snapshot_check = 0
+        # held while the dataset is loaded or replaced
+        self.lock = threading.Lock()
+
+
+class WikiRegistry(object):
+    """Wikis by name; ``dataset(name)`` loads a wiki with ``load(wiki)`` on first use."""
+
+    def __init__(self, load, default, max_bytes=0, unload=None):
+        self.load = load
+        self.default = default
+        self.max_bytes = max_bytes  # 0 for no limit
+        self.on_unload = unload
+        self._wikis = OrderedDict()  # least recently used first
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self._wikis
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._wikis.values()))
+
+    def add(self, wiki):
+        self._wikis[wiki.name] = wiki
+
+    def get(self, name):
+        return self._wikis[name]
+
+    def loaded(self):
+        """Wikis whose dataset is loaded, least recently used first."""
+        return [wiki for wiki in self if wiki.dataset is not None]
+
+    def nbytes(self):
+        return sum(dataset.nbytes for dataset in (w.dataset for w in self) if dataset is not None)
+
+    def dataset(self, name):
+        """Current dataset of a wiki, loading it (and unloading others to make room) if need be."""
+        wiki = self._wikis[name]
+        dataset = wiki.dataset
+        if dataset is None:
+            with wiki.lock:
+                if wiki.dataset is None:
+                    wiki.dataset = self.load(wiki)
+                dataset = wiki.dataset
+            self._touch(wiki)
+            self.evict(keep=wiki)
+        else:
+            self._touch(wiki)
+        return dataset
+
+    def evict(self, keep=None):
+        """Unload least recently used wikis until the loaded ones fit in max_bytes."""
+        if not self.max_bytes:
+            return
+        total = self.nbytes()
+        for wiki in self.loaded():
+            if total <= self.max_bytes:
+                break
+            if wiki is keep or wiki.pinned:
+                continue
+            dataset = wiki.dataset
+            if dataset is None:
+                continue
+            total -= dataset.nbytes
+            self.unload(wiki)
+        if total > self.max_bytes:
+            logger.warning(
+                "Loaded wikis take %d MB, more than the %d MB budget",
+                total // 2 ** 20,
+                self.max_bytes // 2 ** 20,
+            )
+
+    def unload(self, wiki):
+        """Drop a wiki's dataset and cached responses; it is loaded again when next asked for."""
+        with wiki.lock:
+            if wiki.dataset is None:
+                return
+            logger.warning("Unloading %s to stay within the memory budget", wiki.name)
+            wiki.dataset = None
+            wiki.load_status = load_status("unloaded")
+        if self.on_unload is not None:
+            self.on_unload(wiki)
+
+    def _touch(self, wiki):
+        with self._lock:
+            self._wikis.move_to_end(wiki.name)
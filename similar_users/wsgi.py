@@ -1,20 +1,35 @@
 #!/usr/bin/env python3
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from ast import literal_eval as make_tuple
 import argparse
-import distutils.util
+import functools
+import gc
 import logging
 import os
 import pathlib
+import resource
+import time
+import tracemalloc
 
-import mwapi
+import numpy as np
 import yaml
-from flask import Flask, request, jsonify, render_template, abort
+from flask import Flask, request, jsonify, render_template, abort, g
 from flask_basicauth import BasicAuth
 from flask_cors import CORS
+from prometheus_client.core import REGISTRY, CounterMetricFamily, GaugeMetricFamily
 from prometheus_flask_exporter import PrometheusMetrics
-from sklearn.metrics.pairwise import cosine_similarity
+
+import compile_snapshot
+import datastore
+import instrumentation
+import mediawiki
+import refresh
+import response_cache
+import snapshot
+import wikis
 
 app = Flask(__name__)
 
@@ -28,21 +43,82 @@ cors = CORS(app, resources={r"/api/*": {"origins": "*"}})
 # Local: http://127.0.0.1:5000/similarusers?usertext=Ziyingjiang
 # VPS: https://spd-test.wmcloud.org/similarusers?usertext=Bttowadch&k=50
 
-# Data dictionaries -- TODO: move to sqllitedict or something equivalent
-# Currently used for both READ and WRITE though
-USER_METADATA = {}  # is_anon; num_edits; num_pages; most_recent_edit; oldest_edit
-COEDIT_DATA = {}
-TEMPORAL_DATA = {}
+# USER_METADATA (is_anon; num_edits; num_pages; most_recent_edit; oldest_edit),
+# COEDIT_DATA and TEMPORAL_DATA -- read from a memory-mapped snapshot of the dumps of each wiki,
+# loaded the first time the wiki is queried (see wikis.py)
+# Currently used for both READ and WRITE though: new edits are kept in an overlay,
+# by default in a SQLite database shared by all workers (see OVERLAY_PATH)
+WIKIS = None
+# checks of users who are not in the data yet that are under way (see validate_user_text)
+USER_CHECKS = refresh.SingleFlight()
 
 # TODO: Make all of these configuration options
 DEFAULT_K = 50
-TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+TIME_FORMAT = snapshot.TIME_FORMAT
 READABLE_TIME_FORMAT = "%Y-%m-%d %H:%M:%S UTC"
 URL_PREFIX = "https://spd-test.wmcloud.org/similarusers"
-EDITORINTERACT_URL = "https://sigma.toolforge.org/editorinteract.py?users={0}&users={1}&users=&startdate=&enddate=&ns=&server=enwiki&allusers=on"
+EDITORINTERACT_URL = "https://sigma.toolforge.org/editorinteract.py?users={0}&users={1}&users=&startdate=&enddate=&ns=&server={wiki}&allusers=on"
 INTERACTIONTIMELINE_URL = (
-    "https://interaction-timeline.toolforge.org/?wiki=enwiki&user={0}&user={1}"
+    "https://interaction-timeline.toolforge.org/?wiki={wiki}&user={0}&user={1}"
 )
+MEDIAWIKI_URL = "https://{0}.wikipedia.org"
+DEFAULT_WIKI = "enwiki"  # wiki queried when the request doesn't name one
+DEFAULT_WIKI_MEMORY_MB = 0  # snapshots kept loaded before unloading unused wikis; 0 for no limit
+DEFAULT_OVERLAY_MEMORY_MB = 0  # in-memory overlay per wiki before evicting added users; 0 for no limit
+DEFAULT_MW_MAX_WORKERS = 8  # concurrent page fetches per request
+DEFAULT_MW_TIME_BUDGET = 30  # seconds; must leave room within uwsgi's harakiri
+DEFAULT_MW_TIMEOUT = 10  # seconds per API call
+DEFAULT_REVISION_CACHE_MB = 256  # page histories kept per worker; 0 disables the cache
+DEFAULT_ACCOUNT_CACHE_SIZE = 100000  # account statuses (bot etc.) kept per worker
+DEFAULT_ACCOUNT_CACHE_TTL = 24 * 3600  # seconds
+DEFAULT_MW_USERS_BATCH = 50  # names per list=users call; 500 with apihighlimits
+DEFAULT_BATCH_MAX_USERS = 25  # users per call to the batch API
+DEFAULT_BATCH_MAX_WORKERS = 32  # concurrent page fetches per batch request
+DEFAULT_RESPONSE_CACHE_SIZE = 1000  # responses kept per worker
+DEFAULT_RESPONSE_CACHE_TTL = 60  # seconds a response is served without checking for new edits
+DEFAULT_REFRESH_WORKERS = 2  # background refresh threads per worker (stale-while-revalidate)
+DEFAULT_SNAPSHOT_CHECK_INTERVAL = 30  # seconds between checks for a newly installed snapshot
+DEFAULT_TEMPORAL_SEARCH_PROBES = 32  # index lists scanned per temporal search (recall vs. latency)
+DEFAULT_INGEST_MAX_LAG = 60  # seconds since ingest.py's last batch for it to count as keeping up
+MISSING_USER_TEXT = 'missing user_text -- e.g., "Isaac (WMF)" for https://en.wikipedia.org/wiki/User:Isaac_(WMF)'
+# how /similarusers can order neighbors: by pages overlapped (as stored) or by combined score
+RANKINGS = ("overlap", "combined")
+# weights of the fields summed into the combined score
+DEFAULT_COMBINED_SCORE_WEIGHTS = {
+    "edit-overlap": 1.0,
+    "edit-overlap-inv": 1.0,
+    "day-overlap": 0.5,
+    "hour-overlap": 0.5,
+}
+
+# endpoints that work before the data is loaded
+NO_DATA_ENDPOINTS = ("healthz", "readyz", "prometheus_metrics", "static", "memory_usage")
+
+
+@app.before_request
+def bind_data():
+    """Pick the wiki for this request and pin its data, so a reload part-way through doesn't mix two snapshots."""
+    if request.endpoint in NO_DATA_ENDPOINTS:
+        return None
+    if load_status()["status"] != "ready":
+        abort(503, "Data is not loaded yet")
+    name = request.args.get("wiki") or WIKIS.default
+    if name not in WIKIS:
+        abort(422, "Unknown wiki: {0}".format(name))
+    g.wiki = WIKIS.get(name)
+    check_snapshot(g.wiki)
+    try:
+        g.dataset = WIKIS.dataset(name)
+    except Exception as exc:
+        app.logger.exception("Failed to load %s", name)
+        abort(503, "Could not load the data for {0}: {1}".format(name, exc))
+
+
+def load_status():
+    """Progress of loading the default wiki, which has to be loaded for the service to be ready."""
+    if WIKIS is None:
+        return wikis.load_status("starting")
+    return WIKIS.get(WIKIS.default).load_status
 
 
 @app.route("/")
@@ -58,7 +134,7 @@ def index():
 @app.route("/similarusers", methods=["GET"])
 @basic_auth.required
 @metrics.counter('similar_users', 'Number of calls to similarusers',
-                 labels={'similar_count': lambda r: len(r.get_json()["results"]) if "results" in r.get_json() else 0})
+                 labels={'similar_count': lambda r: len((r.get_json() or {}).get("results", []))})
 def get_similar_users():
     """For a given user, find the k-most-similar users based on edit overlap.
 
@@ -66,354 +142,1284 @@ def get_similar_users():
     * usertext (str): username or IP address to query
     * k (int): how many similar users to return at maximum?
     * followup (bool): include additional tool links in API response for follow-up on data
+    * ranking (str): `overlap` (default) to order by pages overlapped, or `combined` to score
+      every neighbor by edit overlap both ways and day/hour overlap (see COMBINED_SCORE_WEIGHTS)
+    * stale (bool): answer right away from the data already held and refresh it in the
+      background (the default if STALE_WHILE_REVALIDATE is set; `stale=0` to wait instead)
+    * wiki (str): database name of the wiki to query (e.g. `enwiki`, the default)
     """
-    user_text, num_similar, followup, error = validate_api_args()
+    dataset = g.dataset
+    responses = g.wiki.responses
+    user_text, num_similar, followup, error = validate_api_args(dataset)
     if error is not None:
         app.logger.error("Got error when trying to validate API arguments: %s", error)
         return jsonify({"Error": error})
+    ranking = validate_ranking()
+
+    if stale_requested():
+        return get_similar_users_stale(dataset, user_text, num_similar, followup, ranking)
+
+    cached = responses.get(user_text, num_similar, followup, ranking)
+    # responses are served as they are for RESPONSE_CACHE_TTL seconds, unless pages are still pending
+    if (
+        cached is None
+        or not responses.is_fresh(cached)
+        or dataset.data.pending_pages(user_text)
+    ):
+        job = g.wiki.refreshes.run(user_text)
+        if job.status == refresh.FAILED:
+            return jsonify(
+                build_unrefreshed(dataset, user_text, num_similar, followup, ranking, job)
+            )
+        skipped_pages = job.result or []
+        version = dataset.data.version(user_text)
+        if cached is not None and cached.version == version and not skipped_pages:
+            responses.validate(cached)
+        else:
+            result = build_similar_users(
+                dataset, user_text, num_similar, followup, skipped_pages, ranking
+            )
+            logging.debug("Got %d similarity results for user %s", len(result["results"]), user_text)
+            if skipped_pages:
+                # partial results aren't cached
+                return jsonify(result)
+            cached = responses.put(user_text, num_similar, followup, version, result, ranking)
+
+    with instrumentation.stage("render", dataset.name):
+        etag, body = cached.body(
+            num_similar,
+            lambda result, k: jsonify(trim_result(dataset, result, k)).get_data(),
+        )
+    response = app.response_class(body, mimetype="application/json")
+    response.set_etag(etag)
+    # let browsers keep the response but check back (If-None-Match) before reusing it
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
-    edits = get_additional_edits(
-        user_text, last_edit_timestamp=USER_METADATA[user_text]["most_recent_edit"]
+
+def build_unrefreshed(dataset, user_text, num_similar, followup, ranking, job):
+    """The response for a user whose refresh failed: from the data already held, marked stale.
+
+    It carries the failed job (as the `stale` responses do) and is not to be
+    cached, so the next request tries the refresh again.
+    """
+    result = build_similar_users(dataset, user_text, num_similar, followup, [], ranking)
+    result["freshness"] = {"status": "stale", "refresh": job.to_dict()}
+    return result
+
+
+def stale_requested():
+    stale = request.args.get("stale")
+    if stale is None:
+        return app.config.get("STALE_WHILE_REVALIDATE", False)
+    return stale.lower() not in ("0", "false", "no")
+
+
+def get_similar_users_stale(dataset, user_text, num_similar, followup, ranking):
+    """Answer from the data already held (the dumps plus earlier updates) and refresh it in the background.
+
+    The response says how fresh it is: "fresh" if the user's data was refreshed
+    within RESPONSE_CACHE_TTL seconds, otherwise "stale" with the state of the
+    refresh that has been queued. Poll /api/similarusers/refresh or repeat the
+    request to get the refreshed result.
+    """
+    ttl = app.config.get("RESPONSE_CACHE_TTL", DEFAULT_RESPONSE_CACHE_TTL)
+    wiki = dataset.wiki
+    job = wiki.refreshes.job(user_text)
+    if job is None or job.status == refresh.FAILED or (job.age() or 0) >= ttl:
+        # (a job that is already queued or running is returned as it is)
+        job = wiki.refreshes.submit(user_text)
+    fresh = job.status == refresh.DONE and job.age() < ttl
+
+    version = dataset.data.version(user_text)
+    cached = wiki.responses.get(user_text, num_similar, followup, ranking)
+    if cached is None or cached.version != version:
+        skipped_pages = job.result if fresh and job.result else []
+        result = build_similar_users(
+            dataset, user_text, num_similar, followup, skipped_pages, ranking
+        )
+        if not skipped_pages:
+            cached = wiki.responses.put(
+                user_text, num_similar, followup, version, result, ranking
+            )
+    else:
+        result = cached.result
+    result = dict(trim_result(dataset, result, num_similar))
+    result["freshness"] = {
+        "status": "fresh" if fresh else "stale",
+        "refresh": job.to_dict(),
+    }
+    return jsonify(result)
+
+
+@app.route("/api/similarusers/refresh", methods=["GET"])
+@basic_auth.required
+def get_refresh_status():
+    """State of the background refresh of a user's data (see the `stale` parameter of /similarusers).
+
+    Expected parameters:
+    * usertext (str): username or IP address
+    * wiki (str): database name of the wiki (default `enwiki`)
+    """
+    user_text = request.args.get("usertext")
+    if not user_text:
+        abort(422, "No usertext provided")
+    user_text = standardize_user_text(user_text)
+    job = g.wiki.refreshes.job(user_text)
+    return jsonify(
+        {
+            "user_text": user_text,
+            "refresh": None if job is None else job.to_dict(),
+            "queued_refreshes": g.wiki.refreshes.pending(),
+        }
     )
-    app.logger.debug("Got %d edits for user %s", len(edits) if edits else 0, user_text)
-    if edits is not None:
-        update_coedit_data(user_text, edits, app.config["EDIT_WINDOW"])
-    overlapping_users = COEDIT_DATA.get(user_text, [])[:num_similar]
+
+
+@app.route("/api/similarusers/reload", methods=["POST"])
+@basic_auth.required
+def post_reload():
+    """Switch to a new snapshot of the dumps without restarting (see reload_data).
+
+    Expected parameters:
+    * snapshot (str): snapshot directory to install, relative to the wiki's resource directory
+      (e.g. `snapshot-2020-11`); leave out to pick up the one already installed
+    * wiki (str): database name of the wiki (default `enwiki`)
+    """
+    wiki = g.wiki
+    snapshot_dir = request.args.get("snapshot")
+    if snapshot_dir:
+        resource_dir = os.path.realpath(wiki.resource_dir)
+        snapshot_dir = os.path.realpath(os.path.join(resource_dir, snapshot_dir))
+        if os.path.dirname(snapshot_dir) != resource_dir:
+            abort(422, "snapshot must be a directory in the resource directory")
+    try:
+        reloaded = reload_data(wiki, snapshot_dir or None)
+    except (OSError, snapshot.SnapshotError) as exc:
+        app.logger.error("Failed to reload data for %s: %s", wiki.name, exc)
+        abort(422, "Could not load snapshot: {0}".format(exc))
+    data_snapshot = WIKIS.dataset(wiki.name).data.snapshot
+    meta = data_snapshot.meta
+    return jsonify(
+        {
+            "reloaded": reloaded,
+            "snapshot": {
+                "path": data_snapshot.path,
+                "created": meta.get("created"),
+                "num_users": data_snapshot.num_users,
+                "most_recent_rev_ts": meta.get("most_recent_rev_ts"),
+                "earliest_ts": meta.get("earliest_ts"),
+            },
+        }
+    )
+
+
+@app.route("/api/similarusers/memory", methods=["GET", "POST"])
+@basic_auth.required
+def memory_usage():
+    """Memory held by this worker: for each wiki, and how the overlays have grown.
+
+    Only the worker that answers is reported on. Optional parameters:
+    * allocations (int): also list the source lines that allocated the most of
+      what is still held, that many of them (needs tracing on)
+    * tracing (str, POST only): `on` to start tracing allocations with
+      tracemalloc, which slows the worker down and takes memory of its own, so
+      turn it `off` again once done
+    """
+    limit = request.args.get("allocations", 0)
+    try:
+        limit = int(limit)
+    except ValueError:
+        abort(422, "allocations must be an integer")
+    if request.method == "POST":
+        tracing = request.args.get("tracing")
+        if tracing == "on" and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        elif tracing == "off":
+            tracemalloc.stop()
+        elif tracing != "on":
+            abort(422, "tracing must be `on` or `off`")
+    # ru_maxrss is in KiB on Linux
+    result = {
+        "pid": os.getpid(),
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "wikis": {},
+        "mediawiki_caches": [
+            {
+                "cache": kind,
+                "host": host,
+                "entries": len(cache),
+                "bytes": getattr(cache, "nbytes", None),
+            }
+            for kind, host, cache in mediawiki.caches()
+        ],
+        "tracing": tracemalloc.is_tracing(),
+    }
+    for wiki in WIKIS or ():
+        dataset = wiki.dataset
+        result["wikis"][wiki.name] = {
+            "snapshot_bytes": 0 if dataset is None else dataset.nbytes,
+            "overlay": None if wiki.overlay is None else overlay_memory(wiki.overlay),
+            "response_cache_entries": len(wiki.responses),
+        }
+    if limit > 0 and tracemalloc.is_tracing():
+        result["allocations"] = allocation_stats(limit)
+    return jsonify(result)
+
+
+def overlay_memory(overlay):
+    """Bytes held by each of an overlay's structures, its budget and how it has grown."""
+    # asked for, so counted afresh (/metrics reports counts up to SQLITE_SIZES_MAX_AGE old)
+    sizes = overlay.byte_sizes(max_age=0)
+    return {
+        "bytes": sizes,
+        "total_bytes": sum(sizes.values()),
+        "max_bytes": overlay.max_bytes or None,
+        "evicted_users": overlay.evicted_users,
+        "growth_bytes_per_hour": overlay.history.growth_per_hour(),
+        "history": [
+            [time.strftime(TIME_FORMAT, time.gmtime(ts)), nbytes]
+            for ts, nbytes in overlay.history.samples()
+        ],
+    }
+
+
+def allocation_stats(limit):
+    """The `limit` source lines holding the most memory allocated since tracing started."""
+    traced, peak = tracemalloc.get_traced_memory()
+    stats = tracemalloc.take_snapshot().statistics("lineno")[:limit]
+    return {
+        "traced_bytes": traced,
+        "peak_traced_bytes": peak,
+        "top": [
+            {
+                "file": stat.traceback[0].filename,
+                "line": stat.traceback[0].lineno,
+                "bytes": stat.size,
+                "blocks": stat.count,
+            }
+            for stat in stats
+        ],
+    }
+
+
+@app.route("/api/similarusers/batch", methods=["GET"])
+@basic_auth.required
+@metrics.counter('similar_users_batch', 'Number of calls to the batch similarusers API')
+def get_similar_users_batch():
+    """For a group of users, find the k-most-similar users of each and how similar they are to each other.
+
+    Pages and account statuses needed by several users in the group are fetched
+    only once, and all users are fetched for at the same time, so a batch takes
+    about as long as its slowest user.
+
+    Expected parameters:
+    * usertext (str): username or IP address to query -- repeat it (or separate with |) for each user
+    * k (int): how many similar users to return at maximum for each user?
+    * followup (bool): include additional tool links in API response for follow-up on data
+    * ranking (str): `overlap` (default) or `combined`, as for /similarusers
+    * wiki (str): database name of the wiki to query (default `enwiki`)
+    """
+    dataset = g.dataset
+    checked, num_similar, followup = validate_batch_api_args(dataset)
+    ranking = validate_ranking()
+    user_texts = []
+    errors = {}
+    for user_text, error in checked:
+        if error is None:
+            user_texts.append(user_text)
+        else:
+            app.logger.error("Got error when trying to validate API arguments: %s", error)
+            errors[user_text] = error
+
+    # users already being refreshed by other requests are waited for rather than fetched again
+    jobs = g.wiki.refreshes.run_many(
+        user_texts, lambda users: refresh_user_data_many(dataset, users)
+    )
+    skipped_pages = {u: job.result or [] for u, job in jobs.items()}
+    failed = {u: job for u, job in jobs.items() if job.status == refresh.FAILED}
+
+    users = []
+    for user_text, _ in checked:
+        if user_text in errors:
+            users.append({"user_text": user_text, "Error": errors[user_text]})
+        elif user_text in failed:
+            users.append(
+                build_unrefreshed(
+                    dataset, user_text, num_similar, followup, ranking, failed[user_text]
+                )
+            )
+        else:
+            users.append(
+                build_similar_users(
+                    dataset,
+                    user_text,
+                    num_similar,
+                    followup,
+                    skipped_pages.get(user_text, []),
+                    ranking,
+                )
+            )
+    return jsonify({"users": users, "group": build_group_overlaps(dataset, user_texts)})
+
+@app.route("/api/similarusers/reverse", methods=["GET"])
+@basic_auth.required
+@metrics.counter('similar_users_reverse', 'Number of calls to the reverse similarusers API')
+def get_listed_by():
+    """For a given user, find the users who have them among their most-similar users.
+
+    Answered from the reverse index of the snapshot plus what has been learned
+    since (the lists of users queried since the dumps), without fetching anything
+    from the API, so it takes milliseconds. Results are closest first: those who
+    rank the user highest in their list, then by edit overlap.
+
+    Expected parameters:
+    * usertext (str): username or IP address to query
+    * k (int): how many users to return at maximum?
+    * rank (int): only users who rank the user within their top `rank` (default 250, i.e. anywhere in their list)
+    * followup (bool): include additional tool links in API response for follow-up on data
+    * wiki (str): database name of the wiki to query (default `enwiki`)
+    """
+    dataset = g.dataset
+    user_text, num_similar, followup, error = validate_api_args(dataset)
+    if error is not None:
+        app.logger.error("Got error when trying to validate API arguments: %s", error)
+        return jsonify({"Error": error})
+    max_rank = validate_num_similar(request.args.get("rank", datastore.NEIGHBOR_LIMIT))
+    return jsonify(build_listed_by(dataset, user_text, num_similar, max_rank, followup))
+
+
+@app.route("/api/similarusers/temporal", methods=["GET"])
+@basic_auth.required
+@metrics.counter('similar_users_temporal', 'Number of calls to the temporal similarusers API')
+def get_temporal_neighbors():
+    """For a given user, find the users anywhere in the data who edit at the most similar times of the week and day.
+
+    Unlike /similarusers, candidates need not have edited any of the same pages:
+    every user is searched, through the temporal index of the snapshot (see
+    temporal_index.py) plus the users learned about since. Results are most
+    similar first, by the mean of the day and hour cosine similarities.
+
+    Expected parameters:
+    * usertext (str): username or IP address to query
+    * k (int): how many users to return at maximum?
+    * anon (0 or 1): only logged-out (1) or only registered (0) users
+    * active_since (str): only users whose edits in the data reach this time or later (YYYY-MM-DDTHH:MM:SSZ)
+    * active_until (str): only users whose edits in the data start by this time
+    * followup (bool): include additional tool links in API response for follow-up on data
+    * wiki (str): database name of the wiki to query (default `enwiki`)
+    """
+    dataset = g.dataset
+    user_text, num_similar, followup, error = validate_api_args(dataset)
+    if error is not None:
+        app.logger.error("Got error when trying to validate API arguments: %s", error)
+        return jsonify({"Error": error})
+    is_anon, active_since, active_until = validate_temporal_filters()
+    return jsonify(
+        build_temporal_neighbors(
+            dataset, user_text, num_similar, followup, is_anon, active_since, active_until
+        )
+    )
+
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """Liveness: the process is up. Also says whether the data is loaded (see /healthz/ready) and how far loading got.
+
+    `load` is for the default wiki, which is loaded at start-up; `wikis` has the
+    state of every wiki (the others are loaded when first queried).
+    """
+    status = load_status()
+    return jsonify(
+        {
+            "status": "running",
+            "ready": status["status"] == "ready",
+            "load": status,
+            "wikis": {} if WIKIS is None else {w.name: w.load_status for w in WIKIS},
+            "pid": os.getpid(),
+        }
+    )
+
+
+@app.route("/healthz/ready", methods=["GET"])
+def readyz():
+    """Readiness: 200 once the default wiki's data is loaded, 503 before that (or if loading failed)."""
+    status = load_status()
+    ready = status["status"] == "ready"
+    return jsonify({"ready": ready, "load": status}), 200 if ready else 503
+
+
+@instrumentation.timed("build_result")
+def build_similar_users(
+    dataset, user_text, num_similar, followup, skipped_pages, ranking="overlap"
+):
+    """Build the similar-users API response for a user whose data is up to date."""
+    data = dataset.data
+    if ranking == "combined":
+        overlapping_users, scores, day_cs, hour_cs = combined_neighbors(
+            dataset, user_text, num_similar
+        )
+        day_overlaps = temporal_overlap_levels(day_cs)
+        hour_overlaps = temporal_overlap_levels(hour_cs)
+    else:
+        overlapping_users = data.neighbors(user_text, num_similar)
+        scores = None
+        day_overlaps, hour_overlaps = get_temporal_overlaps(
+            dataset, user_text, overlapping_users
+        )
 
     oldest_edit = None
     last_edit = None
-    app.logger.info(str(USER_METADATA[user_text]))
-    if USER_METADATA[user_text]["oldest_edit"]:
+    user_metadata = data.metadata(user_text)
+    app.logger.info(str(user_metadata))
+    if user_metadata["oldest_edit"]:
         oldest_edit = datetime.strptime(
-            USER_METADATA[user_text]["oldest_edit"], TIME_FORMAT
+            user_metadata["oldest_edit"], TIME_FORMAT
         ).strftime(READABLE_TIME_FORMAT)
     else:
         app.logger.debug("Didn't get an oldest_edit for user %s", user_text)
 
-    if USER_METADATA[user_text]["most_recent_edit"]:
+    if user_metadata["most_recent_edit"]:
         last_edit = datetime.strptime(
-            USER_METADATA[user_text]["most_recent_edit"], TIME_FORMAT
+            user_metadata["most_recent_edit"], TIME_FORMAT
         ).strftime(READABLE_TIME_FORMAT)
     else:
         app.logger.debug("Didn't get an most_recent_edit for user %s", user_text)
 
     result = {
         "user_text": user_text,
-        "num_edits_in_data": USER_METADATA[user_text]["num_edits"],
+        "num_edits_in_data": user_metadata["num_edits"],
         "first_edit_in_data": oldest_edit,
         "last_edit_in_data": last_edit,
         "results": [
-            build_result(user_text, u[0], u[1], num_similar, followup)
-            for u in overlapping_users
+            build_result(
+                dataset,
+                user_text,
+                user_metadata["num_pages"],
+                u,
+                num_similar,
+                followup,
+                day_overlaps[i],
+                hour_overlaps[i],
+            )
+            for i, u in enumerate(overlapping_users)
         ],
     }
-    logging.debug("Got %d similarity results for user %s", len(result["results"]), user_text)
-    return jsonify(result)
+    if scores is not None:
+        for r, score in zip(result["results"], scores):
+            r["combined-score"] = float(score)
+    if skipped_pages:
+        # partial results -- these pages will be retried on the next request
+        result["skipped_pages"] = skipped_pages
+    return result
+
+
+def combined_neighbors(dataset, user_text, k):
+    """The k neighbors with the highest combined score, best first.
+
+    Every neighbor in the user's list is scored -- including the tail of
+    single-page overlaps that /similarusers cuts off -- as the weighted sum
+    (COMBINED_SCORE_WEIGHTS) of edit-overlap, edit-overlap-inv and the day and
+    hour cosine similarities, computed for the whole list at once. Returns
+    (neighbors, scores, day cosine similarities, hour cosine similarities).
+    """
+    data = dataset.data
+    weights = dict(
+        DEFAULT_COMBINED_SCORE_WEIGHTS,
+        **app.config.get("COMBINED_SCORE_WEIGHTS", {})
+    )
+    arrays = data.neighbor_arrays(user_text)
+    user_num_pages = data.num_pages(user_text) or 1
+    days, hours = get_normalized_temporal_vectors(
+        dataset, [(user_text, data.user_id(user_text))]
+    )
+    neighbor_days, neighbor_hours = normalize_temporal_vectors(arrays.counts, arrays.norms)
+    day_cs = neighbor_days @ days[0]
+    hour_cs = neighbor_hours @ hours[0]
+    overlaps = arrays.overlaps.astype(np.float64)
+    scores = (
+        weights["edit-overlap"] * overlaps / user_num_pages
+        + weights["edit-overlap-inv"]
+        * np.minimum(1, overlaps / np.where(arrays.num_pages > 0, arrays.num_pages, 1))
+        + weights["day-overlap"] * day_cs
+        + weights["hour-overlap"] * hour_cs
+    )
+    top = np.arange(len(scores))
+    if len(scores) > k:
+        top = np.argpartition(-scores, k - 1)[:k]
+    # ties keep the stored (overlap) order
+    top = top[np.lexsort((top, -scores[top]))]
+    return data.neighbors_at(arrays, top), scores[top], day_cs[top], hour_cs[top]
+
+
+@instrumentation.timed("build_reverse_result")
+def build_listed_by(dataset, user_text, num_similar, max_rank, followup):
+    """Build the reverse similar-users API response: who lists user_text, with the same fields as /similarusers plus their rank."""
+    data = dataset.data
+    listed_by = data.listed_by(user_text, num_similar, max_rank)
+    user_num_pages = data.num_pages(user_text) or 1
+    day_overlaps, hour_overlaps = get_temporal_overlaps(dataset, user_text, listed_by)
+    results = []
+    for i, u in enumerate(listed_by):
+        r = build_result(
+            dataset,
+            user_text,
+            user_num_pages,
+            u,
+            num_similar,
+            followup,
+            day_overlaps[i],
+            hour_overlaps[i],
+        )
+        # 1 = user_text is the first in their list
+        r["rank"] = u.rank + 1
+        results.append(r)
+    return {"user_text": user_text, "results": results}
 
-@app.route("/healthz", methods=["GET"])
-def healthz():
-    return "similarusers is running"
 
-def build_result(user_text, neighbor, num_pages_overlapped, num_similar, followup):
+@instrumentation.timed("build_temporal_result")
+def build_temporal_neighbors(
+    dataset, user_text, num_similar, followup, is_anon, active_since, active_until
+):
+    """Build the temporal similar-users API response: the users with the closest editing-time fingerprints."""
+    data = dataset.data
+    matches = data.temporal_neighbors(
+        user_text,
+        num_similar,
+        is_anon=is_anon,
+        active_since=active_since,
+        active_until=active_until,
+        probes=app.config.get("TEMPORAL_SEARCH_PROBES", DEFAULT_TEMPORAL_SEARCH_PROBES),
+    )
+    num_pages = data.num_pages_many([(m.user_text, m.uid) for m in matches])
+    day_overlaps, hour_overlaps = get_temporal_overlaps(dataset, user_text, matches)
+    results = []
+    for i, m in enumerate(matches):
+        r = {
+            "user_text": m.user_text,
+            "num_edits_in_data": num_pages[i],
+            "similarity": m.similarity,
+            "day-overlap": day_overlaps[i],
+            "hour-overlap": hour_overlaps[i],
+        }
+        if followup:
+            r["follow-up"] = {
+                "similar": similar_users_url(dataset, m.user_text, num_similar),
+                "interaction-timeline": INTERACTIONTIMELINE_URL.format(
+                    user_text, m.user_text, wiki=dataset.name
+                ),
+            }
+        results.append(r)
+    return {"user_text": user_text, "results": results}
+
+
+def trim_result(dataset, result, k):
+    """A similar-users response cut down to the k most-similar users."""
+    if len(result["results"]) <= k and all(
+        "follow-up" not in r for r in result["results"]
+    ):
+        return result
+    trimmed = dict(result)
+    trimmed["results"] = []
+    for r in result["results"][:k]:
+        if "follow-up" in r:
+            r = dict(r)
+            r["follow-up"] = dict(
+                r["follow-up"], similar=similar_users_url(dataset, r["user_text"], k)
+            )
+        trimmed["results"].append(r)
+    return trimmed
+
+
+def similar_users_url(dataset, user_text, k):
+    url = "{0}?usertext={1}&k={2}".format(URL_PREFIX, user_text, k)
+    if dataset.name != WIKIS.default:
+        url += "&wiki={0}".format(dataset.name)
+    return url
+
+
+def build_group_overlaps(dataset, user_texts):
+    """Edit and temporal overlap between every pair of users in a group.
+
+    Pages overlapped are looked up in each user's whole list of co-editors, so
+    a pair that is in neither list is reported as 0 overlap.
+    """
+    data = dataset.data
+    overlaps = {}
+    for user_text in user_texts:
+        others = [u for u in user_texts if u != user_text]
+        for other, overlap in data.overlaps_with(user_text, others).items():
+            overlaps[(user_text, other)] = overlap
+    num_pages = data.num_pages_many([(u, data.user_id(u)) for u in user_texts])
+    days, hours = get_normalized_temporal_vectors(
+        dataset, [(u, data.user_id(u)) for u in user_texts]
+    )
+    first, second = np.triu_indices(len(user_texts), 1)
+    day_overlaps = temporal_overlap_levels(np.einsum("ij,ij->i", days[first], days[second]))
+    hour_overlaps = temporal_overlap_levels(np.einsum("ij,ij->i", hours[first], hours[second]))
+    group = []
+    for n, (i, j) in enumerate(zip(first, second)):
+        a, b = user_texts[i], user_texts[j]
+        num_pages_overlapped = max(overlaps.get((a, b), 0), overlaps.get((b, a), 0))
+        group.append(
+            {
+                "user_text": a,
+                "other_user_text": b,
+                "num_pages_overlapped": num_pages_overlapped,
+                "edit-overlap": num_pages_overlapped / (num_pages[i] or 1),
+                "edit-overlap-inv": min(1, num_pages_overlapped / (num_pages[j] or 1)),
+                "day-overlap": day_overlaps[n],
+                "hour-overlap": hour_overlaps[n],
+            }
+        )
+    return group
+
+
+def build_result(
+    dataset, user_text, user_num_pages, neighbor, num_similar, followup, day_overlap, hour_overlap
+):
     """Build a single similar-user API response"""
+    num_pages_overlapped = neighbor.overlap
+    neighbor_num_pages = neighbor.num_pages
     r = {
-        "user_text": neighbor,
-        "num_edits_in_data": USER_METADATA.get(neighbor, {}).get(
-            "num_pages", num_pages_overlapped
-        ),
-        "edit-overlap": num_pages_overlapped / USER_METADATA[user_text]["num_pages"],
+        "user_text": neighbor.user_text,
+        "num_edits_in_data": num_pages_overlapped
+        if neighbor_num_pages is None
+        else neighbor_num_pages,
+        "edit-overlap": num_pages_overlapped / user_num_pages,
         "edit-overlap-inv": min(
             1,
-            num_pages_overlapped / USER_METADATA.get(neighbor, {}).get("num_pages", 1),
+            num_pages_overlapped / (1 if neighbor_num_pages is None else neighbor_num_pages),
         ),
-        "day-overlap": get_temporal_overlap(user_text, neighbor, "d"),
-        "hour-overlap": get_temporal_overlap(user_text, neighbor, "h"),
+        "day-overlap": day_overlap,
+        "hour-overlap": hour_overlap,
     }
     if followup:
         r["follow-up"] = {
-            "similar": "{0}?usertext={1}&k={2}".format(
-                URL_PREFIX, neighbor, num_similar
+            "similar": similar_users_url(dataset, neighbor.user_text, num_similar),
+            "editorinteract": EDITORINTERACT_URL.format(
+                user_text, neighbor.user_text, wiki=dataset.name
+            ),
+            "interaction-timeline": INTERACTIONTIMELINE_URL.format(
+                user_text, neighbor.user_text, wiki=dataset.name
             ),
-            "editorinteract": EDITORINTERACT_URL.format(user_text, neighbor),
-            "interaction-timeline": INTERACTIONTIMELINE_URL.format(user_text, neighbor),
         }
     return r
 
 
-def get_temporal_overlap(u1, u2, k):
-    """Determine how similar two users are in terms of days and hours in which they edit."""
-    # overlap in days-of-week
-    if k == "d":
-        cs = cosine_similarity(
-            [TEMPORAL_DATA.get(u1, {}).get("d", [0] * 7)],
-            [TEMPORAL_DATA.get(u2, {}).get("d", [0] * 7)],
-        )[0][0]
-    # overlap in hours-of-the-day
-    elif k == "h":
-        cs = cosine_similarity(
-            [TEMPORAL_DATA.get(u1, {}).get("h", [0] * 24)],
-            [TEMPORAL_DATA.get(u2, {}).get("h", [0] * 24)],
-        )[0][0]
-    else:
-        app.logger.error(
-            "Unrecognised temporal overlap key - expected 'd' or 'h' but got %s", k
-        )
-        raise Exception(
-            "Do not recognize temporal overlap key -- must be 'd' for daily or 'h' for hourly."
-        )
-    # map cosine similarity values to qualitative labels
-    # thresholds based on examining some examples and making judgments on how similar they seemed to be
-    level = "No overlap"
+def get_temporal_overlaps(dataset, user_text, neighbors):
+    """Determine how similar a user is to each neighbor in terms of days and hours in which they edit.
 
-    if cs == 1:
-        level = "Same"
-    elif cs > 0.8:
-        level = "High"
-    elif cs > 0.5:
-        level = "Medium"
-    elif cs > 0:
-        level = "Low"
+    All neighbors are scored in one pass: every day and hour vector is scaled by its
+    precomputed norm and the cosine similarities come out of one matrix-vector
+    product each for days and hours.
+    """
+    days, hours = get_normalized_temporal_vectors(
+        dataset,
+        [(user_text, dataset.data.user_id(user_text))]
+        + [(u.user_text, u.uid) for u in neighbors]
+    )
+    # overlap in days-of-week and hours-of-the-day
+    return (
+        temporal_overlap_levels(days[1:] @ days[0]),
+        temporal_overlap_levels(hours[1:] @ hours[0]),
+    )
 
-    return {"cos-sim": cs, "level": level}
 
+def get_normalized_temporal_vectors(dataset, users):
+    """Unit-length day and hour vectors for (user_text, uid) pairs, so dot products are cosine similarities."""
+    counts, norms = dataset.data.temporal_vectors(users)
+    return normalize_temporal_vectors(counts, norms)
 
-def get_additional_edits(
-    user_text, last_edit_timestamp=None, lang="en", limit=1000, session=None
-):
-    """Gather edits made by a user since last data dumps -- e.g., October edits if dumps end of September dumps used."""
-    if last_edit_timestamp:
-        arvstart = datetime.strptime(last_edit_timestamp, TIME_FORMAT) + timedelta(
-            seconds=1
-        )
-    else:
-        # TODO move this timestamp out of configuration - either automate it
-        # based on current date or query it from a datastore.
-        arvstart = app.config["MOST_RECENT_REV_TS"]
+
+def normalize_temporal_vectors(counts, norms):
+    """Unit-length day and hour vectors for rows of day/hour counts and their (day, hour) norms."""
+    # all-zero vectors stay zero and so have no overlap with anyone
+    norms = np.where(norms == 0, 1, norms)
+    days = counts[:, : snapshot.NUM_DAYS] / norms[:, 0:1]
+    hours = counts[:, snapshot.NUM_DAYS :] / norms[:, 1:2]
+    return days, hours
+
+
+def temporal_overlap_levels(cs):
+    """Map an array of cosine similarity values to qualitative labels."""
+    # thresholds based on examining some examples and making judgments on how similar they seemed to be
+    levels = np.select(
+        [cs == 1, cs > 0.8, cs > 0.5, cs > 0],
+        ["Same", "High", "Medium", "Low"],
+        default="No overlap",
+    )
+    return [
+        {"cos-sim": float(c), "level": str(level)} for c, level in zip(cs, levels)
+    ]
+
+
+@instrumentation.timed("get_additional_edits")
+def get_additional_edits(dataset, user_text, last_edit_timestamp=None, limit=1000, session=None):
+    """Gather edits made by a user since last data dumps -- e.g., October edits if dumps end of September dumps used.
+
+    Each call does a bounded amount of work: edits are listed until more than
+    `limit` pages have been seen, and the API's continuation of the listing is
+    saved as the user's edit cursor, so the next call resumes exactly where this
+    one stopped. Once the listing is finished, the cursor starts the next one
+    after the newest edit recorded. A page only adds to the user's num_pages the
+    first time it is seen since the dumps. Returns the new edits ({page id:
+    timestamps}), or None if they could not be gathered.
+    """
+    listing = EditListing(dataset, user_text, last_edit_timestamp, limit)
     if session is None:
-        session = mwapi.Session(
-            "https://{0}.wikipedia.org".format(lang), user_agent=app.config["CUSTOM_UA"]
-        )
+        session = get_mw_session(dataset.wiki)
 
     # generate list of all revisions since user's last recorded revision
-    result = session.get(
-        action="query",
-        list="allrevisions",
-        arvuser=user_text,
-        arvprop="ids|timestamp|comment|user",
-        arvnamespace="|".join([str(ns) for ns in app.config["NAMESPACES"]]),
-        arvstart=arvstart,
-        arvdir="newer",
-        format="json",
-        arvlimit=500,
-        formatversion=2,
-        continuation=True,
-    )
-    min_timestamp = USER_METADATA[user_text]["oldest_edit"]
-    max_timestamp = USER_METADATA[user_text]["most_recent_edit"]
-    new_edits = 0
-    new_pages = 0
+    result = session.get(**listing.query())
     try:
-        pageids = {}
         for r in result:
-            for page in r["query"]["allrevisions"]:
-                pid = page["pageid"]
-                if pid not in pageids:
-                    pageids[pid] = []
-                    new_pages += 1
-                for rev in page["revisions"]:
-                    ts = rev["timestamp"]
-                    pageids[pid].append(ts)
-                    dtts = datetime.strptime(ts, TIME_FORMAT)
-                    # update TEMPORAL_DATA so future calls don't have to repeat this
-                    update_temporal_data(user_text, dtts.day, dtts.hour, 1)
-                    new_edits += 1
-                    if min_timestamp is None:
-                        min_timestamp = ts
-                        max_timestamp = ts
-                    else:
-                        max_timestamp = max(max_timestamp, ts)
-                        min_timestamp = min(min_timestamp, ts)
-            if len(pageids) > limit:
+            instrumentation.api_call("allrevisions", session.host)
+            if listing.add(r):
                 break
-        # Update USER_METADATA so future calls don't need to repeat this process
-        USER_METADATA[user_text]["num_edits"] += new_edits
-        # this is not ideal as these might not be new pages but too expensive to check and getting it wrong isn't so bad
-        USER_METADATA[user_text]["num_pages"] += new_pages
-        USER_METADATA[user_text]["most_recent_edit"] = max_timestamp
-        USER_METADATA[user_text]["oldest_edit"] = min_timestamp
-        return pageids
+        return listing.record()
     except Exception as exc:
+        listing.failed(exc)
+        return None
+
+
+class EditListing(object):
+    """One call's worth of listing a user's new edits (see get_additional_edits), whatever makes the API calls.
+
+    query() is the API query to run (with continuation), add() takes in its
+    responses until it says to stop, and record() saves what they held.
+    """
+
+    def __init__(self, dataset, user_text, last_edit_timestamp=None, limit=1000):
+        self.dataset = dataset
+        self.user_text = user_text
+        self.last_edit_timestamp = last_edit_timestamp
+        self.limit = limit
+        # the listing holds the edits made up to about now (see ingested)
+        self.began = time.strftime(TIME_FORMAT, time.gmtime())
+        self.cursor = dataset.data.edit_cursor(user_text)
+        if self.cursor is not None:
+            self.start = self.cursor
+        else:
+            if last_edit_timestamp:
+                arvstart = after_timestamp(last_edit_timestamp)
+            else:
+                # the end of the wiki's dumps (from its snapshot, or the configuration)
+                arvstart = dataset.most_recent_rev_ts
+            self.start = {"arvstart": arvstart, "continue": None, "newest": None, "listed": None}
+        self.pageids = {}
+        self.next_continue = None
+        self.min_timestamp = None
+        self.max_timestamp = None
+        self.temporal = [0] * snapshot.TEMPORAL_DIMS
+        self.new_edits = 0
+
+    def query(self):
+        return dict(
+            action="query",
+            list="allrevisions",
+            arvuser=self.user_text,
+            arvprop="ids|timestamp|comment|user",
+            arvnamespace="|".join([str(ns) for ns in app.config["NAMESPACES"]]),
+            arvstart=self.start["arvstart"],
+            arvdir="newer",
+            format="json",
+            arvlimit=500,
+            formatversion=2,
+            continuation=True,
+            **(self.start["continue"] or {})
+        )
+
+    def add(self, response):
+        """Take in one response of the listing. Returns True once enough pages have been listed."""
+        for page in response["query"]["allrevisions"]:
+            pid = page["pageid"]
+            if pid not in self.pageids:
+                self.pageids[pid] = []
+            for rev in page["revisions"]:
+                self.add_edit(pid, rev["timestamp"])
+        if len(self.pageids) > self.limit and "continue" in response:
+            # stop at the end of a response so the next call can pick up with the next one
+            self.next_continue = response["continue"]
+            return True
+        return False
+
+    def add_edit(self, pid, ts):
+        """Take in one edit to page pid, made at ts (TIME_FORMAT)."""
+        self.pageids.setdefault(pid, []).append(ts)
+        dtts = datetime.strptime(ts, TIME_FORMAT)
+        # update TEMPORAL_DATA so future calls don't have to repeat this
+        update_temporal_data(self.temporal, dtts.day, dtts.hour, 1)
+        self.new_edits += 1
+        if self.min_timestamp is None:
+            self.min_timestamp = ts
+            self.max_timestamp = ts
+        else:
+            self.max_timestamp = max(self.max_timestamp, ts)
+            self.min_timestamp = min(self.min_timestamp, ts)
+
+    def next_cursor(self):
+        """Where the next listing resumes, after the edits taken in."""
+        start = self.start
+        # TIME_FORMAT timestamps sort lexicographically
+        newest = max(start["newest"] or "", self.max_timestamp or "") or None
+        if self.next_continue is not None:
+            return {
+                "arvstart": start["arvstart"],
+                "continue": self.next_continue,
+                "newest": newest,
+                "listed": start.get("listed"),
+            }
+        return {
+            "arvstart": start["arvstart"] if newest is None else after_timestamp(newest),
+            "continue": None,
+            "newest": None,
+            "listed": self.began,
+        }
+
+    def batch(self):
+        """The edits taken in, as the arguments of UserStore.record_edit_batch (after user_text)."""
+        return {
+            "cursor": self.cursor,
+            "next_cursor": self.next_cursor(),
+            "num_edits": self.new_edits,
+            "pageids": list(self.pageids),
+            "oldest_edit": self.min_timestamp,
+            "most_recent_edit": self.max_timestamp,
+            "temporal": self.temporal,
+        }
+
+    def record(self):
+        """Record the edits listed and move the user's cursor on. Returns them, or {} if another request already had."""
+        # Update USER_METADATA so future calls don't need to repeat this process
+        if not self.dataset.data.record_edit_batch(self.user_text, **self.batch()):
+            # a concurrent request got to these edits first and has recorded them
+            app.logger.debug("Edits of %s were already recorded", self.user_text)
+            return {}
+        return self.pageids
+
+    def failed(self, exc):
+        last_edit_timestamp = self.last_edit_timestamp
         app.logger.error(
-            "Failed to get additional edits for {user_text}, lang {lang}. {last_edit}. Exception: {exc}".format(
-                user_text=user_text,
-                lang=lang,
+            "Failed to get additional edits for {user_text}, wiki {wiki}. {last_edit}. Exception: {exc}".format(
+                user_text=self.user_text,
+                wiki=self.dataset.name,
                 last_edit="Last edit timestamp %s" % last_edit_timestamp
                 if last_edit_timestamp
                 else "",
                 exc=str(exc),
             )
         )
-        return None
 
 
-def update_coedit_data(user_text, new_edits, k, lang="en", session=None, limit=250):
+def after_timestamp(timestamp):
+    """The TIME_FORMAT timestamp one second later (where to list edits from after it)."""
+    return (datetime.strptime(timestamp, TIME_FORMAT) + timedelta(seconds=1)).strftime(TIME_FORMAT)
+
+
+def refresh_user_data(dataset, user_text):
+    """Gather a user's edits since their data was last updated and update their co-edit data.
+
+    Returns the pages that could not be fetched in time (see update_coedit_data).
+    """
+    metadata = dataset.data.metadata(user_text)
+    if metadata is None:
+        # evicted from the overlay since they were checked
+        return []
+    if ingested(dataset, user_text):
+        return []
+    edits = get_additional_edits(
+        dataset, user_text, last_edit_timestamp=metadata["most_recent_edit"]
+    )
+    app.logger.debug("Got %d edits for user %s", len(edits) if edits else 0, user_text)
+    if edits is None:
+        return []
+    return update_coedit_data(dataset, user_text, edits, app.config["EDIT_WINDOW"])
+
+
+def refresh_user_data_many(dataset, user_texts):
+    """refresh_user_data for several users at once: {user_text: pages that could not be fetched in time}.
+
+    Each page is fetched once however many of the users edited it.
+    """
+    metadata = {u: dataset.data.metadata(u) for u in user_texts}
+    # (users evicted from the overlay since they were checked, or kept up to date by ingest.py, are left out)
+    user_texts = [
+        u for u in user_texts if metadata[u] is not None and not ingested(dataset, u)
+    ]
+    edits = map_concurrently(
+        lambda u: get_additional_edits(
+            dataset, u, last_edit_timestamp=metadata[u]["most_recent_edit"]
+        ),
+        user_texts,
+    )
+    new_edits = {u: e for u, e in zip(user_texts, edits) if e is not None}
+    # fetch for all users in parallel, rather than one user's worth of pages at a time
+    max_workers = min(
+        max(1, len(new_edits)) * app.config.get("MW_MAX_WORKERS", DEFAULT_MW_MAX_WORKERS),
+        app.config.get("BATCH_MAX_WORKERS", DEFAULT_BATCH_MAX_WORKERS),
+    )
+    return update_coedit_data_many(
+        dataset, new_edits, app.config["EDIT_WINDOW"], max_workers=max_workers
+    )
+
+
+def ingested(dataset, user_text):
+    """Whether ingest.py is keeping the user's data up to date, so that it needs no refresh.
+
+    That is while the ingester has recorded a batch within INGEST_MAX_LAG
+    seconds, for users whose new edits were last listed after it started taking
+    edits in (it has seen all of their edits since) and who have no pages left
+    to fetch.
+    """
+    max_lag = app.config.get("INGEST_MAX_LAG", DEFAULT_INGEST_MAX_LAG)
+    if not max_lag:
+        return False
+    data = dataset.data
+    state = data.ingest_state()
+    if state is None or state["since"] is None or time.time() - state["updated"] > max_lag:
+        return False
+    cursor = data.edit_cursor(user_text)
+    return (
+        cursor is not None
+        and cursor["continue"] is None
+        and (cursor.get("listed") or "") >= state["since"]
+        and not data.pending_pages(user_text)
+    )
+
+
+def update_coedit_data(dataset, user_text, new_edits, k, session=None):
     """Get all new edits since dump ended on pages the user edited and overlapping users.
 
+    Pages are fetched concurrently and only until the MW_TIME_BUDGET runs out. Pages
+    that could not be fetched in time are returned (so the response can say it is
+    partial) and remembered so the next request for this user retries them.
+    Histories already in the revision cache are only topped up with newer revisions.
+
     NOTE: this is potentially very high latency for pages w/ many edits or if the editor edited many pages
+    (get_additional_edits caps the pages per request, resuming from the user's edit cursor next time)
     TODO: come up with a sampling strategy -- e.g., cap at 50
-    ALT TODO: only do first k -- e.g., 50 -- but rewrite how additional edits are stored so can ensure that the next API call
-    will get the next 50 without missing data.
     """
-    most_similar_users = COEDIT_DATA[user_text]
+    return update_coedit_data_many(dataset, {user_text: new_edits}, k, session)[user_text]
+
+
+@instrumentation.timed("update_coedit_data")
+def update_coedit_data_many(dataset, new_edits, k, session=None, max_workers=None):
+    """update_coedit_data for several users ({user_text: new_edits}) at once.
+
+    Every page is fetched once even if several of the users edited it, and the
+    overlapping users of all of them are checked for bots together. Returns the
+    pages skipped for each user.
+    """
     if session is None:
-        session = mwapi.Session(
-            "https://{0}.wikipedia.org".format(lang), user_agent=app.config["CUSTOM_UA"]
+        session = get_mw_session(dataset.wiki)
+    update = CoeditUpdate(dataset, new_edits, k)
+    # generate list of all revisions since the dumps for each page
+    with instrumentation.stage("fetch_page_revisions", dataset.name):
+        revisions, skipped = mediawiki.fetch_page_revisions(
+            session,
+            update.pageids(),
+            max_workers=max_workers
+            or app.config.get("MW_MAX_WORKERS", DEFAULT_MW_MAX_WORKERS),
+            deadline=mediawiki.Deadline(
+                app.config.get("MW_TIME_BUDGET", DEFAULT_MW_TIME_BUDGET)
+            ),
+            cache=get_revision_cache(dataset.wiki),
+            **update.revisions_query()
         )
+    update.add_revisions(revisions, skipped)
 
-    overlapping_users = {}
-    for pid in new_edits:
-        # generate list of all revisions since user's last recorded revision
-        result = session.get(
-            action="query",
-            prop="revisions",
-            pageids=pid,
+    # remove bots
+    with instrumentation.stage("account_status", dataset.name):
+        statuses = get_account_cache(dataset.wiki).lookup(session, update.unknown_users())
+    return update.record(statuses)
+
+
+class CoeditUpdate(object):
+    """update_coedit_data_many's work apart from the API calls: which pages to fetch and what their histories add.
+
+    The pages are marked as pending for their users until their histories have
+    been taken in (add_revisions), so that if the update is cut short they are
+    fetched on the user's next request.
+    """
+
+    def __init__(self, dataset, new_edits, k):
+        self.dataset = dataset
+        self.k = k
+        data = dataset.data
+        self.user_pageids = {}
+        for user_text, edits in new_edits.items():
+            pending = data.pending_pages(user_text)
+            pageids = list(edits)
+            pageids.extend(p for p in pending if p not in edits)
+            self.user_pageids[user_text] = pageids
+            if pageids != pending:
+                data.set_pending_pages(user_text, pageids)
+        self.skipped_pages = {}
+        self.overlapping_users = {}
+
+    def pageids(self):
+        return list(dict.fromkeys(p for pageids in self.user_pageids.values() for p in pageids))
+
+    def revisions_query(self):
+        """Parameters of the prop=revisions query (besides the page) for the pages' histories since the dumps."""
+        return dict(
             rvprop="ids|timestamp|user",
-            # TODO move this timestamp out of configuration - either automate it
-            # based on current date or query it from a datastore.
-            rvstart=app.config["MOST_RECENT_REV_TS"],
+            rvstart=self.dataset.most_recent_rev_ts,
             rvdir="newer",
             format="json",
             rvlimit=500,
             formatversion=2,
-            continuation=True,
         )
-        for r in result:
-            revs = r["query"]["pages"][0].get("revisions", [])
-            user_edit_indices = [
-                i for i, e in enumerate(revs) if e["user"] == user_text
-            ]
-            for idx in user_edit_indices:
-                for e in revs[max(0, idx - k) : idx + k]:
-                    if e["user"] == user_text:
-                        continue
-                    if e["user"] not in overlapping_users:
-                        overlapping_users[e["user"]] = set()
-                    overlapping_users[e["user"]].add(pid)
 
-    # remove bots
-    new_users = [u for u in overlapping_users if u not in USER_METADATA]
-    for user_list in chunkify(new_users):
-        result = session.get(
-            action="query",
-            list="users",
-            ususers="|".join(user_list),
-            usprop="groups",
-            format="json",
-            formatversion=2,
+    def add_revisions(self, revisions, skipped):
+        """Find the users overlapping in the histories fetched ({page id: revisions}); skipped ones stay pending."""
+        dataset = self.dataset
+        skipped = set(skipped)
+        instrumentation.PAGES_FETCHED.labels(dataset.name).inc(len(revisions))
+        num_revisions = 0
+        overlapping_users = self.overlapping_users
+        for user_text, pageids in self.user_pageids.items():
+            self.skipped_pages[user_text] = [p for p in pageids if p in skipped]
+            dataset.data.set_pending_pages(user_text, self.skipped_pages[user_text])
+            overlapping_users[user_text] = {}
+            for pid in pageids:
+                if pid not in revisions:
+                    continue
+                num_revisions += len(revisions[pid])
+                for u in mediawiki.edit_window_neighbors(revisions[pid], user_text, self.k):
+                    if u not in overlapping_users[user_text]:
+                        overlapping_users[user_text][u] = set()
+                    overlapping_users[user_text][u].add(pid)
+        instrumentation.REVISIONS_SCANNED.labels(dataset.name).inc(num_revisions)
+        instrumentation.OVERLAPPING_USERS.labels(dataset.name).inc(
+            sum(len(overlaps) for overlaps in overlapping_users.values())
         )
-        for u in result["query"]["users"]:
-            if "bot" in u.get("groups", []):
-                overlapping_users.pop(u["name"])
-
-    # update overlap list
-    for i in range(len(most_similar_users) - 1, -1, -1):
-        ut = most_similar_users[i][0]
-        overlap = most_similar_users[i][1]
-        if ut in overlapping_users:
-            new_pages = overlapping_users.pop(ut)
-            overlap += len(new_pages)
-            most_similar_users[i] = (ut, overlap)
-    for u in overlapping_users:
-        most_similar_users.append((u, len(overlapping_users[u])))
-
-    # temporarily add in # of edits from neighbor for purpose of sorting and then remove for long-term storage
-    most_similar_users_sorted = [
-        (u[0], u[1], 0 - USER_METADATA.get(u[0], {}).get("num_pages", 0))
-        for u in most_similar_users
-    ]
-    most_similar_users_sorted = sorted(
-        most_similar_users_sorted, key=lambda x: (x[1], x[2]), reverse=True
-    )
-    most_similar_users_sorted = [(u[0], u[1]) for u in most_similar_users_sorted]
-    if len(most_similar_users_sorted) > limit:
-        cut_at = len(most_similar_users_sorted)
-        for i, u in enumerate(most_similar_users_sorted[limit:]):
-            overlap = u[1]
-            if overlap == 1:
-                cut_at = limit + i
-                break
-        most_similar_users_sorted = most_similar_users_sorted[:cut_at]
-    # Update COEDIT_DATA so future calls don't need to repeat this process
-    COEDIT_DATA[user_text] = most_similar_users_sorted
 
+    def unknown_users(self):
+        """The overlapping users who are not in the data, whose account status has to be looked up."""
+        candidates = list(
+            dict.fromkeys(u for overlaps in self.overlapping_users.values() for u in overlaps)
+        )
+        known_users = self.dataset.data.known_users(candidates)
+        return [u for u in candidates if u not in known_users]
+
+    def record(self, statuses):
+        """Add the overlaps to COEDIT_DATA, leaving out bots (by account status). Returns the pages skipped for each user."""
+        bots = set(u for u, status in statuses.items() if status == mediawiki.BOT)
+        # Update COEDIT_DATA so future calls don't need to repeat this process
+        # (ranking and the `limit` cut-off are applied when the list is read back)
+        for user_text, overlaps in self.overlapping_users.items():
+            self.dataset.data.add_coedits(
+                user_text,
+                {u: len(pages) for u, pages in overlaps.items() if u not in bots},
+            )
+        return self.skipped_pages
+
+
+def get_mw_session(wiki):
+    """Pooled keep-alive API session for a wiki, shared by all requests in this process."""
+    return mediawiki.get_session(
+        wiki.host,
+        app.config["CUSTOM_UA"],
+        pool_size=max(
+            app.config.get("MW_MAX_WORKERS", DEFAULT_MW_MAX_WORKERS),
+            app.config.get("BATCH_MAX_WORKERS", DEFAULT_BATCH_MAX_WORKERS),
+        ),
+        timeout=app.config.get("MW_TIMEOUT", DEFAULT_MW_TIMEOUT),
+    )
+
+
+def get_revision_cache(wiki):
+    """Page histories already fetched from a wiki, shared by all requests in this process."""
+    max_mb = app.config.get("REVISION_CACHE_MB", DEFAULT_REVISION_CACHE_MB)
+    if not max_mb:
+        return None
+    return mediawiki.get_revision_cache(
+        wiki.host,
+        max_mb * 1024 * 1024,
+    )
+
+
+def map_concurrently(fn, items):
+    """[fn(item) for item in items], with the calls (mostly waiting on the API) made in threads."""
+    if len(items) < 2:
+        return [fn(item) for item in items]
+    max_workers = min(len(items), app.config.get("MW_MAX_WORKERS", DEFAULT_MW_MAX_WORKERS))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(fn, items))
 
-def chunkify(l, k=50):
-    for i in range(0, len(l), k):
-        yield l[i : i + k]
 
+def get_account_cache(wiki):
+    """Account statuses already looked up on a wiki, shared by all requests in this process."""
+    return mediawiki.get_account_cache(
+        wiki.host,
+        app.config.get("ACCOUNT_CACHE_SIZE", DEFAULT_ACCOUNT_CACHE_SIZE),
+        app.config.get("ACCOUNT_CACHE_TTL", DEFAULT_ACCOUNT_CACHE_TTL),
+        app.config.get("MW_USERS_BATCH", DEFAULT_MW_USERS_BATCH),
+    )
+
+
+class MediaWikiCacheCollector(object):
+    """Prometheus metrics for the per-process MediaWiki caches (hit rate = hits / lookups)."""
+
+    def collect(self):
+        hits = CounterMetricFamily(
+            "similarusers_mw_cache_hits", "Cache hits", labels=["cache", "host"]
+        )
+        misses = CounterMetricFamily(
+            "similarusers_mw_cache_misses", "Cache misses", labels=["cache", "host"]
+        )
+        entries = GaugeMetricFamily(
+            "similarusers_mw_cache_entries", "Entries cached", labels=["cache", "host"]
+        )
+        for kind, host, cache in mediawiki.caches():
+            hits.add_metric([kind, host], cache.hits)
+            misses.add_metric([kind, host], cache.misses)
+            entries.add_metric([kind, host], len(cache))
+        yield hits
+        yield misses
+        yield entries
+
+
+REGISTRY.register(MediaWikiCacheCollector())
 
-def check_user_text(user_text):
+
+class DataCollector(object):
+    """Prometheus metrics for the data held for each wiki: snapshot, overlay, responses and refreshes."""
+
+    def collect(self):
+        if WIKIS is None:
+            return
+        loaded = GaugeMetricFamily(
+            "similarusers_wiki_loaded_bytes",
+            "Size of the snapshot loaded for a wiki (0 if it is not loaded)",
+            labels=["wiki"],
+        )
+        users = GaugeMetricFamily(
+            "similarusers_snapshot_users", "Users in the snapshot", labels=["wiki"]
+        )
+        overlay = GaugeMetricFamily(
+            "similarusers_overlay_entries",
+            "Entries learned since the snapshot, by kind of data",
+            labels=["wiki", "data"],
+        )
+        overlay_bytes = GaugeMetricFamily(
+            "similarusers_overlay_bytes",
+            "Bytes held by the overlay (in memory, or on disk for SQLite), by kind of data",
+            labels=["wiki", "data"],
+        )
+        evicted = CounterMetricFamily(
+            "similarusers_overlay_evicted_users",
+            "Users evicted from the in-memory overlay to stay within OVERLAY_MEMORY_MB",
+            labels=["wiki"],
+        )
+        responses = GaugeMetricFamily(
+            "similarusers_response_cache_entries", "Responses cached", labels=["wiki"]
+        )
+        pending = GaugeMetricFamily(
+            "similarusers_refresh_queue_pending",
+            "Refreshes waiting for a worker",
+            labels=["wiki"],
+        )
+        ingest_age = GaugeMetricFamily(
+            "similarusers_ingest_age_seconds",
+            "Seconds since ingest.py last recorded a batch of edits",
+            labels=["wiki"],
+        )
+        for wiki in WIKIS:
+            dataset = wiki.dataset
+            loaded.add_metric([wiki.name], 0 if dataset is None else dataset.nbytes)
+            if dataset is not None and dataset.data.snapshot is not None:
+                users.add_metric([wiki.name], dataset.data.snapshot.num_users)
+            if wiki.overlay is not None:
+                for name, size in sorted(wiki.overlay.sizes().items()):
+                    overlay.add_metric([wiki.name, name], size)
+                for name, nbytes in sorted(wiki.overlay.byte_sizes().items()):
+                    overlay_bytes.add_metric([wiki.name, name], nbytes)
+                evicted.add_metric([wiki.name], wiki.overlay.evicted_users)
+                ingest_state = wiki.overlay.get_ingest_state()
+                if ingest_state is not None:
+                    ingest_age.add_metric([wiki.name], time.time() - ingest_state["updated"])
+            responses.add_metric([wiki.name], len(wiki.responses))
+            pending.add_metric([wiki.name], wiki.refreshes.pending())
+        yield loaded
+        yield users
+        yield overlay
+        yield overlay_bytes
+        yield evicted
+        yield responses
+        yield pending
+        yield ingest_age
+
+
+REGISTRY.register(DataCollector())
+
+
+@instrumentation.timed("check_user_text")
+def check_user_text(dataset, user_text):
     # already in dataset -- meets valid user criteria
-    if user_text in USER_METADATA:
+    if user_text in dataset.data:
         return None
 
     # wasn't in dataset
     # this could be because they have only contributed since the date of the dumps
     # but have to be careful to filter out bots still
     # unfortunately no one API call can give: is user/anon but not bot
-    session = mwapi.Session(
-        "https://en.wikipedia.org", user_agent=app.config["CUSTOM_UA"]
-    )
+    wiki = dataset.wiki
+    session = get_mw_session(wiki)
     # check if user has made contributions in 2020
-    result = session.get(
+    result = session.get(**usercontribs_query(dataset, user_text))
+    instrumentation.api_call("usercontribs", session.host)
+
+    status = None
+    if result["query"]["usercontribs"]:
+        # check if bot
+        status = get_account_cache(wiki).lookup(session, [user_text]).get(user_text)
+    return admit_user(dataset, user_text, bool(result["query"]["usercontribs"]), status)
+
+
+def usercontribs_query(dataset, user_text):
+    """list=usercontribs query for whether a user has edited in scope since the start of the dumps."""
+    return dict(
         action="query",
         list="usercontribs",
         ucuser=user_text,
         ucprop="timestamp",
         ucnamespace="|".join([str(ns) for ns in app.config["NAMESPACES"]]),
-        # TODO move this timestamp out of configuration - either automate it
-        # based on current date or query it from a datastore.
-        ucstart=app.config["EARLIEST_TS"],
+        # the start of the wiki's dumps (from its snapshot, or the configuration)
+        ucstart=dataset.earliest_ts,
         ucdir="newer",
         uclimit=1,
         format="json",
         formatversion=2,
     )
 
-    if result["query"]["usercontribs"]:
-        # check if bot
-        result = session.get(
-            action="query",
-            list="users",
-            ususers=user_text,
-            usprop="groups",
-            format="json",
-            formatversion=2,
-        )
+
+def admit_user(dataset, user_text, has_contribs, status):
+    """Add a user who is not in the data if they are in scope (see check_user_text). Returns an error otherwise.
+
+    has_contribs: whether they have edited in scope; status: their account status
+    (None if it could not be looked up).
+    """
+    wiki = dataset.wiki
+    if has_contribs:
         # this condition should never be met -- valid username w/ contributions but no account info
-        if "missing" in result["query"]["users"][0]:
+        if status == mediawiki.MISSING:
             app.logger.error(
-                "Received request for user %s when they don't appear to have an enwiki account",
+                "Received request for user %s when they don't appear to have an %s account",
                 user_text,
+                wiki.name,
             )
-            return "User `{0}` does not appear to have an account in English Wikipedia.".format(
-                user_text
+            return "User `{0}` does not appear to have an account in {1}.".format(
+                user_text, wiki.title
             )
         # anon (has contribs but not a valid account name)
-        elif "invalid" in result["query"]["users"][0]:
-            USER_METADATA[user_text] = {
-                "is_anon": True,
-                "num_edits": 0,
-                "num_pages": 0,
-                "most_recent_edit": None,
-                "oldest_edit": None,
-            }
-            TEMPORAL_DATA[user_text] = {"d": [0] * 7, "h": [0] * 24}
-            COEDIT_DATA[user_text] = []
+        elif status == mediawiki.ANON:
+            dataset.data.add_user(user_text, is_anon=True)
             return None
-        elif "groups" in result["query"]["users"][0]:
+        elif status is not None:
             # bot
-            if "bot" in result["query"]["users"][0]["groups"]:
+            if status == mediawiki.BOT:
                 app.logger.warning(
                     "Received request for user %s which is a bot account - out of scope",
                     user_text,
@@ -423,32 +1429,32 @@ def check_user_text(user_text):
                 )
             # exists and is user but wasn't in original dataset
             else:
-                USER_METADATA[user_text] = {
-                    "is_anon": False,
-                    "num_edits": 0,
-                    "num_pages": 0,
-                    "most_recent_edit": None,
-                    "oldest_edit": None,
-                }
-                TEMPORAL_DATA[user_text] = {"d": [0] * 7, "h": [0] * 24}
-                COEDIT_DATA[user_text] = []
+                dataset.data.add_user(user_text, is_anon=False)
                 app.logger.debug(
                     "Received request for user %s but user is not in dataset", user_text
                 )
                 return None
 
-    # account has no contributions in enwiki in namespaces
+    # account has no contributions in the wiki in namespaces
     app.logger.warning(
-        "Received request for user %s but user does not have an account or edits in scope on enwiki",
+        "Received request for user %s but user does not have an account or edits in scope on %s",
         user_text,
+        wiki.name,
     )
-    return "User `{0}` does not appear to have an account (or edits in scope) in English Wikipedia.".format(
-        user_text
+    return "User `{0}` does not appear to have an account (or edits in scope) in {1}.".format(
+        user_text, wiki.title
     )
 
 
-def validate_api_args():
+def validate_api_args(dataset):
     """Validate API arguments for model. Return error if missing or user-text does not exist or not relevant."""
+    user_text, num_similar, followup = parse_api_args()
+    user_text, error = validate_user_text(dataset, user_text)
+    return user_text, num_similar, followup, error
+
+
+def parse_api_args():
+    """The usertext, k and followup arguments of a /similarusers request (the usertext not yet checked)."""
     user_text = request.args.get("usertext")
     num_similar = request.args.get("k", DEFAULT_K)  # must be between 1 and 250
     followup = "followup" in request.args
@@ -458,103 +1464,323 @@ def validate_api_args():
     if not num_similar:
         abort(422, "No k specified")
 
-    error = None
+    return user_text, validate_num_similar(num_similar), followup
+
+
+def validate_batch_api_args(dataset):
+    """Validate API arguments for the batch endpoint. Returns [(user_text, error)] for each user."""
+    user_texts = [
+        u for arg in request.args.getlist("usertext") for u in arg.split("|") if u
+    ]
+    num_similar = request.args.get("k", DEFAULT_K)  # must be between 1 and 250
+    followup = "followup" in request.args
+
+    if not user_texts:
+        abort(422, "No usertext provided")
+    max_users = app.config.get("BATCH_MAX_USERS", DEFAULT_BATCH_MAX_USERS)
+    if len(user_texts) > max_users:
+        abort(422, "At most {0} usertexts can be queried together".format(max_users))
+    if not num_similar:
+        abort(422, "No k specified")
+
+    num_similar = validate_num_similar(num_similar)
+    checked = map_concurrently(lambda u: validate_user_text(dataset, u), user_texts)
+    # the same user may have been given in different forms
+    checked = list(OrderedDict((u, (u, error)) for u, error in checked).values())
+    return checked, num_similar, followup
+
+
+def validate_temporal_filters():
+    """The anon, active_since and active_until arguments of the temporal endpoint (None where not given)."""
+    is_anon = request.args.get("anon")
+    if is_anon is not None:
+        if is_anon not in ("0", "1"):
+            abort(422, "anon must be 0 or 1")
+        is_anon = is_anon == "1"
+    period = []
+    for arg in ("active_since", "active_until"):
+        ts = request.args.get(arg) or None
+        if ts is not None:
+            try:
+                datetime.strptime(ts, TIME_FORMAT)
+            except ValueError:
+                abort(422, "{0} must look like 2021-01-31T23:59:59Z".format(arg))
+        period.append(ts)
+    return (is_anon,) + tuple(period)
+
+
+def validate_ranking():
+    ranking = request.args.get("ranking") or RANKINGS[0]
+    if ranking not in RANKINGS:
+        abort(422, "ranking must be one of: {0}".format(", ".join(RANKINGS)))
+    return ranking
+
+
+def validate_num_similar(num_similar):
     try:
         num_similar = max(1, int(num_similar))
         num_similar = min(num_similar, 250)
     except ValueError:
         num_similar = DEFAULT_K
-    # standardize usertext
+    return num_similar
+
+
+def validate_user_text(dataset, user_text):
+    """Standardize a usertext and check it is in scope. Returns (user_text, error)."""
+    error = None
+    user_text = standardize_user_text(user_text)
+    if user_text:
+        # concurrent requests for a user who is not in the data share one check
+        error = USER_CHECKS.do(
+            (dataset.name, user_text), lambda: check_user_text(dataset, user_text)
+        )
+    else:
+        error = MISSING_USER_TEXT
+    return user_text, error
+
+
+def standardize_user_text(user_text):
     if user_text.lower().startswith("user:"):
         user_text = user_text[5:]
     if user_text:
         user_text = user_text.replace(" ", "_")
         user_text = user_text[0].upper() + user_text[1:]
-        error = check_user_text(user_text)
-    else:
-        error = 'missing user_text -- e.g., "Isaac (WMF)" for https://en.wikipedia.org/wiki/User:Isaac_(WMF)'
-    return user_text, num_similar, followup, error
+    return user_text
 
 
-def load_coedit_data(resource_dir):
-    """Load preprocessed data about edit overlap between users."""
-    app.logger.info("Loading co-edit data")
-    expected_header = ["user_text", "user_neighbor", "num_pages_overlapped"]
-    with open(os.path.join(resource_dir, "coedit_counts.tsv"), "r") as fin:
-        assert next(fin).strip().split("\t") == expected_header
-        for line_str in fin:
-            line = line_str.strip().split("\t")
-            user = line[0]
-            neighbor = line[1]
-            overlap_count = int(line[2])
-            if user not in COEDIT_DATA:
-                COEDIT_DATA[user] = []
-            COEDIT_DATA[user].append((neighbor, overlap_count))
-    return COEDIT_DATA
-
-
-def load_temporal_data(resource_dir):
-    """Load preprocessed temporal information about when an account has edited."""
-    app.logger.info("Loading temporal data")
-    expected_header = ["user_text", "day_of_week", "hour_of_day", "num_edits"]
-    with open(os.path.join(resource_dir, "temporal.tsv"), "r") as fin:
-        assert next(fin).strip().split("\t") == expected_header
-        for line_str in fin:
-            line = line_str.strip().split("\t")
-            user_text = line[0]
-            day_of_week = int(line[1]) - 1  # 0 Sunday - 6 Saturday
-            hour_of_day = int(line[2])  # 0 - 23
-            num_edits = int(line[3])
-            if user_text not in TEMPORAL_DATA:
-                TEMPORAL_DATA[user_text] = {"d": [0] * 7, "h": [0] * 24}
-            update_temporal_data(user_text, day_of_week, hour_of_day, num_edits)
-
-
-def update_temporal_data(user_text, day, hour, num_edits):
+def update_temporal_data(temporal, day, hour, num_edits):
     """Update data on hours / days in which a user has edited."""
-    if user_text not in TEMPORAL_DATA:
-        TEMPORAL_DATA[user_text] = {"d": [0] * 7, "h": [0] * 24}
     # potentially smear data so edits in nearby hours also overlap (not just direct matches)
     offset_tup = make_tuple(app.config["TEMPORAL_OFFSET"])
-    for offset in offset_tup:
-        h = hour + offset  # -1 to 24
-        d = (day + (h // 24)) % 7
-        h = h % 24
-        TEMPORAL_DATA[user_text]["d"][d] += num_edits
-        TEMPORAL_DATA[user_text]["h"][h] += num_edits
-
-
-def load_metadata(resource_dir):
-    """Load some basic statistics about coverage of each account in the data."""
-    app.logger.info("Loading metadata")
-    expected_header = [
-        "user_text",
-        "is_anon",
-        "num_edits",
-        "num_pages",
-        "most_recent_edit",
-        "oldest_edit",
-    ]
-    with open(os.path.join(resource_dir, "metadata.tsv"), "r") as fin:
-        assert next(fin).strip().split("\t") == expected_header
-        for line_str in fin:
-            # TODO use csv library here?
-            line = line_str.strip().split("\t")
-            user = line[0]
-            USER_METADATA[user] = {
-                "is_anon": bool(distutils.util.strtobool(line[1])),
-                "num_edits": int(line[2]),
-                "num_pages": int(line[3]),
-                "most_recent_edit": line[4],
-                "oldest_edit": line[5],
-            }
+    snapshot.smear_temporal(temporal, day, hour, num_edits, offset_tup)
 
 
 def load_data(resource_dir):
-    """Load in necessary data for tool."""
-    load_coedit_data(resource_dir)
-    load_temporal_data(resource_dir)
-    load_metadata(resource_dir)
+    """Load in necessary data for tool.
+
+    The wikis served are set up from the WIKIS config (see build_wikis) and the
+    default wiki's data is loaded; the others are loaded when first queried. A
+    wiki's TSVs are compiled into a snapshot under `<its resource dir>/snapshot`
+    (ideally ahead of time with compile_snapshot.py); after that the snapshot
+    is just memory-mapped, which is near-instant and shared between all worker
+    processes.
+
+    What is learned from queries goes to the SQLite overlay at OVERLAY_PATH
+    (default `resource_dir/overlay.sqlite3`), or stays in each worker's memory if
+    OVERLAY_PATH is set to an empty value.
+    """
+    global WIKIS
+    WIKIS = build_wikis(str(resource_dir))
+    WIKIS.dataset(WIKIS.default)
+
+
+def build_wikis(resource_dir):
+    """WikiRegistry of the wikis in the WIKIS config, or of just DEFAULT_WIKI with its data in resource_dir.
+
+    WIKIS maps database names to options, all of them optional:
+    * resources: directory with the wiki's TSVs and snapshot (default
+      resource_dir for the default wiki, resource_dir/<name> for the others)
+    * lang: language code, used for the API host (default from the name, e.g. "fr" for "frwiki")
+    * url: API host (default MEDIAWIKI_URL with the language code)
+    * title: name of the wiki in messages (e.g. "French Wikipedia")
+    * overlay: like OVERLAY_PATH (which otherwise only applies to the default
+      wiki; the others get `<resources>/overlay.sqlite3`, or memory if it is empty)
+    * most_recent_rev_ts, earliest_ts: for snapshots that don't record them
+      (default MOST_RECENT_REV_TS and EARLIEST_TS)
+    """
+    default = app.config.get("DEFAULT_WIKI", DEFAULT_WIKI)
+    configured = app.config.get("WIKIS") or {default: {}}
+    if default not in configured:
+        raise ValueError("DEFAULT_WIKI {0} is not one of the WIKIS".format(default))
+    registry = wikis.WikiRegistry(
+        load_wiki,
+        default,
+        max_bytes=app.config.get("WIKI_MEMORY_MB", DEFAULT_WIKI_MEMORY_MB) * 1024 * 1024,
+        unload=unload_wiki,
+    )
+    overlay_path = app.config.get("OVERLAY_PATH")
+    for name, options in configured.items():
+        options = options or {}
+        lang = options.get("lang", wikis.lang_of(name))
+        wiki_dir = str(
+            options.get(
+                "resources", resource_dir if name == default else os.path.join(resource_dir, name)
+            )
+        )
+        if "overlay" in options:
+            wiki_overlay = options["overlay"]
+        elif overlay_path is not None and (name == default or not overlay_path):
+            wiki_overlay = overlay_path
+        else:
+            wiki_overlay = os.path.join(wiki_dir, "overlay.sqlite3")
+        wiki = wikis.Wiki(
+            name,
+            lang,
+            wiki_dir,
+            options.get("url", app.config.get("MEDIAWIKI_URL", MEDIAWIKI_URL).format(lang)),
+            title=options.get("title"),
+            overlay_path=str(wiki_overlay) if wiki_overlay else None,
+            pinned=name == default,
+            most_recent_rev_ts=options.get(
+                "most_recent_rev_ts", app.config.get("MOST_RECENT_REV_TS")
+            ),
+            earliest_ts=options.get("earliest_ts", app.config.get("EARLIEST_TS")),
+        )
+        wiki.responses = response_cache.ResponseCache(
+            app.config.get("RESPONSE_CACHE_SIZE", DEFAULT_RESPONSE_CACHE_SIZE),
+            app.config.get("RESPONSE_CACHE_TTL", DEFAULT_RESPONSE_CACHE_TTL),
+        )
+        wiki.refreshes = refresh.RefreshQueue(
+            functools.partial(refresh_wiki_user, name),
+            app.config.get("REFRESH_WORKERS", DEFAULT_REFRESH_WORKERS),
+        )
+        registry.add(wiki)
+    return registry
+
+
+def refresh_wiki_user(name, user_text):
+    """refresh_user_data with the current dataset of the named wiki (run by its RefreshQueue)."""
+    return refresh_user_data(WIKIS.dataset(name), user_text)
+
+
+def load_wiki(wiki):
+    """Load a wiki's dataset -- called by WIKIS the first time the wiki is used (or after it was unloaded)."""
+    start = time.time()
+    wiki.load_status = wikis.load_status("loading")
+    wiki.load_status["started"] = time.strftime(TIME_FORMAT, time.gmtime())
+    try:
+        dataset = _load_wiki(wiki)
+    except Exception as exc:
+        wiki.load_status.update(status="failed", error=str(exc))
+        raise
+    wiki.load_status.update(
+        status="ready", stage=None, finished=time.strftime(TIME_FORMAT, time.gmtime())
+    )
+    instrumentation.LOAD_SECONDS.labels(wiki.name).set(time.time() - start)
+    return dataset
+
+
+def _load_wiki(wiki):
+    snapshot_dir = os.path.join(wiki.resource_dir, "snapshot")
+    if not os.path.exists(os.path.join(snapshot_dir, snapshot.META_FILE)):
+        if not wiki.pinned:
+            # far too slow to do while a request waits
+            raise snapshot.SnapshotError(
+                "No snapshot at {0} -- compile it with compile_snapshot.py".format(snapshot_dir)
+            )
+        app.logger.info("No snapshot at %s -- compiling it from the TSVs", snapshot_dir)
+        wiki.load_status["stage"] = "compiling snapshot"
+        compile_snapshot.compile_snapshot(
+            wiki.resource_dir,
+            snapshot_dir,
+            make_tuple(app.config["TEMPORAL_OFFSET"]),
+            most_recent_rev_ts=wiki.most_recent_rev_ts,
+            earliest_ts=wiki.earliest_ts,
+        )
+    if wiki.overlay is None:
+        wiki.load_status["stage"] = "opening overlay"
+        if wiki.overlay_path:
+            app.logger.info("Using overlay at %s for %s", wiki.overlay_path, wiki.name)
+            wiki.overlay = datastore.SqliteOverlay(wiki.overlay_path)
+        else:
+            wiki.overlay = datastore.MemoryOverlay(
+                max_bytes=int(
+                    app.config.get("OVERLAY_MEMORY_MB", DEFAULT_OVERLAY_MEMORY_MB) * 1024 * 1024
+                )
+            )
+    return open_data(wiki, os.path.realpath(snapshot_dir))
+
+
+def unload_wiki(wiki):
+    """Forget what is cached for a wiki that WIKIS unloaded (the overlay is kept)."""
+    wiki.responses.clear()
+    wiki.refreshes.forget_finished()
+    if not any(w.host == wiki.host for w in WIKIS.loaded()):
+        mediawiki.drop_caches(wiki.host)
+
+
+def open_data(wiki, snapshot_dir):
+    """Dataset for the snapshot at snapshot_dir, with the wiki's overlay moved onto it.
+
+    The period it covers is taken from the snapshot (when it recorded it), since
+    new edits have to be gathered from where its data ends.
+    """
+    wiki.load_status["stage"] = "opening snapshot"
+    data_snapshot = snapshot.Snapshot(snapshot_dir)
+    if app.config.get("VERIFY_SNAPSHOT", False):
+        wiki.load_status["stage"] = "verifying snapshot checksums"
+        data_snapshot.verify_checksums()
+    if data_snapshot.temporal_offset != tuple(make_tuple(app.config["TEMPORAL_OFFSET"])):
+        app.logger.warning(
+            "Snapshot was built with TEMPORAL_OFFSET %s but config has %s",
+            data_snapshot.temporal_offset,
+            app.config["TEMPORAL_OFFSET"],
+        )
+    most_recent_rev_ts = data_snapshot.meta.get("most_recent_rev_ts") or wiki.most_recent_rev_ts
+    earliest_ts = data_snapshot.meta.get("earliest_ts") or wiki.earliest_ts
+    app.logger.info(
+        "Loaded snapshot of %d users for %s (%s to %s)",
+        data_snapshot.num_users,
+        wiki.name,
+        earliest_ts,
+        most_recent_rev_ts,
+    )
+    wiki.load_status["stage"] = "moving overlay onto snapshot"
+    wiki.overlay = wiki.overlay.rebase(
+        data_snapshot.id, data_snapshot.meta.get("most_recent_rev_ts")
+    )
+    return wikis.Dataset(
+        wiki, datastore.UserStore(data_snapshot, wiki.overlay), most_recent_rev_ts, earliest_ts
+    )
+
+
+def reload_data(wiki, snapshot_dir=None):
+    """Switch a wiki to the snapshot at snapshot_dir without restarting. Returns whether anything changed.
+
+    snapshot_dir (e.g. a new month's snapshot written next to the current one
+    with compile_snapshot.py -o) is installed as <the wiki's resource dir>/snapshot,
+    which the other workers check every SNAPSHOT_CHECK_INTERVAL seconds. Without
+    it, this worker just catches up with whatever is installed there. The new
+    snapshot is loaded alongside the current one and swapped in at once:
+    requests in flight finish on the data they started with. Cached responses
+    and finished refreshes are forgotten, and the overlay keeps only the updates
+    the new dumps do not cover. A wiki that isn't loaded just picks up the new
+    snapshot when it next is.
+    """
+    link = os.path.join(wiki.resource_dir, "snapshot")
+    with wiki.lock:
+        if snapshot_dir is not None:
+            snapshot.install_snapshot(snapshot_dir, link)
+        current = wiki.dataset
+        if current is None:
+            return snapshot_dir is not None
+        snapshot_dir = os.path.realpath(link)
+        if current.data.snapshot is not None and current.data.snapshot.path == snapshot_dir:
+            return False
+        start = time.time()
+        app.logger.warning("Switching %s to the snapshot at %s", wiki.name, snapshot_dir)
+        wiki.dataset = open_data(wiki, snapshot_dir)
+        wiki.load_status["stage"] = None
+        wiki.responses.clear()
+        wiki.refreshes.forget_finished()
+        instrumentation.LOAD_SECONDS.labels(wiki.name).set(time.time() - start)
+    # the new snapshot may be bigger
+    WIKIS.evict(keep=wiki)
+    return True
+
+
+def check_snapshot(wiki):
+    """Reload a loaded wiki if another worker installed a new snapshot (checked at most every SNAPSHOT_CHECK_INTERVAL seconds)."""
+    interval = app.config.get("SNAPSHOT_CHECK_INTERVAL", DEFAULT_SNAPSHOT_CHECK_INTERVAL)
+    now = time.monotonic()
+    if wiki.dataset is None or not interval or now < wiki.next_snapshot_check:
+        return
+    wiki.next_snapshot_check = now + interval
+    try:
+        reload_data(wiki)
+    except Exception:
+        # keep serving the current data
+        app.logger.exception("Failed to switch %s to the newly installed snapshot", wiki.name)
 
 
 def parse_args():
@@ -590,20 +1816,59 @@ def parse_args():
     return parser.parse_args()
 
 
-def main():
-
-    args = parse_args()
+def configure(config_path):
     # TODO move app creation to its own function rather than using it as a
     # global
-    config_yaml = yaml.safe_load(open(args.config))
+    config_yaml = yaml.safe_load(open(config_path))
     app.config.update(config_yaml)
 
     logging.basicConfig(level=logging.getLevelName(config_yaml["LOG_LEVEL"]))
 
+
+def preload():
+    """Configure and load the data in the uWSGI master, before it forks the workers.
+
+    The snapshot is memory-mapped numpy arrays, so the workers share it through
+    the page cache rather than each holding a copy. What little else is built
+    while loading is then moved out of reach of the garbage collector
+    (gc.freeze), so collections in the workers don't write to -- and so copy --
+    the pages they inherited from the master. The config and resource directory
+    default to the ones next to this file and can be set with the
+    SIMILARUSERS_CONFIG and SIMILARUSERS_RESOURCES environment variables.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    configure(
+        os.environ.get("SIMILARUSERS_CONFIG", os.path.join(here, "flask_config.yaml"))
+    )
+    try:
+        load_data(
+            os.environ.get("SIMILARUSERS_RESOURCES", os.path.join(here, "resources"))
+        )
+    except Exception:
+        # keep the app up so /healthz can say what went wrong
+        app.logger.exception("Failed to load data")
+    gc.collect()
+    gc.freeze()
+
+
+def main():
+
+    args = parse_args()
+    configure(args.config)
+
     load_data(args.resourcedir)
     # Only use LISTEN_IP to configure docker port exposure - not for serving elsewhere.
     app.run(app.config["LISTEN_IP"] if "LISTEN_IP" in app.config else "127.0.0.1")
 
 
+try:
+    # only importable when running under uWSGI, which never calls main()
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+if uwsgi is not None:
+    preload()
+
 if __name__ == "__main__":
     main()